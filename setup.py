@@ -57,7 +57,6 @@ setup(
     include_package_data=True,
     install_requires=[
         "netifaces>=0.10.9,<0.11",
-        "upnpclient>=0.0.8,<1",
     ],
     python_requires='>=3.6, <4',
     extras_require=extras_require,
@@ -0,0 +1,289 @@
+"""
+Benchmarks of discovery and port mapping against fake IGDs served on loopback.
+
+Run ``python tests/benchmarks/run_benchmarks.py``, or add ``--json`` to save the
+results and compare them between releases.  Each scenario starts its own devices, so
+the numbers only depend on the library and on the simulated device latency.
+"""
+import argparse
+import asyncio
+from contextlib import contextmanager
+import functools
+import json
+from pathlib import Path
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# Run from a checkout: the fake devices live with the tests
+TESTS_DIR = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(TESTS_DIR.parent), str(TESTS_DIR / "core")]
+
+from fake_igd import FakeIGD, FakeSSDPResponder  # noqa: E402 isort:skip
+from upnp_port_forward import aio, client, ssdp  # noqa: E402 isort:skip
+from upnp_port_forward.tools import export  # noqa: E402 isort:skip
+
+CONTENT_DIRECTORY = "urn:schemas-upnp-org:service:ContentDirectory:1"
+MEDIA_SERVER = "urn:schemas-upnp-org:device:MediaServer:1"
+
+PORT = 30303
+
+# The phases of a run, each ending with the first request of the next one
+PHASES = ("discovery", "description", "probe", "mapping")
+
+
+class Scenario(NamedTuple):
+    name: str
+    # Called with the address of the SSDP responder and the discovery timeout
+    run: Callable[[Tuple[str, int], float], Any]
+    # Options of the FakeIGD serving each WAN device
+    igds: Tuple[Dict[str, Any], ...] = ({},)
+    # Devices without any WAN service answering the searches, e.g. TVs or printers
+    decoys: int = 0
+    # Called with the started WAN devices, before the run
+    setup: Optional[Callable[[List[FakeIGD]], None]] = None
+
+
+class RunResult(NamedTuple):
+    wall_time: float
+    soap_calls: int
+    http_requests: int
+    phases: Dict[str, Optional[float]]
+
+
+def _setup_port_map(
+    ssdp_address: Tuple[str, int], timeout: float, **kwargs: Any
+) -> Any:
+    return client.setup_port_map(PORT, **kwargs)
+
+
+def _setup_port_maps(ssdp_address: Tuple[str, int], timeout: float) -> Any:
+    return client.setup_port_maps(range(PORT, PORT + 32))
+
+
+def _fetch_add_portmapping_services(
+    ssdp_address: Tuple[str, int], timeout: float
+) -> Any:
+    return export.fetch_add_portmapping_services()
+
+
+def _aio_setup_port_map(ssdp_address: Tuple[str, int], timeout: float) -> Any:
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            aio.setup_port_map(
+                PORT, discovery_timeout=timeout, ssdp_address=ssdp_address
+            )
+        )
+    finally:
+        loop.close()
+
+
+def _map_tcp_port_elsewhere(igds: List[FakeIGD]) -> None:
+    igds[0].mappings[(str(PORT), "TCP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": str(PORT),
+    }
+
+
+def _fail_first_device(igds: List[FakeIGD]) -> None:
+    igds[0].errors["AddPortMapping"] = (501, "ActionFailed")
+
+
+SCENARIOS = (
+    Scenario("setup_port_map", _setup_port_map),
+    Scenario(
+        "setup_port_map, 50 decoys, 50ms device",
+        _setup_port_map,
+        igds=({"delay": 0.05},),
+        decoys=50,
+    ),
+    Scenario(
+        "setup_port_map, TCP port taken",
+        _setup_port_map,
+        setup=_map_tcp_port_elsewhere,
+    ),
+    Scenario(
+        "setup_port_map, failing + slow + working",
+        _setup_port_map,
+        igds=({}, {"delay": 0.5}, {}),
+        setup=_fail_first_device,
+    ),
+    Scenario(
+        "setup_port_map concurrent, failing + slow + working",
+        functools.partial(_setup_port_map, concurrent=True),
+        igds=({}, {"delay": 0.5}, {}),
+        setup=_fail_first_device,
+    ),
+    Scenario("setup_port_maps, 32 ports", _setup_port_maps, igds=({"delay": 0.05},)),
+    Scenario(
+        "fetch_add_portmapping_services, 50 decoys",
+        _fetch_add_portmapping_services,
+        decoys=50,
+    ),
+    Scenario("aio.setup_port_map, 50 decoys", _aio_setup_port_map, decoys=50),
+)
+
+
+@contextmanager
+def _searching(ssdp_address: Tuple[str, int], timeout: float) -> Iterator[None]:
+    """
+    Send the searches of the library to ``ssdp_address`` instead of the multicast group.
+    """
+    search = functools.partial(ssdp.search, timeout=timeout, ssdp_address=ssdp_address)
+    original_searches = client.search, export.search
+    client.search = export.search = search
+    try:
+        yield
+    finally:
+        client.search, export.search = original_searches
+
+
+def _phases(
+    start: float, end: float, igds: List[FakeIGD]
+) -> Dict[str, Optional[float]]:
+    timeline = sorted(event for igd in igds for event in igd.timeline)
+
+    def first(predicate: Callable[[str], bool]) -> Optional[float]:
+        return next((at for at, event in timeline if predicate(event)), None)
+
+    boundaries = [
+        start,
+        first(lambda event: event.startswith("GET ")),
+        first(lambda event: not event.startswith("GET ")),
+        first(lambda event: event == "AddPortMapping"),
+        end,
+    ]
+    phases: Dict[str, Optional[float]] = {}
+    for phase, phase_start, phase_end in zip(PHASES, boundaries, boundaries[1:]):
+        if phase_start is None or phase_end is None:
+            phases[phase] = None
+        else:
+            phases[phase] = phase_end - phase_start
+    return phases
+
+
+def run_scenario(scenario: Scenario, discovery_timeout: float) -> RunResult:
+    igds = [
+        FakeIGD(udn=f"uuid:fake-igd-{index}", **options).start()
+        for index, options in enumerate(scenario.igds)
+    ]
+    decoys = [
+        FakeIGD(
+            udn=f"uuid:decoy-{index}",
+            service_name="ContentDirectory1",
+            service_type=CONTENT_DIRECTORY,
+            device_type=MEDIA_SERVER,
+        ).start()
+        for index in range(scenario.decoys)
+    ]
+    try:
+        if scenario.setup is not None:
+            scenario.setup(igds)
+        with FakeSSDPResponder(*igds, *decoys) as responder, _searching(
+            responder.address, discovery_timeout
+        ):
+            start = time.monotonic()
+            try:
+                scenario.run(responder.address, discovery_timeout)
+            finally:
+                end = time.monotonic()
+
+        devices = igds + decoys
+        return RunResult(
+            wall_time=end - start,
+            soap_calls=sum(len(device.calls) for device in devices),
+            http_requests=sum(
+                len(device.requests) + len(device.calls) for device in devices
+            ),
+            phases=_phases(start, end, devices),
+        )
+    finally:
+        for device in igds + decoys:
+            device.stop()
+
+
+def _median(values: List[Optional[float]]) -> Optional[float]:
+    present = [value for value in values if value is not None]
+    return statistics.median(present) if present else None
+
+
+def summarize(scenario: Scenario, runs: List[RunResult]) -> Dict[str, Any]:
+    return {
+        "scenario": scenario.name,
+        "runs": len(runs),
+        "wall_time": statistics.median(run.wall_time for run in runs),
+        "wall_time_min": min(run.wall_time for run in runs),
+        "soap_calls": max(run.soap_calls for run in runs),
+        "http_requests": max(run.http_requests for run in runs),
+        "phases": {
+            phase: _median([run.phases[phase] for run in runs]) for phase in PHASES
+        },
+    }
+
+
+def _milliseconds(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}"
+
+
+def format_table(summaries: List[Dict[str, Any]]) -> str:
+    headers = ("scenario", "wall ms", "min ms", "soap", "http") + PHASES
+    rows = [
+        (
+            summary["scenario"],
+            _milliseconds(summary["wall_time"]),
+            _milliseconds(summary["wall_time_min"]),
+            str(summary["soap_calls"]),
+            str(summary["http_requests"]),
+            *(_milliseconds(summary["phases"][phase]) for phase in PHASES),
+        )
+        for summary in summaries
+    ]
+    widths = [
+        max(len(row[column]) for row in (headers,) + tuple(rows))
+        for column in range(len(headers))
+    ]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if column == 0 else cell.rjust(width)
+            for column, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in (headers,) + tuple(rows)
+    ]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="runs per scenario")
+    parser.add_argument(
+        "--discovery-timeout",
+        type=float,
+        default=1.0,
+        help="seconds to wait for SSDP answers",
+    )
+    parser.add_argument(
+        "--only", help="only run the scenarios whose name contains this string"
+    )
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    summaries = []
+    for scenario in SCENARIOS:
+        if args.only and args.only not in scenario.name:
+            continue
+        runs = [
+            run_scenario(scenario, args.discovery_timeout) for _ in range(args.repeat)
+        ]
+        summaries.append(summarize(scenario, runs))
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        print(format_table(summaries))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import pytest
+
+from fake_igd import FakeIGD, FakeSSDPResponder
+from upnp_port_forward import client, ssdp
+
+# Long enough for loopback answers, short enough for the tests that exhaust the search
+FAKE_SSDP_SEARCH_TIMEOUT = 1
+
+
+@pytest.fixture(autouse=True)
+def clear_client_caches():
+    client.external_ip_cache.invalidate()
+    client.unusable_device_cache.invalidate()
+    yield
+    client.external_ip_cache.invalidate()
+    client.unusable_device_cache.invalidate()
+
+
+@pytest.fixture
+def fake_igd():
+    with FakeIGD() as igd:
+        yield igd
+
+
+@pytest.fixture
+def fake_ssdp(monkeypatch):
+    """
+    Send the searches of the client to a loopback SSDP responder instead of the
+    multicast group.  Devices are added to the ``igds`` of the returned responder.
+    """
+    with FakeSSDPResponder() as responder:
+
+        def search(*args, **kwargs):
+            timeout = min(
+                kwargs.get("timeout", FAKE_SSDP_SEARCH_TIMEOUT),
+                FAKE_SSDP_SEARCH_TIMEOUT,
+            )
+            kwargs.update(timeout=timeout, ssdp_address=responder.address)
+            return ssdp.search(*args, **kwargs)
+
+        monkeypatch.setattr(client, "search", search)
+        yield responder
+
+
+@pytest.fixture
+def discover(monkeypatch, fake_ssdp, fake_igd):
+    """
+    Let the client discover ``fake_igd``, and record each discovery round.
+    """
+    fake_ssdp.igds.append(fake_igd)
+    discover_calls = []
+    search = client.search
+
+    def _search(*args, **kwargs):
+        discover_calls.append(None)
+        return search(*args, **kwargs)
+
+    monkeypatch.setattr(client, "search", _search)
+    return discover_calls
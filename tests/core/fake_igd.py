@@ -0,0 +1,611 @@
+"""
+A minimal Internet Gateway Device served on loopback, for tests.
+"""
+import http.server
+import ipaddress
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from xml.etree import ElementTree
+
+NS_SOAP_ENV = "http://schemas.xmlsoap.org/soap/envelope/"
+WAN_IP_CONNECTION = "urn:schemas-upnp-org:service:WANIPConnection:1"
+WAN_IP_CONNECTION_2 = "urn:schemas-upnp-org:service:WANIPConnection:2"
+INTERNET_GATEWAY_DEVICE = "urn:schemas-upnp-org:device:InternetGatewayDevice:1"
+SSDP_SERVER = "Fake/1.0 UPnP/1.1 FakeIGD/1.0"
+
+DEVICE_DESCRIPTION = """<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>{device_type}</deviceType>
+    <friendlyName>{friendly_name}</friendlyName>
+    <manufacturer>Fake Networks</manufacturer>
+    <modelName>{model_name}</modelName>
+    <UDN>{udn}</UDN>
+    <serviceList>
+      <service>
+        <serviceType>urn:schemas-upnp-org:service:Layer3Forwarding:1</serviceType>
+        <serviceId>urn:upnp-org:serviceId:L3Forwarding1</serviceId>
+        <SCPDURL>/L3F.xml</SCPDURL>
+        <controlURL>/ctl/L3F</controlURL>
+        <eventSubURL>/evt/L3F</eventSubURL>
+      </service>
+    </serviceList>
+    <deviceList>
+      <device>
+        <deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>
+        <friendlyName>WAN Connection</friendlyName>
+        <UDN>{udn}-wan</UDN>
+        <serviceList>
+          <service>
+            <serviceType>{service_type}</serviceType>
+            <serviceId>urn:upnp-org:serviceId:{service_name}</serviceId>
+            <SCPDURL>/WANIPCn.xml</SCPDURL>
+            <controlURL>/ctl/IPConn</controlURL>
+            <eventSubURL>/evt/IPConn</eventSubURL>
+          </service>
+        </serviceList>
+      </device>
+    </deviceList>
+  </device>
+</root>
+"""
+
+STATE_VARIABLES = (
+    ("ExternalIPAddress", "string"),
+    ("RemoteHost", "string"),
+    ("ExternalPort", "ui2"),
+    ("InternalPort", "ui2"),
+    ("PortMappingProtocol", "string"),
+    ("InternalClient", "string"),
+    ("PortMappingEnabled", "boolean"),
+    ("PortMappingDescription", "string"),
+    ("PortMappingLeaseDuration", "ui4"),
+    ("PortMappingNumberOfEntries", "ui2"),
+)
+
+MAPPING_ARGUMENTS = (
+    ("NewRemoteHost", "RemoteHost"),
+    ("NewExternalPort", "ExternalPort"),
+    ("NewProtocol", "PortMappingProtocol"),
+    ("NewInternalPort", "InternalPort"),
+    ("NewInternalClient", "InternalClient"),
+    ("NewEnabled", "PortMappingEnabled"),
+    ("NewPortMappingDescription", "PortMappingDescription"),
+    ("NewLeaseDuration", "PortMappingLeaseDuration"),
+)
+
+# The arguments of the mappings added directly to FakeIGD.mappings that default to
+# an enabled and permanent entry
+MAPPING_DEFAULTS = {
+    "NewRemoteHost": "",
+    "NewEnabled": "1",
+    "NewPortMappingDescription": "",
+    "NewLeaseDuration": "0",
+}
+
+ACTIONS = {
+    "GetExternalIPAddress": ((), (("NewExternalIPAddress", "ExternalIPAddress"),)),
+    "AddPortMapping": (MAPPING_ARGUMENTS, ()),
+    "DeletePortMapping": (MAPPING_ARGUMENTS[:3], ()),
+    "GetSpecificPortMappingEntry": (MAPPING_ARGUMENTS[:3], MAPPING_ARGUMENTS[3:]),
+    "GetGenericPortMappingEntry": (
+        (("NewPortMappingIndex", "PortMappingNumberOfEntries"),),
+        MAPPING_ARGUMENTS,
+    ),
+}
+
+
+def _build_scpd() -> str:
+    actions = []
+    for action_name, (in_arguments, out_arguments) in ACTIONS.items():
+        arguments = [
+            f"<argument><name>{name}</name><direction>{direction}</direction>"
+            f"<relatedStateVariable>{state_variable}</relatedStateVariable></argument>"
+            for direction, action_arguments in (
+                ("in", in_arguments),
+                ("out", out_arguments),
+            )
+            for name, state_variable in action_arguments
+        ]
+        actions.append(
+            f"<action><name>{action_name}</name>"
+            f"<argumentList>{''.join(arguments)}</argumentList></action>"
+        )
+    state_variables = [
+        f'<stateVariable sendEvents="no"><name>{name}</name>'
+        f"<dataType>{data_type}</dataType></stateVariable>"
+        for name, data_type in STATE_VARIABLES
+    ]
+    return (
+        '<?xml version="1.0"?><scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+        f"<actionList>{''.join(actions)}</actionList>"
+        f"<serviceStateTable>{''.join(state_variables)}</serviceStateTable></scpd>"
+    )
+
+
+def _soap_envelope(body: str) -> bytes:
+    return (
+        '<?xml version="1.0"?>'
+        f'<s:Envelope xmlns:s="{NS_SOAP_ENV}" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+        f"<s:Body>{body}</s:Body></s:Envelope>"
+    ).encode()
+
+
+class FakeIGD:
+    """
+    Serves a device description, a WANIPConnection SCPD and its control URL on
+    loopback.  AddPortMapping and friends operate on an in-memory mapping table.
+
+    ``errors`` maps an action name to the ``(code, description)`` UPnP error every
+    call to that action fails with, and ``delay`` is slept before answering each
+    SOAP call.  The next ``transient_failures`` SOAP calls are answered with an
+    HTTP 503, as overwhelmed devices do.
+    """
+
+    def __init__(
+        self,
+        external_ip: str = "203.0.113.7",
+        service_name: str = "WANIPConn1",
+        service_type: str = WAN_IP_CONNECTION,
+        udn: str = "uuid:fake-igd-0001",
+        friendly_name: str = "Fake IGD",
+        model_name: str = "FakeRouter 1000",
+        device_type: str = INTERNET_GATEWAY_DEVICE,
+        delay: float = 0.0,
+    ) -> None:
+        self.external_ip = external_ip
+        self.service_name = service_name
+        self.service_type = service_type
+        self.udn = udn
+        self.friendly_name = friendly_name
+        self.model_name = model_name
+        self.device_type = device_type
+        self.delay = delay
+        self.transient_failures = 0
+        self.errors: Dict[str, Tuple[int, str]] = {}
+        self.mappings: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self.calls: List[Tuple[str, Dict[str, str]]] = []
+        self.requests: List[str] = []
+        # When each description GET and SOAP call arrived, per time.monotonic()
+        self.timeline: List[Tuple[float, str]] = []
+        # The client ends of the connections SOAP calls were made over
+        self.soap_connections: Set[Tuple[str, int]] = set()
+        self._lock = threading.Lock()
+        self._server: Optional[socketserver.TCPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        assert self._server is not None
+        return self._server.server_address[1]
+
+    @property
+    def location(self) -> str:
+        return f"http://127.0.0.1:{self.port}/rootDesc.xml"
+
+    @property
+    def control_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/ctl/IPConn"
+
+    @property
+    def search_targets(self) -> Tuple[str, ...]:
+        return ("upnp:rootdevice", self.udn, self.device_type, self.service_type)
+
+    def soap_calls(self, action_name: str) -> List[Dict[str, str]]:
+        with self._lock:
+            return [args for name, args in self.calls if name == action_name]
+
+    def start(self) -> "FakeIGD":
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "FakeIGD":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def handle_soap(
+        self, action_name: str, arguments: Dict[str, str]
+    ) -> Dict[str, str]:
+        with self._lock:
+            self.calls.append((action_name, arguments))
+            self.timeline.append((time.monotonic(), action_name))
+        if self.delay:
+            time.sleep(self.delay)
+        if action_name in self.errors:
+            raise _UPnPError(*self.errors[action_name])
+
+        with self._lock:
+            if action_name == "GetExternalIPAddress":
+                return {"NewExternalIPAddress": self.external_ip}
+            elif action_name == "AddPortMapping":
+                key = (arguments["NewExternalPort"], arguments["NewProtocol"])
+                existing = self.mappings.get(key)
+                target = (arguments["NewInternalClient"], arguments["NewInternalPort"])
+                if existing is not None and target != (
+                    existing["NewInternalClient"],
+                    existing["NewInternalPort"],
+                ):
+                    raise _UPnPError(718, "ConflictInMappingEntry")
+                self.mappings[key] = dict(arguments)
+                return {}
+            elif action_name == "AddAnyPortMapping" and self.service_type.endswith(
+                ":2"
+            ):
+                protocol = arguments["NewProtocol"]
+                external_port = int(arguments["NewExternalPort"])
+                while (str(external_port), protocol) in self.mappings:
+                    external_port += 1
+                self.mappings[(str(external_port), protocol)] = dict(
+                    arguments, NewExternalPort=str(external_port)
+                )
+                return {"NewReservedPort": str(external_port)}
+            elif action_name == "DeletePortMapping":
+                key = (arguments["NewExternalPort"], arguments["NewProtocol"])
+                if self.mappings.pop(key, None) is None:
+                    raise _UPnPError(714, "NoSuchEntryInArray")
+                return {}
+            elif action_name == "GetSpecificPortMappingEntry":
+                key = (arguments["NewExternalPort"], arguments["NewProtocol"])
+                try:
+                    mapping = self.mappings[key]
+                except KeyError:
+                    raise _UPnPError(714, "NoSuchEntryInArray")
+                return {
+                    name: mapping.get(name, MAPPING_DEFAULTS.get(name, ""))
+                    for name, _ in MAPPING_ARGUMENTS[3:]
+                }
+            elif action_name == "GetGenericPortMappingEntry":
+                index = int(arguments["NewPortMappingIndex"])
+                entries = list(self.mappings.items())
+                try:
+                    (external_port, protocol), mapping = entries[index]
+                except IndexError:
+                    raise _UPnPError(713, "SpecifiedArrayIndexInvalid")
+                entry = dict(MAPPING_DEFAULTS, **mapping)
+                entry.update(NewExternalPort=external_port, NewProtocol=protocol)
+                return entry
+            else:
+                raise _UPnPError(401, "Invalid Action")
+
+
+class _UPnPError(Exception):
+    pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients routinely give up on slow devices before they answer
+        pass
+
+
+def _make_handler(igd: FakeIGD) -> Any:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Send the headers and body of each response together
+        wbufsize = -1
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def _respond(self, status: int, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", 'text/xml; charset="utf-8"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            with igd._lock:
+                igd.requests.append(self.path)
+                igd.timeline.append((time.monotonic(), f"GET {self.path}"))
+            if self.path == "/rootDesc.xml":
+                description = DEVICE_DESCRIPTION.format(
+                    friendly_name=igd.friendly_name,
+                    model_name=igd.model_name,
+                    udn=igd.udn,
+                    device_type=igd.device_type,
+                    service_type=igd.service_type,
+                    service_name=igd.service_name,
+                )
+                self._respond(200, description.encode())
+            elif self.path == "/WANIPCn.xml":
+                self._respond(200, _build_scpd().encode())
+            else:
+                self._respond(404, b"")
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            with igd._lock:
+                igd.soap_connections.add(self.client_address)
+            if self.path != "/ctl/IPConn":
+                self._respond(404, b"")
+                return
+            with igd._lock:
+                overwhelmed = igd.transient_failures > 0
+                if overwhelmed:
+                    igd.transient_failures -= 1
+            if overwhelmed:
+                self._respond(503, b"")
+                return
+            action_name = self.headers["SOAPAction"].strip('"').split("#")[1]
+            action = ElementTree.fromstring(body).find(
+                f".//{{{igd.service_type}}}{action_name}"
+            )
+            arguments = {child.tag: child.text or "" for child in action}
+            try:
+                result = igd.handle_soap(action_name, arguments)
+            except _UPnPError as exc:
+                code, description = exc.args
+                fault = (
+                    "<s:Fault><faultcode>s:Client</faultcode>"
+                    "<faultstring>UPnPError</faultstring><detail>"
+                    '<UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+                    f"<errorCode>{code}</errorCode>"
+                    f"<errorDescription>{description}</errorDescription>"
+                    "</UPnPError></detail></s:Fault>"
+                )
+                self._respond(500, _soap_envelope(fault))
+            else:
+                outputs = "".join(
+                    f"<{name}>{value}</{name}>" for name, value in result.items()
+                )
+                self._respond(
+                    200,
+                    _soap_envelope(
+                        f'<u:{action_name}Response xmlns:u="{igd.service_type}">'
+                        f"{outputs}</u:{action_name}Response>"
+                    ),
+                )
+
+    return Handler
+
+
+class FakeSSDPResponder:
+    """
+    Answers M-SEARCH requests sent to a loopback UDP port on behalf of the given
+    devices, the same way they would answer a multicast search.
+    """
+
+    def __init__(self, *igds: FakeIGD) -> None:
+        self.igds = list(igds)
+        self.searches: List[str] = []
+        self.search_times: List[float] = []
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        assert self._sock is not None
+        return self._sock.getsockname()
+
+    def start(self) -> "FakeSSDPResponder":
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.settimeout(0.05)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        if self._sock is not None:
+            self._sock.close()
+
+    def __enter__(self) -> "FakeSSDPResponder":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def _serve(self) -> None:
+        assert self._sock is not None
+        while self._running:
+            try:
+                data, addr = self._sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            headers = dict(
+                line.split(":", 1)
+                for line in data.decode().split("\r\n")[1:]
+                if ":" in line
+            )
+            search_target = headers.get("ST", "").strip()
+            self.searches.append(search_target)
+            self.search_times.append(time.monotonic())
+            for igd in list(self.igds):
+                if search_target == "ssdp:all":
+                    targets = igd.search_targets
+                elif search_target in igd.search_targets:
+                    targets = (search_target,)
+                else:
+                    continue
+                for target in targets:
+                    usn = igd.udn if target == igd.udn else f"{igd.udn}::{target}"
+                    response = (
+                        "HTTP/1.1 200 OK\r\n"
+                        "CACHE-CONTROL: max-age=1800\r\n"
+                        "EXT:\r\n"
+                        f"LOCATION: {igd.location}\r\n"
+                        f"SERVER: {SSDP_SERVER}\r\n"
+                        f"ST: {target}\r\n"
+                        f"USN: {usn}\r\n"
+                        "\r\n"
+                    )
+                    self._sock.sendto(response.encode(), addr)
+
+
+class FakeNATGateway:
+    """
+    Answers the PCP MAP and NAT-PMP requests sent to a loopback UDP port.
+
+    With ``nat_pmp_only`` PCP requests get the NAT-PMP "unsupported version" error,
+    the ports in ``taken_ports`` can't be mapped, and a ``silent`` gateway never
+    answers.
+    """
+
+    def __init__(
+        self,
+        external_ip: str = "203.0.113.7",
+        nat_pmp_only: bool = False,
+        taken_ports: Tuple[int, ...] = (),
+        silent: bool = False,
+    ) -> None:
+        self.external_ip = external_ip
+        self.nat_pmp_only = nat_pmp_only
+        self.taken_ports = taken_ports
+        self.silent = silent
+        # (version, opcode) of each request
+        self.requests: List[Tuple[int, int]] = []
+        # (protocol, internal port) -> (external port, lifetime)
+        self.mappings: Dict[Tuple[str, int], Tuple[int, int]] = {}
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        assert self._sock is not None
+        return self._sock.getsockname()
+
+    def start(self) -> "FakeNATGateway":
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.settimeout(0.05)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        if self._sock is not None:
+            self._sock.close()
+
+    def __enter__(self) -> "FakeNATGateway":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def _serve(self) -> None:
+        assert self._sock is not None
+        while self._running:
+            try:
+                data, addr = self._sock.recvfrom(1100)
+            except socket.timeout:
+                continue
+            self.requests.append((data[0], data[1]))
+            if self.silent:
+                continue
+            if data[0] == 0:
+                response = self._handle_nat_pmp(data)
+            elif self.nat_pmp_only:
+                response = struct.pack("!BBHI", 0, 0x80 | data[1], 1, 0)
+            else:
+                response = self._handle_pcp(data)
+            self._sock.sendto(response, addr)
+
+    def _handle_pcp(self, data: bytes) -> bytes:
+        _, _, lifetime = struct.unpack_from("!BBxxI", data)
+        nonce, protocol_number, internal_port, _ = struct.unpack_from(
+            "!12sB3xHH", data, 24
+        )
+        protocol = {6: "TCP", 17: "UDP"}[protocol_number]
+        if internal_port in self.taken_ports:
+            result_code = 11  # CANNOT_PROVIDE_EXTERNAL
+        else:
+            result_code = 0
+            self.mappings[(protocol, internal_port)] = (internal_port, lifetime)
+        header = struct.pack("!BBxBII12x", 2, 0x81, result_code, lifetime, 0)
+        external_ip = ipaddress.IPv6Address(f"::ffff:{self.external_ip}").packed
+        payload = struct.pack(
+            "!12sB3xHH16s",
+            nonce,
+            protocol_number,
+            internal_port,
+            internal_port,
+            external_ip,
+        )
+        return header + payload
+
+    def _handle_nat_pmp(self, data: bytes) -> bytes:
+        opcode = data[1]
+        if opcode == 0:
+            return struct.pack(
+                "!BBHI4s", 0, 0x80, 0, 0, ipaddress.IPv4Address(self.external_ip).packed
+            )
+        internal_port, _, lifetime = struct.unpack_from("!HHI", data, 4)
+        protocol = {1: "UDP", 2: "TCP"}[opcode]
+        # Map the next port when the requested one is taken, like NAT-PMP gateways do
+        external_port = (
+            internal_port + 1 if internal_port in self.taken_ports else internal_port
+        )
+        if lifetime:
+            self.mappings[(protocol, internal_port)] = (external_port, lifetime)
+        else:
+            self.mappings.pop((protocol, internal_port), None)
+        return struct.pack(
+            "!BBHIHHI", 0, 0x80 | opcode, 0, 0, internal_port, external_port, lifetime
+        )
+
+
+class FakeNetlink:
+    """
+    Announces address and default route changes as the kernel does over rtnetlink,
+    through a datagram socket pair whose ``sock`` end is read by a NetlinkSource.
+    """
+
+    def __init__(self) -> None:
+        self._kernel_sock, self.sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM
+        )
+
+    def change_address(self, added: bool, address: str, prefix_length: int) -> None:
+        ip = ipaddress.ip_address(address)
+        family = socket.AF_INET if ip.version == 4 else socket.AF_INET6
+        payload = struct.pack("=BBBBI", family, prefix_length, 0, 0, 2)
+        payload += _netlink_attribute(2, ip.packed)  # IFA_LOCAL
+        self._send(20 if added else 21, payload)
+
+    def change_default_route(self, added: bool, gateway: str) -> None:
+        payload = struct.pack("=BBBBBBBBI", socket.AF_INET, 0, 0, 0, 254, 3, 0, 1, 0)
+        payload += _netlink_attribute(5, ipaddress.ip_address(gateway).packed)
+        self._send(24 if added else 25, payload)
+
+    def close(self) -> None:
+        self._kernel_sock.close()
+
+    def _send(self, message_type: int, payload: bytes) -> None:
+        header = struct.pack("=IHHII", 16 + len(payload), message_type, 0, 0, 0)
+        self._kernel_sock.send(header + payload)
+
+
+def _netlink_attribute(attribute_type: int, value: bytes) -> bytes:
+    attribute = struct.pack("=HH", 4 + len(value), attribute_type) + value
+    return attribute + b"\0" * (-len(attribute) % 4)
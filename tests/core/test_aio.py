@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from fake_igd import FakeIGD, FakeSSDPResponder
+from upnp_port_forward import PortMapFailed, aio
+from upnp_port_forward.ssdp import parse_ssdp_response
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def ssdp_responder(fake_igd):
+    with FakeSSDPResponder(fake_igd) as responder:
+        yield responder
+
+
+def test_parse_ssdp_response():
+    response = parse_ssdp_response(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Location: http://192.168.1.1:5000/rootDesc.xml\r\n"
+        b"ST: upnp:rootdevice\r\n"
+        b"USN: uuid:1::upnp:rootdevice\r\n"
+        b"\r\n"
+    )
+    assert response.location == "http://192.168.1.1:5000/rootDesc.xml"
+    assert response.usn == "uuid:1::upnp:rootdevice"
+    assert parse_ssdp_response(b"NOTIFY * HTTP/1.1\r\n\r\n") is None
+    assert (
+        parse_ssdp_response(b"HTTP/1.1 200 OK\r\nST: upnp:rootdevice\r\n\r\n") is None
+    )
+
+
+def test_discover(fake_igd, ssdp_responder):
+    (response,) = run(aio.discover(0.2, ssdp_address=ssdp_responder.address))
+
+    assert response.location == fake_igd.location
+    assert ssdp_responder.searches == ["upnp:rootdevice"]
+
+
+def test_fetch_device_description(fake_igd):
+    description = run(aio.fetch_device_description(fake_igd.location))
+
+    assert description.udn == fake_igd.udn
+    assert [service.name for service in description.services] == [
+        "L3Forwarding1",
+        "WANIPConn1",
+    ]
+    assert description.services[1].control_url == fake_igd.control_url
+    # Service descriptions are not needed to map a port
+    assert fake_igd.requests == ["/rootDesc.xml"]
+
+
+def test_http_request_reads_chunked_responses():
+    async def serve_and_request():
+        async def handle(reader, writer):
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n"
+            )
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await aio.http_request(f"http://127.0.0.1:{port}/")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    assert run(serve_and_request()) == (200, b"hello world")
+
+
+def test_setup_port_map(fake_igd, ssdp_responder):
+    internal_ip, external_ip = run(
+        aio.setup_port_map(
+            8000, discovery_timeout=0.2, ssdp_address=ssdp_responder.address
+        )
+    )
+
+    assert str(internal_ip) == "127.0.0.1"
+    assert str(external_ip) == fake_igd.external_ip
+    assert fake_igd.mappings[("8000", "UDP")]["NewInternalClient"] == "127.0.0.1"
+    assert ("8000", "TCP") in fake_igd.mappings
+
+
+def test_setup_port_map_ignores_conflicts(fake_igd, ssdp_responder, caplog):
+    fake_igd.mappings[("8000", "UDP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "8000",
+    }
+    caplog.set_level(logging.INFO, "upnp_port_forward")
+
+    run(
+        aio.setup_port_map(
+            8000, discovery_timeout=0.2, ssdp_address=ssdp_responder.address
+        )
+    )
+
+    assert fake_igd.mappings[("8000", "UDP")]["NewInternalClient"] == "127.0.0.2"
+    assert fake_igd.mappings[("8000", "TCP")]["NewInternalClient"] == "127.0.0.1"
+    assert "(UDP=conflict TCP=mapped)" in caplog.text
+
+
+def test_setup_port_map_skips_slow_and_failing_devices(fake_igd, ssdp_responder):
+    fake_igd.errors["AddPortMapping"] = (501, "ActionFailed")
+    with FakeIGD(delay=2, udn="uuid:slow") as slow, FakeIGD(
+        external_ip="198.51.100.1", udn="uuid:working"
+    ) as working:
+        ssdp_responder.igds.extend([slow, working])
+
+        start = time.monotonic()
+        internal_ip, external_ip = run(
+            aio.setup_port_map(
+                8000, discovery_timeout=0.2, ssdp_address=ssdp_responder.address
+            )
+        )
+
+        assert time.monotonic() - start < 1.5
+        assert str(external_ip) == "198.51.100.1"
+        assert slow.mappings == {}
+
+
+def test_setup_port_map_without_devices(ssdp_responder):
+    ssdp_responder.igds.clear()
+
+    with pytest.raises(PortMapFailed, match="No UPnP devices available"):
+        run(
+            aio.setup_port_map(
+                8000, discovery_timeout=0.1, ssdp_address=ssdp_responder.address
+            )
+        )
@@ -0,0 +1,145 @@
+import ipaddress
+import json
+
+import pytest
+
+from upnp_port_forward import cache, client
+from upnp_port_forward.cache import (
+    CachedDevice,
+    DeviceCache,
+    ExternalIPCache,
+    UnusableDeviceCache,
+    UnusableReason,
+)
+from upnp_port_forward.client import setup_port_map
+from upnp_port_forward.interfaces import LocalAddress
+
+
+@pytest.fixture
+def device_cache(tmp_path):
+    return DeviceCache(tmp_path / "devices.json")
+
+
+def _cached_device(**overrides):
+    fields = dict(
+        udn="uuid:1",
+        location="http://192.168.1.1:5000/rootDesc.xml",
+        service_name="WANIPConn1",
+        service_type="urn:schemas-upnp-org:service:WANIPConnection:1",
+        control_url="http://192.168.1.1:5000/ctl/IPConn",
+        updated_at=1000.0,
+    )
+    fields.update(overrides)
+    return CachedDevice(**fields)
+
+
+def test_device_cache_round_trip(device_cache, monkeypatch):
+    monkeypatch.setattr(client.time, "time", lambda: 1100.0)
+    older = _cached_device(udn="uuid:1", updated_at=1000.0)
+    newer = _cached_device(udn="uuid:2", updated_at=1050.0)
+    device_cache.record(older)
+    device_cache.record(newer)
+
+    assert DeviceCache(device_cache.path).entries() == (newer, older)
+
+    device_cache.invalidate("uuid:2")
+    assert device_cache.entries() == (older,)
+
+
+def test_device_cache_expires_entries(device_cache):
+    device_cache.record(_cached_device(updated_at=0.0))
+    assert device_cache.entries() == ()
+
+
+def test_device_cache_ignores_corrupt_file(device_cache):
+    device_cache.path.write_text("{not json")
+    assert device_cache.entries() == ()
+
+    device_cache.path.write_text(json.dumps({"version": 0, "devices": {}}))
+    assert device_cache.entries() == ()
+
+
+def test_setup_port_map_populates_then_uses_cache(fake_igd, discover, device_cache):
+    setup_port_map(8000, device_cache=device_cache)
+    assert len(discover) == 1
+    (cached_device,) = device_cache.entries()
+    assert cached_device.udn == fake_igd.udn
+    assert cached_device.control_url == fake_igd.control_url
+
+    description_requests = len(fake_igd.requests)
+    internal_ip, external_ip = setup_port_map(8001, device_cache=device_cache)
+
+    assert len(discover) == 1
+    assert len(fake_igd.requests) == description_requests
+    assert str(external_ip) == fake_igd.external_ip
+    assert ("8001", "TCP") in fake_igd.mappings
+
+
+def test_setup_port_map_falls_back_to_discovery(fake_igd, discover, device_cache):
+    device_cache.record(
+        _cached_device(
+            location="http://127.0.0.1:1/rootDesc.xml",
+            control_url="http://127.0.0.1:1/ctl/IPConn",
+            updated_at=9e12,
+        )
+    )
+
+    setup_port_map(8000, device_cache=device_cache)
+
+    assert len(discover) == 1
+    (cached_device,) = device_cache.entries()
+    assert cached_device.location == fake_igd.location
+
+
+def test_external_ip_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    external_ip_cache = ExternalIPCache(ttl=60)
+    external_ip_cache.record("http://a/ctl", "203.0.113.1")
+    now[0] += 10
+    external_ip_cache.record("http://b/ctl", "203.0.113.2")
+
+    assert external_ip_cache.get("http://a/ctl") == "203.0.113.1"
+    assert external_ip_cache.latest() == ("http://b/ctl", "203.0.113.2")
+
+    now[0] += 55
+    assert external_ip_cache.get("http://a/ctl") is None
+    assert external_ip_cache.latest() == ("http://b/ctl", "203.0.113.2")
+
+    external_ip_cache.invalidate("http://b/ctl")
+    assert external_ip_cache.latest() is None
+
+
+def test_unusable_device_cache_follows_interfaces_and_advertisement(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    eth0 = LocalAddress(
+        "eth0",
+        ipaddress.ip_address("192.168.1.2"),
+        ipaddress.ip_network("192.168.1.0/24"),
+    )
+    wlan0 = LocalAddress(
+        "wlan0", ipaddress.ip_address("10.0.0.2"), ipaddress.ip_network("10.0.0.0/24")
+    )
+    advertisement = ("http://192.168.1.1:5000/rootDesc.xml", "Linux UPnP/1.1")
+    unusable_device_cache = UnusableDeviceCache(ttl=60)
+
+    def record():
+        unusable_device_cache.record(
+            "uuid:a", UnusableReason.NO_WAN_SERVICE, advertisement, (eth0,)
+        )
+
+    record()
+    entry = unusable_device_cache.get("uuid:a", advertisement, (eth0,))
+    assert entry.reason is UnusableReason.NO_WAN_SERVICE
+    assert unusable_device_cache.get("uuid:a", advertisement, (eth0, wlan0)) is None
+    # Forgotten for good once the interfaces changed
+    assert unusable_device_cache.get("uuid:a", advertisement, (eth0,)) is None
+
+    record()
+    moved = ("http://192.168.1.1:5001/rootDesc.xml", "Linux UPnP/1.1")
+    assert unusable_device_cache.get("uuid:a", moved, (eth0,)) is None
+
+    record()
+    now[0] += 61
+    assert unusable_device_cache.get("uuid:a", advertisement, (eth0,)) is None
@@ -0,0 +1,503 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+import threading
+import time
+
+import pytest
+
+from conftest import FAKE_SSDP_SEARCH_TIMEOUT
+from fake_igd import SSDP_SERVER, WAN_IP_CONNECTION_2, FakeIGD
+from upnp_port_forward import (
+    PortMapFailed,
+    PortMapStatus,
+    client,
+    external_ip_cache,
+    get_external_ip,
+    get_port_mappings,
+    setup_port_map,
+    setup_port_maps,
+    unusable_device_cache,
+)
+from upnp_port_forward.cache import UnusableReason
+from upnp_port_forward.interfaces import InterfaceIndex
+from upnp_port_forward.ssdp import SSDPResponse
+
+
+@pytest.fixture
+def igds():
+    started = []
+    yield started
+    for igd in started:
+        igd.stop()
+
+
+@pytest.fixture
+def discover_igds(fake_ssdp, igds):
+    def _discover_igds(*igd_options):
+        for index, options in enumerate(igd_options):
+            options.setdefault("udn", f"uuid:fake-igd-{index}")
+            igds.append(FakeIGD(**options).start())
+        fake_ssdp.igds.extend(igds)
+        return igds
+
+    return _discover_igds
+
+
+def wait_until_unusable(igd, timeout=1):
+    """
+    :return: the reason ``igd`` is in the unusable device cache, once it is
+    """
+    advertisement = (igd.location, SSDP_SERVER)
+    local_addresses = InterfaceIndex().local_addresses
+    deadline = time.monotonic() + timeout
+    while True:
+        unusable = unusable_device_cache.get(igd.udn, advertisement, local_addresses)
+        if unusable is not None or time.monotonic() >= deadline:
+            return None if unusable is None else unusable.reason
+        time.sleep(0.01)
+
+
+class ScriptedSearch:
+    """
+    Stand-in for ``client.search`` yielding the answers of the ``first`` devices,
+    then those of the ``later`` ones once ``answer_later`` is set.
+    """
+
+    def __init__(self, first, later):
+        self.first = first
+        self.later = later
+        self.answer_later = threading.Event()
+        self.closed = threading.Event()
+
+    def __call__(self, *args, **kwargs):
+        try:
+            yield from map(_ssdp_response, self.first)
+            self.answer_later.wait(FAKE_SSDP_SEARCH_TIMEOUT)
+            yield from map(_ssdp_response, self.later)
+        finally:
+            self.closed.set()
+
+
+def _ssdp_response(igd):
+    return SSDPResponse(
+        igd.location, f"{igd.udn}::{igd.service_type}", igd.service_type, SSDP_SERVER
+    )
+
+
+@pytest.fixture
+def submit_errors(monkeypatch):
+    """
+    The errors raised when submitting probes to the executors of the client.
+    """
+    errors = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            try:
+                return super().submit(*args, **kwargs)
+            except RuntimeError as exc:
+                errors.append(exc)
+                raise
+
+    monkeypatch.setattr(client, "ThreadPoolExecutor", RecordingExecutor)
+    return errors
+
+
+@pytest.mark.parametrize("concurrent", (False, True))
+def test_setup_port_map_skips_unusable_devices(discover_igds, concurrent, caplog):
+    no_wan, failing, working = discover_igds(
+        dict(service_name="Layer3Forwarding1"), dict(), dict(external_ip="198.51.100.1")
+    )
+    failing.errors["AddPortMapping"] = (501, "ActionFailed")
+    caplog.set_level(logging.DEBUG, "upnp_port_forward")
+
+    internal_ip, external_ip = setup_port_map(8000, concurrent=concurrent)
+
+    assert str(external_ip) == "198.51.100.1"
+    assert set(working.mappings) == {("8000", "UDP"), ("8000", "TCP")}
+    if concurrent:
+        # The port may be mapped before the other probes complete
+        assert wait_until_unusable(no_wan) is UnusableReason.NO_WAN_SERVICE
+    else:
+        assert "No WAN services managed by the UPnP device" in caplog.text
+        assert "Failed to setup portmap on UPnP device" in caplog.text
+
+
+@pytest.mark.parametrize("concurrent", (False, True))
+def test_setup_port_map_remembers_unusable_devices(discover_igds, concurrent):
+    no_wan, working = discover_igds(dict(service_name="Layer3Forwarding1"), dict())
+
+    setup_port_map(8000, concurrent=concurrent)
+    assert wait_until_unusable(no_wan) is UnusableReason.NO_WAN_SERVICE
+    setup_port_map(8001, concurrent=concurrent)
+
+    assert no_wan.requests.count("/rootDesc.xml") == 1
+    assert working.requests.count("/rootDesc.xml") == 2
+
+    # Looking for other services is worth a new try
+    with pytest.raises(PortMapFailed):
+        setup_port_map(8002, required_service_names=("WANIPConn9",))
+    assert no_wan.requests.count("/rootDesc.xml") == 2
+
+
+def test_setup_port_map_concurrently_fails_when_all_devices_are_unusable(
+    discover_igds,
+):
+    discover_igds(dict(service_name="Layer3Forwarding1"))
+    failures = []
+
+    def setup_port_map_twice():
+        for port in (8000, 8001):
+            with pytest.raises(PortMapFailed, match="Tried 1 devices"):
+                setup_port_map(port, concurrent=True)
+            failures.append(port)
+
+    # The second call, which skips the device, used to wait forever
+    thread = threading.Thread(target=setup_port_map_twice, daemon=True)
+    thread.start()
+    thread.join(FAKE_SSDP_SEARCH_TIMEOUT * 5)
+
+    assert failures == [8000, 8001]
+
+
+@pytest.mark.parametrize("concurrent", (False, True))
+def test_setup_port_map_fails_when_no_device_works(discover_igds, concurrent):
+    (igd,) = discover_igds(dict())
+    igd.errors["GetExternalIPAddress"] = (501, "ActionFailed")
+
+    with pytest.raises(PortMapFailed, match="Tried 1 devices"):
+        setup_port_map(8000, concurrent=concurrent)
+
+
+def test_setup_port_map_concurrently_does_not_wait_for_slow_devices(discover_igds):
+    slow, fast = discover_igds(dict(delay=2), dict(external_ip="198.51.100.1"))
+
+    start = time.monotonic()
+    internal_ip, external_ip = setup_port_map(8000, concurrent=True)
+
+    assert time.monotonic() - start < 1
+    assert str(external_ip) == "198.51.100.1"
+    assert slow.mappings == {}
+
+
+def test_setup_port_map_concurrently_ends_the_search(igds, monkeypatch, submit_errors):
+    working = FakeIGD(udn="uuid:working").start()
+    late = FakeIGD(udn="uuid:late").start()
+    igds.extend((working, late))
+    search = ScriptedSearch([working], [late])
+    monkeypatch.setattr(client, "search", search)
+
+    setup_port_map(8000, concurrent=True)
+    search.answer_later.set()
+
+    assert search.closed.wait(1)
+    assert submit_errors == []
+    assert late.requests == []
+
+
+@pytest.mark.parametrize("skipped_after_mapping", (False, True))
+def test_setup_port_map_concurrently_skips_devices_while_searching(
+    igds, monkeypatch, submit_errors, skipped_after_mapping
+):
+    unusable = FakeIGD(udn="uuid:unusable").start()
+    working = FakeIGD(udn="uuid:working").start()
+    late = FakeIGD(udn="uuid:late").start()
+    igds.extend((unusable, working, late))
+    response = _ssdp_response(unusable)
+    unusable_device_cache.record(
+        client._device_key(response),
+        UnusableReason.INVALID_DESCRIPTION,
+        client._advertisement(response),
+        InterfaceIndex().local_addresses,
+    )
+    if skipped_after_mapping:
+        search = ScriptedSearch([working], [unusable, late])
+    else:
+        search = ScriptedSearch([unusable, working], [late])
+    monkeypatch.setattr(client, "search", search)
+
+    start = time.monotonic()
+    setup_port_map(8000, concurrent=True)
+
+    # Neither the skipped device nor the search held up the mapping
+    assert time.monotonic() - start < FAKE_SSDP_SEARCH_TIMEOUT / 2
+    search.answer_later.set()
+    assert search.closed.wait(1)
+    assert submit_errors == []
+    assert unusable.requests == []
+    assert late.requests == []
+
+
+@pytest.mark.parametrize("concurrent", (False, True))
+def test_setup_port_map_does_not_wait_for_the_search_to_end(discover_igds, concurrent):
+    discover_igds(dict())
+
+    start = time.monotonic()
+    setup_port_map(8000, concurrent=concurrent)
+
+    assert time.monotonic() - start < FAKE_SSDP_SEARCH_TIMEOUT / 2
+
+
+def test_setup_port_map_adds_protocols_concurrently(discover_igds, caplog):
+    (igd,) = discover_igds(dict(delay=0.5))
+    igd.mappings[("8000", "TCP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "8000",
+    }
+    caplog.set_level(logging.INFO, "upnp_port_forward")
+
+    start = time.monotonic()
+    setup_port_map(8000)
+
+    # One GetExternalIPAddress round trip, both lookups at once, then the UDP mapping
+    assert time.monotonic() - start < 1.9
+    assert len(igd.soap_calls("GetSpecificPortMappingEntry")) == 2
+    assert len(igd.soap_calls("AddPortMapping")) == 1
+    assert "(UDP=mapped TCP=conflict)" in caplog.text
+
+
+def test_setup_port_map_only_fetches_the_root_description(discover_igds):
+    (igd,) = discover_igds(dict())
+
+    setup_port_map(8000)
+
+    assert igd.requests == ["/rootDesc.xml"]
+
+
+def test_setup_port_map_for_some_protocols(discover_igds):
+    (igd,) = discover_igds(dict())
+
+    setup_port_map(8000, protocols=("tcp",))
+
+    assert set(igd.mappings) == {("8000", "TCP")}
+
+
+def test_setup_port_maps(discover_igds):
+    (igd,) = discover_igds(dict())
+    igd.mappings[("9000", "TCP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "9000",
+    }
+
+    results = setup_port_maps([8000, (9000, 9001, "tcp"), (9000, 9001, "UDP")])
+
+    assert [
+        (result.external_port, result.internal_port, result.protocol, result.status)
+        for result in results
+    ] == [
+        (8000, 8000, "UDP", PortMapStatus.MAPPED),
+        (8000, 8000, "TCP", PortMapStatus.MAPPED),
+        (9000, 9001, "TCP", PortMapStatus.CONFLICT),
+        (9000, 9001, "UDP", PortMapStatus.MAPPED),
+    ]
+    assert {str(result.external_ip) for result in results} == {igd.external_ip}
+    assert igd.mappings[("9000", "UDP")]["NewInternalPort"] == "9001"
+    assert len(igd.soap_calls("GetExternalIPAddress")) == 1
+
+
+def test_setup_port_maps_reconciles_existing_mappings(discover_igds):
+    (igd,) = discover_igds(dict())
+    igd.mappings.update(
+        {
+            # Ours, but expiring sooner than requested
+            ("8000", "UDP"): {
+                "NewInternalClient": "127.0.0.1",
+                "NewInternalPort": "8000",
+                "NewLeaseDuration": "60",
+            },
+            ("8000", "TCP"): {
+                "NewInternalClient": "127.0.0.2",
+                "NewInternalPort": "8000",
+                "NewPortMappingDescription": "someone else",
+            },
+            ("8001", "UDP"): {
+                "NewInternalClient": "127.0.0.1",
+                "NewInternalPort": "8001",
+            },
+        }
+    )
+
+    results = setup_port_maps([8000, 8001])
+
+    assert [result.status for result in results] == [
+        PortMapStatus.MAPPED,
+        PortMapStatus.CONFLICT,
+        PortMapStatus.EXISTING,
+        PortMapStatus.MAPPED,
+    ]
+    assert results[1].existing_entry.description == "someone else"
+    assert [
+        (args["NewExternalPort"], args["NewProtocol"])
+        for args in igd.soap_calls("AddPortMapping")
+    ] == [("8000", "UDP"), ("8001", "TCP")]
+    assert igd.mappings[("8000", "UDP")]["NewLeaseDuration"] == "1800"
+
+
+def test_setup_port_maps_picks_free_ports_from_the_mapping_table(discover_igds):
+    (igd,) = discover_igds(dict())
+    for port in ("8000", "8001", "8003"):
+        igd.mappings[(port, "TCP")] = {
+            "NewInternalClient": "127.0.0.2",
+            "NewInternalPort": port,
+        }
+
+    results = setup_port_maps(
+        [(8000, 8000, "TCP"), (8001, 8001, "TCP"), (8000, 8000, "UDP")],
+        any_external_port=True,
+    )
+
+    assert [result.status for result in results] == [PortMapStatus.MAPPED] * 3
+    # The two TCP mappings look for a free port concurrently
+    assert {results[0].external_port, results[1].external_port} == {8002, 8004}
+    assert results[2].external_port == 8000
+    moved_mapping = igd.mappings[(str(results[1].external_port), "TCP")]
+    assert moved_mapping["NewInternalPort"] == "8001"
+    # The table is listed once, then only free ports are tried
+    listed_indexes = [
+        args["NewPortMappingIndex"]
+        for args in igd.soap_calls("GetGenericPortMappingEntry")
+    ]
+    assert listed_indexes.count("0") == 1
+    assert len(igd.soap_calls("AddPortMapping")) == 3
+
+
+def test_setup_port_maps_uses_add_any_port_mapping(discover_igds):
+    (igd,) = discover_igds(dict(service_type=WAN_IP_CONNECTION_2))
+    igd.mappings[("8000", "TCP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "8000",
+    }
+
+    (result,) = setup_port_maps([(8000, 8000, "TCP")], any_external_port=True)
+
+    assert (result.external_port, result.status) == (8001, PortMapStatus.MAPPED)
+    assert igd.soap_calls("GetGenericPortMappingEntry") == []
+
+
+def test_get_port_mappings_fetches_entries_lazily(discover_igds):
+    (igd,) = discover_igds(dict())
+    for port in range(8000, 8005):
+        igd.mappings[(str(port), "TCP")] = {
+            "NewInternalClient": "127.0.0.2",
+            "NewInternalPort": str(port + 1000),
+            "NewLeaseDuration": "600",
+        }
+
+    first_entries = list(itertools.islice(get_port_mappings(), 2))
+
+    assert [(entry.external_port, entry.internal_port) for entry in first_entries] == [
+        (8000, 9000),
+        (8001, 9001),
+    ]
+    assert len(igd.soap_calls("GetGenericPortMappingEntry")) == 2
+
+    entries = list(get_port_mappings())
+
+    assert len(entries) == 5
+    assert entries[-1].protocol == "TCP"
+    assert entries[-1].lease_duration == 600
+    assert entries[-1].enabled
+
+
+def test_setup_port_maps_reuses_connections(discover_igds):
+    (igd,) = discover_igds(dict())
+
+    results = setup_port_maps(range(8000, 8010), max_concurrent_calls=1)
+
+    assert all(result.status is PortMapStatus.MAPPED for result in results)
+    assert len(igd.soap_calls("AddPortMapping")) == 20
+    assert len(igd.soap_connections) == 1
+
+
+@pytest.mark.parametrize(
+    "call",
+    (
+        lambda concurrent: setup_port_map(8000, concurrent=concurrent),
+        lambda concurrent: setup_port_maps([8000, 8001], concurrent=concurrent),
+        lambda concurrent: get_external_ip(concurrent=concurrent),
+        lambda concurrent: list(get_port_mappings(concurrent=concurrent)),
+    ),
+)
+@pytest.mark.parametrize("concurrent", (False, True))
+def test_one_shot_calls_close_their_connections(
+    discover_igds, monkeypatch, call, concurrent
+):
+    discover_igds(dict(), dict(external_ip="198.51.100.1"))
+    services = []
+
+    class RecordingSOAPService(client.SOAPService):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            services.append(self)
+
+    monkeypatch.setattr(client, "SOAPService", RecordingSOAPService)
+
+    call(concurrent)
+
+    # The services of the devices that lost the race are closed once probed
+    deadline = time.monotonic() + FAKE_SSDP_SEARCH_TIMEOUT
+    while any(service._idle_connections for service in services):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert services
+
+
+def test_setup_port_maps_moves_on_when_nothing_can_be_mapped(discover_igds):
+    failing, working = discover_igds(dict(), dict(external_ip="198.51.100.1"))
+    failing.errors["AddPortMapping"] = (501, "ActionFailed")
+
+    results = setup_port_maps([8000])
+
+    assert {str(result.external_ip) for result in results} == {"198.51.100.1"}
+    assert all(result.status is PortMapStatus.MAPPED for result in results)
+
+
+@pytest.mark.parametrize("protocols", ((), ("SCTP",), ("TCP", "SCTP")))
+def test_setup_port_map_rejects_missing_or_unknown_protocols(protocols):
+    with pytest.raises(ValueError):
+        setup_port_map(8000, protocols=protocols)
+
+
+def test_setup_port_maps_rejects_unknown_protocols():
+    with pytest.raises(ValueError, match="SCTP"):
+        setup_port_maps([(8000, 8000, "SCTP")])
+
+
+def test_external_ip_is_looked_up_once_per_device(discover_igds):
+    (igd,) = discover_igds(dict())
+
+    setup_port_map(8000)
+    setup_port_maps([8001, 8002])
+    assert str(get_external_ip()) == igd.external_ip
+
+    assert len(igd.soap_calls("GetExternalIPAddress")) == 1
+
+    igd.external_ip = "198.51.100.1"
+    external_ip_cache.invalidate()
+    assert str(get_external_ip()) == "198.51.100.1"
+    assert len(igd.soap_calls("GetExternalIPAddress")) == 2
+
+
+def test_get_external_ip_of_the_required_service(discover_igds):
+    ppp, ip = discover_igds(
+        dict(service_name="WANPPPConn1", external_ip="198.51.100.1"),
+        dict(external_ip="198.51.100.2"),
+    )
+    setup_port_map(8000, required_service_names=("WANPPPConn1",))
+    assert str(get_external_ip()) == "198.51.100.1"
+
+    external_ip = get_external_ip(required_service_names=("WANIPConn1",))
+
+    assert str(external_ip) == "198.51.100.2"
+
+
+def test_failed_mappings_invalidate_the_external_ip(discover_igds):
+    (igd,) = discover_igds(dict())
+    setup_port_map(8000)
+    igd.errors["AddPortMapping"] = (501, "ActionFailed")
+
+    with pytest.raises(PortMapFailed):
+        setup_port_map(8001)
+
+    assert external_ip_cache.get(igd.control_url) is None
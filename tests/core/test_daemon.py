@@ -0,0 +1,78 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from upnp_port_forward import PortMapFailed, PortMapStatus
+from upnp_port_forward.daemon import DaemonClient, PortMapDaemon
+
+
+@pytest.fixture
+def daemon():
+    # Unix socket paths are limited to about a hundred characters
+    with tempfile.TemporaryDirectory() as socket_dir:
+        daemon = PortMapDaemon(f"{socket_dir}/daemon.sock")
+        thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+        yield daemon
+        daemon.shutdown()
+        thread.join()
+        daemon.close()
+
+
+def test_clients_share_the_daemon_mappings(fake_igd, discover, daemon):
+    with DaemonClient(daemon.socket_path) as first_client:
+        with DaemonClient(daemon.socket_path) as second_client:
+            first_results = first_client.add([8000])
+            second_results = second_client.add([8000, (9000, 9001, "UDP")])
+            assert str(second_client.get_external_ip()) == fake_igd.external_ip
+
+        assert [result.status for result in first_results] == [PortMapStatus.MAPPED] * 2
+        assert [result.status for result in second_results] == [
+            PortMapStatus.EXISTING,
+            PortMapStatus.EXISTING,
+            PortMapStatus.MAPPED,
+        ]
+        assert len(discover) == 1
+        # Only the mapping that no other client holds is deleted
+        _wait_for_mappings(fake_igd, {("8000", "UDP"), ("8000", "TCP")})
+
+    _wait_for_mappings(fake_igd, set())
+
+
+def _wait_for_mappings(fake_igd, expected_mappings):
+    # The daemon lets go of the mappings once it sees the connection closed
+    deadline = time.monotonic() + 1
+    while set(fake_igd.mappings) != expected_mappings and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert set(fake_igd.mappings) == expected_mappings
+
+
+def test_daemon_errors_are_raised_by_the_client(fake_ssdp, daemon):
+    with DaemonClient(daemon.socket_path) as client:
+        with pytest.raises(PortMapFailed, match="No UPnP devices available"):
+            client.add([8000])
+
+
+def test_only_one_daemon_per_socket(daemon):
+    with pytest.raises(PortMapFailed):
+        PortMapDaemon(daemon.socket_path)
+
+
+def test_stale_sockets_are_replaced():
+    with tempfile.TemporaryDirectory() as socket_dir:
+        socket_path = f"{socket_dir}/daemon.sock"
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale_socket:
+            # As left behind by a daemon that is gone
+            stale_socket.bind(socket_path)
+
+        PortMapDaemon(socket_path).close()
+
+        other_path = f"{socket_dir}/not-a-socket"
+        open(other_path, "w").close()
+        with pytest.raises(PortMapFailed, match="not a socket"):
+            PortMapDaemon(other_path)
+        assert os.path.isfile(other_path)
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from upnp_port_forward import DeadlineExceeded, setup_port_map, setup_port_maps
+from upnp_port_forward.deadline import Deadline
+
+
+def test_deadline_cuts_down_the_budget_of_each_phase():
+    deadline = Deadline(0.2)
+
+    assert 0.1 < deadline.budget("discovery", 5) <= 0.2
+    assert deadline.budget("discovery", 0.05) == 0.05
+
+    time.sleep(0.2)
+    with pytest.raises(DeadlineExceeded, match="during discovery") as exc_info:
+        deadline.budget("discovery", 5)
+    assert exc_info.value.phase == "discovery"
+
+    assert Deadline().budget("discovery", 5) == 5
+
+
+def test_setup_port_map_fails_fast_on_a_hung_device(fake_igd, discover):
+    fake_igd.delay = 5
+    started_at = time.monotonic()
+
+    with pytest.raises(DeadlineExceeded) as exc_info:
+        setup_port_map(8000, timeout=0.5)
+
+    assert time.monotonic() - started_at < 1.5
+    assert exc_info.value.phase == "the GetExternalIPAddress call"
+
+
+def test_setup_port_maps_fails_when_discovery_uses_up_the_time(fake_ssdp):
+    with pytest.raises(DeadlineExceeded, match="during discovery"):
+        setup_port_maps([8000], timeout=0.3)
+
+
+def test_setup_port_map_within_the_time(fake_igd, discover):
+    setup_port_map(8000, timeout=5)
+
+    assert set(fake_igd.mappings) == {("8000", "UDP"), ("8000", "TCP")}
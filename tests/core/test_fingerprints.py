@@ -0,0 +1,85 @@
+import pytest
+
+from fake_igd import FakeIGD
+from upnp_port_forward import PortMapFailed, client, external_ip_cache, setup_port_map
+from upnp_port_forward.fingerprints import DeviceModel, FingerprintDB
+from upnp_port_forward.tools import export
+
+
+@pytest.fixture
+def fingerprint_db(tmp_path):
+    return FingerprintDB(tmp_path / "fingerprints.json")
+
+
+def test_fingerprint_db_round_trip(fingerprint_db):
+    model = DeviceModel("Fake Networks", "FakeRouter 1000", "Living room")
+    fingerprint_db.record(model, "WANIPConn1", ("GetExternalIPAddress",))
+    fingerprint_db.record(model, "WANIPConn1", ("AddPortMapping",))
+
+    fingerprint = FingerprintDB(fingerprint_db.path).lookup(model)
+    assert fingerprint.service_name == "WANIPConn1"
+    assert fingerprint.actions == ("AddPortMapping", "GetExternalIPAddress")
+
+    # The friendly name is set by the owner of the router
+    renamed = model._replace(friendly_name="Office")
+    assert fingerprint_db.lookup(renamed) == fingerprint
+    assert fingerprint_db.lookup(model._replace(model_name="Other")) is None
+
+    fingerprint_db.record(model, "WANPPPConn1", ("AddPortMapping",))
+    assert fingerprint_db.lookup(model).actions == ("AddPortMapping",)
+
+
+def test_fingerprint_db_is_not_rewritten_when_unchanged(fingerprint_db):
+    model = DeviceModel("Fake Networks", "FakeRouter 1000", "Living room")
+    fingerprint_db.record(model, "WANIPConn1", ("AddPortMapping",))
+    (recorded,) = fingerprint_db.entries()
+
+    fingerprint_db.record(model, "WANIPConn1", ("AddPortMapping",))
+
+    assert fingerprint_db.entries() == (recorded,)
+
+
+def test_fingerprint_db_ignores_corrupt_file(fingerprint_db):
+    fingerprint_db.path.write_text("{not json")
+    assert fingerprint_db.entries() == ()
+
+
+def test_setup_port_map_records_fingerprint(fake_igd, discover, fingerprint_db):
+    setup_port_map(8000, fingerprint_db=fingerprint_db)
+
+    (fingerprint,) = fingerprint_db.entries()
+    assert fingerprint.model == DeviceModel(
+        "Fake Networks", "FakeRouter 1000", "Fake IGD"
+    )
+    assert fingerprint.service_name == "WANIPConn1"
+    assert fingerprint.actions == ("AddPortMapping", "GetExternalIPAddress")
+
+
+def test_cached_external_ip_is_not_recorded_as_working(
+    fake_igd, discover, fingerprint_db
+):
+    external_ip_cache.record(fake_igd.control_url, fake_igd.external_ip)
+
+    setup_port_map(8000, fingerprint_db=fingerprint_db)
+
+    assert not fake_igd.soap_calls("GetExternalIPAddress")
+    (fingerprint,) = fingerprint_db.entries()
+    assert fingerprint.actions == ("AddPortMapping",)
+
+
+def test_exported_fingerprints_find_unknown_services(
+    monkeypatch, fake_ssdp, fingerprint_db
+):
+    monkeypatch.setattr(export, "search", client.search)
+    with FakeIGD(service_name="WANIPConnCustom") as igd:
+        fake_ssdp.igds.append(igd)
+        with pytest.raises(PortMapFailed):
+            setup_port_map(8000)
+
+        export.fetch_add_portmapping_services(fingerprint_db=fingerprint_db)
+        (fingerprint,) = fingerprint_db.entries()
+        assert fingerprint.service_name == "WANIPConnCustom"
+        assert "AddPortMapping" in fingerprint.actions
+
+        setup_port_map(8000, fingerprint_db=fingerprint_db)
+        assert ("8000", "TCP") in igd.mappings
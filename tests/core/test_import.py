@@ -1,2 +1,45 @@
+import json
+import subprocess
+import sys
+
+IMPORT_PACKAGE = """
+import json, sys
+before = set(sys.modules)
+import upnp_port_forward
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
 def test_import():
     import upnp_port_forward  # noqa: F401
+
+
+def test_import_is_lazy():
+    # In a fresh interpreter, where nothing else has imported the package already
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_PACKAGE],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    imported_modules = json.loads(output)
+
+    assert [
+        module for module in imported_modules if module.startswith("upnp_port_forward")
+    ] == ["upnp_port_forward", "upnp_port_forward.exceptions"]
+    for heavy_module in (
+        "asyncio",
+        "concurrent.futures",
+        "http.client",
+        "netifaces",
+        "xml.etree.ElementTree",
+    ):
+        assert heavy_module not in imported_modules
+
+
+def test_public_names_are_loaded_on_first_access():
+    import upnp_port_forward
+    from upnp_port_forward import client
+
+    assert upnp_port_forward.setup_port_map is client.setup_port_map
+    assert "PortMapManager" in dir(upnp_port_forward)
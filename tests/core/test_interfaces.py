@@ -0,0 +1,87 @@
+import ipaddress
+
+import netifaces
+import pytest
+
+from upnp_port_forward.interfaces import (
+    InterfaceIndex,
+    LocalAddress,
+    get_local_addresses,
+)
+
+
+@pytest.fixture
+def interface_index():
+    return InterfaceIndex(
+        [
+            LocalAddress("eth0", *_split("10.1.2.3/16")),
+            LocalAddress("eth1", *_split("10.1.200.7/22")),
+            LocalAddress("eth2", *_split("192.168.1.10/24")),
+            LocalAddress("eth3", *_split("192.168.1.11/24")),
+            LocalAddress("eth0", *_split("2001:db8::10/64")),
+            LocalAddress("eth1", *_split("2001:db8::/32")),
+        ]
+    )
+
+
+def _split(interface_address):
+    interface = ipaddress.ip_interface(interface_address)
+    return interface.ip, interface.network
+
+
+@pytest.mark.parametrize(
+    "device_address, interface",
+    (
+        ("10.1.0.1", "eth0"),
+        ("10.1.255.254", "eth0"),
+        ("10.1.201.1", "eth1"),
+        ("10.1.203.255", "eth1"),
+        ("192.168.1.1", "eth2"),
+        ("2001:db8::1", "eth0"),
+        ("2001:db8:1::1", "eth1"),
+        ("fe80::1%eth0", None),
+        ("10.2.0.1", None),
+        ("192.168.0.255", None),
+        ("1.1.1.1", None),
+    ),
+)
+def test_lookup_finds_longest_prefix_match(interface_index, device_address, interface):
+    local_address = interface_index.lookup(device_address)
+
+    if interface is None:
+        assert local_address is None
+    else:
+        assert local_address.interface == interface
+        assert ipaddress.ip_address(device_address) in local_address.network
+
+
+def test_refresh_replaces_addresses(interface_index):
+    interface_index.refresh([LocalAddress("wlan0", *_split("10.2.0.5/16"))])
+
+    assert interface_index.lookup("10.1.0.1") is None
+    assert interface_index.lookup("10.2.3.4").interface == "wlan0"
+
+
+def test_get_local_addresses_reads_netmasks(monkeypatch):
+    addresses = {
+        "eth0": {
+            netifaces.AF_INET: [{"addr": "172.16.4.2", "netmask": "255.255.252.0"}],
+            netifaces.AF_INET6: [
+                {"addr": "fe80::1%eth0", "netmask": "ffff:ffff:ffff:ffff::/64"},
+                {"addr": "2001:db8::2", "netmask": "ffff:ffff:ffff:ff00::"},
+            ],
+        },
+        "lo": {netifaces.AF_INET: [{"addr": "127.0.0.1"}]},
+    }
+    monkeypatch.setattr(netifaces, "interfaces", lambda: list(addresses))
+    monkeypatch.setattr(netifaces, "ifaddresses", addresses.__getitem__)
+
+    assert {
+        (local_address.interface, str(local_address.network))
+        for local_address in get_local_addresses()
+    } == {
+        ("eth0", "172.16.4.0/22"),
+        ("eth0", "fe80::/64"),
+        ("eth0", "2001:db8::/56"),
+        ("lo", "127.0.0.1/32"),
+    }
@@ -0,0 +1,147 @@
+import json
+import time
+
+import pytest
+
+from fake_igd import WAN_IP_CONNECTION
+from upnp_port_forward import client
+from upnp_port_forward.journal import JournalEntry, MappingJournal
+from upnp_port_forward.manager import PortMapManager
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return MappingJournal(tmp_path / "journal.jsonl")
+
+
+def _entry(external_port, protocol="TCP", internal_client="127.0.0.1", **fields):
+    return JournalEntry(
+        **dict(
+            dict(
+                location="http://192.0.2.1:5000/rootDesc.xml",
+                udn="uuid:a",
+                service_name="WANIPConn1",
+                service_type=WAN_IP_CONNECTION,
+                control_url="http://192.0.2.1:5000/ctl/IPConn",
+                external_port=external_port,
+                internal_port=external_port,
+                protocol=protocol,
+                internal_client=internal_client,
+                expires_at=time.time() + 600,
+            ),
+            **fields,
+        )
+    )
+
+
+def test_journal_replays_the_changes(journal):
+    journal.record([_entry(8000), _entry(8001), _entry(8002, expires_at=0)])
+    journal.forget([(8001, "TCP")])
+    journal.record([_entry(8003, expires_at=time.time() - 1)])
+    # A line the process crashed while writing
+    with journal.path.open("a") as journal_file:
+        journal_file.write('{"op": "add", "location": "http://19')
+
+    assert {entry.external_port for entry in journal.entries()} == {8000, 8002}
+
+    # A restarted process rewrites the journal before appending to it
+    restarted_journal = MappingJournal(journal.path)
+    restarted_journal.forget([(8000, "TCP")])
+    assert [entry.external_port for entry in restarted_journal.entries()] == [8002]
+    lines = journal.path.read_text().splitlines()
+    assert [json.loads(line).get("op") for line in lines] == [
+        None,
+        "add",
+        "add",
+        "delete",
+    ]
+
+
+def test_restarted_manager_recovers_the_mappings_without_discovery(
+    fake_igd, discover, journal
+):
+    PortMapManager(journal=journal).add([8000])
+    assert len(journal.entries()) == 2
+    client.external_ip_cache.invalidate()
+
+    manager = PortMapManager(journal=journal)
+    results = manager.recover()
+
+    assert len(discover) == 1
+    assert {(result.external_port, result.protocol) for result in results} == {
+        (8000, "UDP"),
+        (8000, "TCP"),
+    }
+    assert set(manager.mappings) == {(8000, 8000, "UDP"), (8000, 8000, "TCP")}
+
+
+def test_recovery_drops_the_mappings_that_are_not_ours_anymore(
+    fake_igd, discover, journal
+):
+    PortMapManager(journal=journal).add([8000, 9000])
+    # Taken over by another host
+    fake_igd.mappings[("8000", "TCP")]["NewInternalClient"] = "127.0.0.2"
+    # Set up when this host had another address
+    journal.record(
+        [
+            _entry(
+                7000,
+                internal_client="127.0.0.3",
+                location=fake_igd.location,
+                control_url=fake_igd.control_url,
+            )
+        ]
+    )
+    fake_igd.mappings[("7000", "TCP")] = {
+        "NewInternalClient": "127.0.0.3",
+        "NewInternalPort": "7000",
+    }
+
+    manager = PortMapManager(journal=journal)
+    manager.recover()
+
+    assert (8000, 8000, "TCP") not in manager.mappings
+    assert len(manager.mappings) == 3
+    assert ("7000", "TCP") not in fake_igd.mappings
+    assert {entry.key for entry in journal.entries()} == {
+        (8000, "UDP"),
+        (9000, "UDP"),
+        (9000, "TCP"),
+    }
+
+
+def test_recovery_leaves_the_mappings_of_other_hosts_alone(fake_igd, discover, journal):
+    # Set up when this host had another address, and taken over by a third host since
+    journal.record(
+        [
+            _entry(
+                7000,
+                internal_client="127.0.0.3",
+                location=fake_igd.location,
+                control_url=fake_igd.control_url,
+            )
+        ]
+    )
+    fake_igd.mappings[("7000", "TCP")] = {
+        "NewInternalClient": "127.0.0.4",
+        "NewInternalPort": "7000",
+    }
+
+    manager = PortMapManager(journal=journal)
+    manager.recover()
+
+    assert fake_igd.soap_calls("GetSpecificPortMappingEntry")
+    assert not fake_igd.soap_calls("DeletePortMapping")
+    assert fake_igd.mappings[("7000", "TCP")]["NewInternalClient"] == "127.0.0.4"
+    assert journal.entries() == ()
+    assert manager.mappings == ()
+
+
+def test_released_mappings_are_forgotten(fake_igd, discover, journal):
+    manager = PortMapManager(journal=journal)
+    manager.add([8000])
+    manager.remove([(8000, 8000, "UDP")])
+    assert [entry.key for entry in journal.entries()] == [(8000, "TCP")]
+
+    manager.release()
+    assert journal.entries() == ()
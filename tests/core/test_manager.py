@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+import pytest
+
+from upnp_port_forward import PortMapStatus
+from upnp_port_forward.manager import PortMapManager
+
+
+def test_renewals_reuse_the_device(fake_igd, discover):
+    manager = PortMapManager(duration=600, renew_before=60, jitter=0)
+    manager.add([8000])
+
+    assert manager.renew_due(time.monotonic()) == ()
+
+    results = manager.renew_due(time.monotonic() + 600)
+
+    assert [result.status for result in results] == [PortMapStatus.MAPPED] * 2
+    assert len(discover) == 1
+    assert len(fake_igd.soap_calls("AddPortMapping")) == 4
+    assert manager.next_renewal_at() > time.monotonic() + 500
+
+
+def test_close_renewals_are_coalesced(fake_igd, discover):
+    manager = PortMapManager(
+        duration=600, renew_before=60, jitter=0, coalesce_window=30
+    )
+    manager.add([8000])
+    time.sleep(0.05)
+    manager.add([(9000, 9000, "UDP")])
+    first_renewal_at = manager.next_renewal_at()
+
+    results = manager.renew_due(first_renewal_at)
+
+    assert {result.external_port for result in results} == {8000, 9000}
+
+
+def test_renewals_rediscover_when_the_device_stops_working(fake_igd, discover):
+    manager = PortMapManager(duration=600)
+    manager.add([8000])
+    fake_igd.errors["GetExternalIPAddress"] = (501, "ActionFailed")
+    fake_igd.errors["AddPortMapping"] = (501, "ActionFailed")
+
+    renewal_time = time.monotonic() + 600
+    manager.renew_due(renewal_time)
+
+    assert len(discover) == 2
+    assert manager.next_renewal_at() == renewal_time + manager.retry_delay
+
+
+def test_conflicting_mappings_are_not_kept(fake_igd, discover):
+    fake_igd.mappings[("8000", "TCP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "8000",
+    }
+    manager = PortMapManager()
+
+    manager.add([8000])
+
+    assert manager.mappings == ((8000, 8000, "UDP"),)
+
+
+def test_permanent_mappings_are_not_managed(fake_igd, discover):
+    fake_igd.mappings[("8000", "UDP")] = {
+        "NewInternalClient": "127.0.0.1",
+        "NewInternalPort": "8000",
+    }
+    manager = PortMapManager()
+
+    results = manager.add([8000])
+
+    assert [result.status for result in results] == [
+        PortMapStatus.EXISTING,
+        PortMapStatus.MAPPED,
+    ]
+    assert manager.mappings == ((8000, 8000, "TCP"),)
+
+
+def test_permanent_leases_are_rejected():
+    with pytest.raises(ValueError):
+        PortMapManager(duration=0)
+
+
+def test_external_ports_are_mapped_to_one_internal_port(fake_igd, discover):
+    manager = PortMapManager()
+    manager.add([(8000, 8000, "TCP")])
+
+    with pytest.raises(ValueError):
+        manager.add([(8000, 9000, "TCP")])
+    with pytest.raises(ValueError):
+        manager.add([(8001, 8001, "TCP"), (8001, 9001, "TCP")])
+
+    assert manager.mappings == ((8000, 8000, "TCP"),)
+    manager.remove([(8000, 9000, "TCP")])
+    assert manager.mappings == ((8000, 8000, "TCP"),)
+    assert fake_igd.mappings[("8000", "TCP")]["NewInternalPort"] == "8000"
+
+
+def test_stop_deletes_mappings(fake_igd, discover):
+    manager = PortMapManager()
+    manager.start()
+    manager.add([8000, 8001])
+    manager.remove([8001])
+
+    assert set(fake_igd.mappings) == {("8000", "UDP"), ("8000", "TCP")}
+
+    manager.stop(delete_mappings=True)
+
+    assert fake_igd.mappings == {}
+    assert manager.mappings == ()
+
+
+def test_thread_backend_renews_mappings(fake_igd, discover):
+    manager = PortMapManager(duration=2, renew_before=1.9, jitter=0, coalesce_window=0)
+    manager.start()
+    try:
+        manager.add([8000])
+        time.sleep(1.5)
+    finally:
+        manager.stop()
+
+    assert len(fake_igd.soap_calls("AddPortMapping")) >= 4
+    assert len(discover) == 1
+
+
+def test_asyncio_backend_renews_mappings(fake_igd, discover):
+    manager = PortMapManager(duration=2, renew_before=1.9, jitter=0, coalesce_window=0)
+    manager.add([8000])
+
+    async def run_briefly():
+        task = asyncio.ensure_future(manager.run())
+        await asyncio.sleep(1.5)
+        task.cancel()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_briefly())
+    finally:
+        loop.close()
+
+    assert len(fake_igd.soap_calls("AddPortMapping")) >= 4
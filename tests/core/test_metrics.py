@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import pytest
+
+from upnp_port_forward import metrics, setup_port_map
+from upnp_port_forward.metrics import Phase, PhaseTiming, PrometheusMetrics
+
+
+@pytest.fixture
+def prometheus_metrics():
+    observer = PrometheusMetrics()
+    metrics.add_observer(observer)
+    yield observer
+    metrics.remove_observer(observer)
+
+
+def test_setup_port_map_phases(fake_igd, discover, prometheus_metrics):
+    fake_igd.mappings[("8000", "TCP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "8000",
+    }
+    # Without looking up the existing entries, the conflict is only found when adding
+    fake_igd.errors["GetSpecificPortMappingEntry"] = (401, "Invalid Action")
+    timings = []
+    metrics.add_observer(timings.append)
+    try:
+        setup_port_map(8000)
+    finally:
+        metrics.remove_observer(timings.append)
+
+    assert [timing.phase for timing in timings[:4]] == [
+        Phase.DISCOVERY,
+        Phase.INTERNAL_ADDRESS,
+        Phase.DESCRIPTION,
+        Phase.EXTERNAL_IP,
+    ]
+    assert {timing.location for timing in timings[1:]} == {fake_igd.location}
+
+    rendered = prometheus_metrics.render()
+    assert 'upnp_port_forward_phase_total{phase="discovery",outcome="ok"} 1' in rendered
+    assert (
+        'upnp_port_forward_phase_total{phase="add_port_mapping",outcome="ok"} 1'
+        in rendered
+    )
+    assert (
+        "upnp_port_forward_device_errors_total"
+        f'{{location="{fake_igd.location}",phase="add_port_mapping",'
+        'error="SOAPError:718"} 1'
+    ) in rendered
+
+
+def test_prometheus_histogram():
+    observer = PrometheusMetrics(buckets=(0.3, 1.0))
+    for duration in (0.25, 0.5, 4.0):
+        observer(PhaseTiming(Phase.EXTERNAL_IP, duration, "ok", "http://a/"))
+    observer(PhaseTiming(Phase.EXTERNAL_IP, 0.25, "SOAPProtocolError", "http://a/"))
+
+    rendered = observer.render()
+
+    assert (
+        "\n".join(
+            (
+                'upnp_port_forward_phase_duration_seconds_bucket{phase="external_ip",le="0.3"} 2',
+                'upnp_port_forward_phase_duration_seconds_bucket{phase="external_ip",le="1.0"} 3',
+                'upnp_port_forward_phase_duration_seconds_bucket{phase="external_ip",le="+Inf"} 4',
+                'upnp_port_forward_phase_duration_seconds_sum{phase="external_ip"} 5.0',
+                'upnp_port_forward_phase_duration_seconds_count{phase="external_ip"} 4',
+            )
+        )
+        in rendered
+    )
+    assert (
+        'upnp_port_forward_phase_total{phase="external_ip",outcome="SOAPProtocolError"} 1'
+        in rendered
+    )
+
+
+def test_phases_are_not_timed_without_observers(monkeypatch):
+    def fail():
+        raise AssertionError("timed without observers")
+
+    monkeypatch.setattr(metrics, "time", SimpleNamespace(monotonic=fail))
+
+    with metrics.measure(Phase.DESCRIPTION, "http://a/"):
+        pass
+    metrics.record_phase(Phase.DISCOVERY, 1.0, "ok")
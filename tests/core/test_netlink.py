@@ -0,0 +1,127 @@
+import ipaddress
+import threading
+
+import pytest
+
+from fake_igd import FakeIGD, FakeNetlink
+from upnp_port_forward import PortMapStatus
+from upnp_port_forward.interfaces import LocalAddress
+from upnp_port_forward.manager import PortMapManager
+from upnp_port_forward.netlink import NetlinkSource, NetworkChange, NetworkWatcher
+
+
+@pytest.fixture
+def fake_netlink():
+    netlink = FakeNetlink()
+    yield netlink
+    netlink.close()
+
+
+def _loopback(address):
+    return LocalAddress(
+        "lo", ipaddress.ip_address(address), ipaddress.ip_network("127.0.0.0/8")
+    )
+
+
+def test_netlink_source_parses_changes(fake_netlink):
+    source = NetlinkSource(fake_netlink.sock)
+    fake_netlink.change_address(True, "192.168.1.20", 24)
+    fake_netlink.change_address(False, "fe80::1", 64)
+    fake_netlink.change_default_route(True, "192.168.1.1")
+
+    assert source.receive(1) == (NetworkChange("address", True, "192.168.1.20"),)
+    assert source.receive(1) == (NetworkChange("address", False, "fe80::1"),)
+    assert source.receive(1) == (NetworkChange("route", True, "192.168.1.1"),)
+    assert source.receive(0.01) == ()
+    source.close()
+
+
+def test_new_internal_address_remaps_on_the_same_device(fake_igd, discover):
+    manager = PortMapManager()
+    manager.add([8000])
+    add_calls = len(fake_igd.soap_calls("AddPortMapping"))
+
+    # Nothing changed for the device
+    assert manager.handle_network_change([_loopback("127.0.0.1")]) == ()
+    assert len(fake_igd.soap_calls("AddPortMapping")) == add_calls
+
+    results = manager.handle_network_change([_loopback("127.0.0.2")])
+
+    assert {str(result.internal_ip) for result in results} == {"127.0.0.2"}
+    assert len(fake_igd.soap_calls("DeletePortMapping")) == 2
+    assert {mapping["NewInternalClient"] for mapping in fake_igd.mappings.values()} == {
+        "127.0.0.2"
+    }
+    assert len(discover) == 1
+    assert len(manager.mappings) == 2
+
+
+def test_lost_device_is_rediscovered(fake_igd, discover):
+    manager = PortMapManager()
+    manager.add([8000])
+    other_network = LocalAddress(
+        "eth0",
+        ipaddress.ip_address("192.0.2.10"),
+        ipaddress.ip_network("192.0.2.0/24"),
+    )
+
+    results = manager.handle_network_change([other_network])
+
+    # The device is not on the given network, only discovery can find it again, with
+    # the mappings still in place for this host
+    assert len(discover) == 2
+    assert [result.status for result in results] == [PortMapStatus.EXISTING] * 2
+    assert len(manager.mappings) == 2
+
+
+def test_new_default_route_remaps_on_the_router_now_in_use(
+    fake_igd, fake_ssdp, discover
+):
+    manager = PortMapManager()
+    manager.add([8000])
+    local_addresses = [_loopback("127.0.0.1")]
+
+    # The device still answers through the new route
+    get_calls = len(fake_igd.soap_calls("GetExternalIPAddress"))
+    assert manager.handle_network_change(local_addresses, route_changed=True) == ()
+    assert len(fake_igd.soap_calls("GetExternalIPAddress")) == get_calls + 1
+
+    with FakeIGD(udn="uuid:new-router", external_ip="198.51.100.1") as new_router:
+        # Another router took over, on the same network
+        fake_igd.errors["GetExternalIPAddress"] = (501, "ActionFailed")
+        fake_ssdp.igds[:] = [new_router]
+
+        # The addresses of this host didn't change
+        assert manager.handle_network_change(local_addresses) == ()
+        results = manager.handle_network_change(local_addresses, route_changed=True)
+
+        assert {str(result.external_ip) for result in results} == {"198.51.100.1"}
+        assert set(new_router.mappings) == {("8000", "UDP"), ("8000", "TCP")}
+        assert len(manager.mappings) == 2
+        manager.release()
+
+
+@pytest.mark.parametrize("route_changed", (False, True))
+def test_watcher_handles_a_burst_of_changes_once(fake_netlink, route_changed):
+    handled = threading.Event()
+    calls = []
+
+    class Manager:
+        def handle_network_change(self, route_changed=False):
+            calls.append(route_changed)
+            handled.set()
+
+    watcher = NetworkWatcher(
+        Manager(), NetlinkSource(fake_netlink.sock), settle_delay=0.2
+    )
+    watcher.start()
+    try:
+        fake_netlink.change_address(False, "192.168.1.20", 24)
+        fake_netlink.change_address(True, "10.0.0.20", 24)
+        if route_changed:
+            fake_netlink.change_default_route(True, "10.0.0.1")
+        assert handled.wait(5)
+    finally:
+        watcher.stop()
+
+    assert calls == [route_changed]
@@ -0,0 +1,83 @@
+import functools
+import ipaddress
+import time
+
+import pytest
+
+from fake_igd import FakeNATGateway
+from upnp_port_forward import PortMapFailed, client, setup_port_map
+from upnp_port_forward.pcp import map_port_on_gateway
+
+
+@pytest.fixture
+def gateway_options():
+    return {}
+
+
+@pytest.fixture
+def fake_gateway(monkeypatch, gateway_options):
+    with FakeNATGateway(**gateway_options) as gateway:
+        monkeypatch.setattr(
+            client,
+            "map_port_on_gateway",
+            functools.partial(map_port_on_gateway, gateway_address=gateway.address),
+        )
+        yield gateway
+
+
+def _no_search(*args, **kwargs):
+    raise AssertionError("UPnP devices were searched")
+
+
+def test_setup_port_map_with_pcp(fake_gateway, monkeypatch):
+    monkeypatch.setattr(client, "search", _no_search)
+
+    internal_ip, external_ip = setup_port_map(8000, duration=600, try_pcp=True)
+
+    assert internal_ip == ipaddress.ip_address("127.0.0.1")
+    assert external_ip == ipaddress.ip_address(fake_gateway.external_ip)
+    assert fake_gateway.mappings == {
+        ("UDP", 8000): (8000, 600),
+        ("TCP", 8000): (8000, 600),
+    }
+    assert {version for version, _ in fake_gateway.requests} == {2}
+
+
+@pytest.mark.parametrize("gateway_options", ({"nat_pmp_only": True},))
+def test_setup_port_map_with_nat_pmp(fake_gateway, monkeypatch):
+    monkeypatch.setattr(client, "search", _no_search)
+
+    _, external_ip = setup_port_map(8000, duration=600, try_pcp=True)
+
+    assert external_ip == ipaddress.ip_address(fake_gateway.external_ip)
+    assert fake_gateway.mappings == {
+        ("UDP", 8000): (8000, 600),
+        ("TCP", 8000): (8000, 600),
+    }
+
+
+@pytest.mark.parametrize(
+    "gateway_options",
+    ({"taken_ports": (8000,)}, {"taken_ports": (8000,), "nat_pmp_only": True}),
+)
+def test_taken_ports_are_not_mapped(fake_gateway):
+    with pytest.raises(PortMapFailed):
+        map_port_on_gateway(8000, 600, ("UDP",), gateway_address=fake_gateway.address)
+
+    # NAT-PMP gateways map another port instead, which is given back
+    deadline = time.monotonic() + 1
+    while fake_gateway.mappings and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert fake_gateway.mappings == {}
+
+
+@pytest.mark.parametrize("gateway_options", ({"silent": True},))
+def test_setup_port_map_falls_back_to_upnp(fake_gateway, fake_igd, discover):
+    start = time.monotonic()
+    internal_ip, _ = setup_port_map(8000, try_pcp=True, pcp_timeout=0.3)
+
+    assert time.monotonic() - start >= 0.3
+    assert len(discover) == 1
+    assert ("8000", "TCP") in fake_igd.mappings
+    # The requests were sent again while waiting for an answer
+    assert len(fake_gateway.requests) > 2
@@ -0,0 +1,150 @@
+import signal
+import threading
+import time
+
+import pytest
+
+from upnp_port_forward import (
+    PortMapManager,
+    PortMapStatus,
+    install_release_handlers,
+    map_ports,
+    release,
+    release_all,
+)
+
+
+@pytest.fixture(autouse=True)
+def release_leftovers():
+    yield
+    release_all(timeout=0)
+
+
+def test_handle_deletes_added_mappings(fake_igd, discover):
+    fake_igd.mappings[("8001", "UDP")] = {
+        "NewInternalClient": "127.0.0.2",
+        "NewInternalPort": "8001",
+    }
+
+    with map_ports([8000, (8001, 8001, "UDP")]) as handle:
+        assert [result.status for result in handle.results] == [
+            PortMapStatus.MAPPED,
+            PortMapStatus.MAPPED,
+            PortMapStatus.CONFLICT,
+        ]
+        assert len(fake_igd.mappings) == 3
+
+    assert handle.released
+    # The entry of the other host is left alone
+    assert list(fake_igd.mappings) == [("8001", "UDP")]
+
+
+def test_release_all_deletes_concurrently(fake_igd, discover):
+    map_ports([8000, 8001])
+    manager = PortMapManager()
+    manager.add([8002, 8003])
+    fake_igd.delay = 0.2
+
+    start = time.monotonic()
+    assert release_all() == ()
+
+    # 8 deletions, all at once
+    assert time.monotonic() - start < 0.6
+    assert fake_igd.mappings == {}
+    assert manager.mappings == ()
+
+
+def test_release_all_gives_up_at_the_deadline(fake_igd, discover):
+    handle = map_ports([8000])
+    fake_igd.delay = 1
+
+    start = time.monotonic()
+    left = release_all(timeout=0.2)
+
+    assert time.monotonic() - start < 0.5
+    assert {mapping.protocol for mapping in left} == {"UDP", "TCP"}
+    assert handle.released
+
+
+def test_deletions_finishing_late_dont_pool_connections(fake_igd, discover):
+    map_ports([8000])
+    fake_igd.delay = 0.3
+
+    left = release_all(timeout=0.1)
+
+    for thread in threading.enumerate():
+        if thread.name == "upnp-port-forward-release":
+            thread.join()
+    assert fake_igd.mappings == {}
+    assert not any(mapping.wan_service._idle_connections for mapping in left)
+
+
+def test_release_all_doesnt_wait_for_renewals(fake_igd, discover):
+    manager = PortMapManager(duration=600)
+    manager.add([8000])
+    fake_igd.delay = 1
+    renewal = threading.Thread(target=manager.renew_due, args=(time.monotonic() + 600,))
+    renewal.start()
+    time.sleep(0.1)
+
+    start = time.monotonic()
+    release_all(timeout=0.2)
+
+    assert time.monotonic() - start < 0.5
+    fake_igd.delay = 0
+    renewal.join()
+    # Renewed while being released, and deleted then
+    assert fake_igd.mappings == {}
+    assert manager.mappings == ()
+
+
+def test_signal_handler_releases_then_chains(fake_igd, discover, monkeypatch):
+    registered = []
+    monkeypatch.setattr(release, "_handlers_installed", False)
+    monkeypatch.setattr(
+        release.atexit, "register", lambda *args: registered.append(args)
+    )
+    received = []
+    previous_handler = signal.signal(
+        signal.SIGTERM, lambda signum, frame: received.append(signum)
+    )
+    try:
+        install_release_handlers(timeout=1)
+        handle = map_ports([8000])
+
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+    assert handle.released
+    assert fake_igd.mappings == {}
+    assert received == [signal.SIGTERM]
+    assert registered == [(release_all, 1)]
+
+
+def test_signal_handler_doesnt_wait_for_the_interrupted_thread(
+    fake_igd, discover, monkeypatch
+):
+    monkeypatch.setattr(release, "_handlers_installed", False)
+    monkeypatch.setattr(release.atexit, "register", lambda *args: None)
+    received = []
+    previous_handler = signal.signal(
+        signal.SIGTERM, lambda signum, frame: received.append(signum)
+    )
+    try:
+        install_release_handlers(timeout=0.2)
+        handle = map_ports([8000])
+
+        # As if the signal arrived while the main thread held the lock
+        with release._owners_lock:
+            start = time.monotonic()
+            signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+            assert time.monotonic() - start < 0.5
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+    assert received == [signal.SIGTERM]
+    deadline = time.monotonic() + 1
+    while not handle.released and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert handle.released
@@ -0,0 +1,41 @@
+import time
+
+from fake_igd import FakeIGD, FakeSSDPResponder
+from upnp_port_forward.ssdp import WAN_CONNECTION_SEARCH_TARGETS, search
+
+
+def test_search_deduplicates_answers(fake_igd):
+    with FakeIGD(udn="uuid:other-igd") as other_igd, FakeSSDPResponder(
+        fake_igd, other_igd
+    ) as responder:
+        responses = list(
+            search(
+                WAN_CONNECTION_SEARCH_TARGETS + ("upnp:rootdevice",),
+                timeout=0.2,
+                ssdp_address=responder.address,
+            )
+        )
+
+        assert sorted(response.location for response in responses) == sorted(
+            (fake_igd.location, other_igd.location)
+        )
+    assert responder.searches == list(WAN_CONNECTION_SEARCH_TARGETS) + [
+        "upnp:rootdevice"
+    ]
+
+
+def test_search_can_stop_at_the_first_answer(fake_igd):
+    with FakeSSDPResponder(fake_igd) as responder:
+        start = time.monotonic()
+        response = next(search(timeout=5, ssdp_address=responder.address))
+
+    assert time.monotonic() - start < 1
+    assert response.location == fake_igd.location
+    assert response.usn == f"{fake_igd.udn}::{fake_igd.service_type}"
+
+
+def test_search_ignores_other_devices():
+    with FakeIGD(
+        service_type="urn:schemas-upnp-org:service:ContentDirectory:1"
+    ) as media_server, FakeSSDPResponder(media_server) as responder:
+        assert list(search(timeout=0.2, ssdp_address=responder.address)) == []
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+from upnp_port_forward import DeadlineExceeded
+from upnp_port_forward.deadline import Deadline
+from upnp_port_forward.soap import SOAPService, SOAPTransientError
+from upnp_port_forward.throttle import DeviceThrottle
+
+
+def _wan_service(fake_igd, **options):
+    return SOAPService(
+        fake_igd.control_url, fake_igd.service_type, fake_igd.service_name, **options
+    )
+
+
+def test_throttle_limit_adapts_to_the_device():
+    throttle = DeviceThrottle(initial_concurrency=4, max_concurrency=5)
+
+    throttle.acquire()
+    throttle.release(0.01, transient_failure=True)
+    assert throttle.limit == 2
+
+    for _ in range(2):
+        throttle.acquire()
+        throttle.release(0.01)
+    assert throttle.limit == 3
+
+    throttle.acquire()
+    throttle.release(throttle.slow_call_duration + 1)
+    assert throttle.limit == 1
+
+    for _ in range(20):
+        throttle.acquire()
+        throttle.release(0.01)
+    assert throttle.limit == 5
+
+
+def test_waiting_for_the_throttle_is_cut_short_by_the_deadline():
+    throttle = DeviceThrottle(initial_concurrency=1)
+    throttle.acquire()
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded) as exc_info:
+        throttle.acquire(Deadline(0.1), "the AddPortMapping call")
+
+    assert time.monotonic() - start < 0.5
+    assert exc_info.value.phase == "the AddPortMapping call"
+
+
+def test_transient_failures_are_retried(fake_igd):
+    fake_igd.transient_failures = 2
+    wan_service = _wan_service(fake_igd)
+
+    external_ip = wan_service.GetExternalIPAddress()["NewExternalIPAddress"]
+
+    assert external_ip == fake_igd.external_ip
+    assert fake_igd.transient_failures == 0
+
+
+def test_retries_are_bounded(fake_igd):
+    fake_igd.transient_failures = 3
+    wan_service = _wan_service(fake_igd, retries=2)
+
+    with pytest.raises(SOAPTransientError):
+        wan_service.GetExternalIPAddress()
+    assert fake_igd.transient_failures == 0
+
+
+def test_calls_in_flight_are_capped(fake_igd):
+    fake_igd.delay = 0.1
+    wan_service = _wan_service(
+        fake_igd, throttle=DeviceThrottle(initial_concurrency=1, max_concurrency=1)
+    )
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        for _ in range(3):
+            executor.submit(wan_service.GetExternalIPAddress)
+
+    assert time.monotonic() - start >= 0.3
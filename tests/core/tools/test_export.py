@@ -1,7 +1,12 @@
+import json
 import logging
+import time
 
 import pytest
 
+from fake_igd import FakeIGD
+from upnp_port_forward import client, interfaces
+from upnp_port_forward.tools import export
 from upnp_port_forward.tools.export import UPnPServiceNames, output_upnp_service_names
 
 
@@ -33,3 +38,70 @@ def test_output_upnp_service_names(upnp_service_names, caplog):
     caplog.set_level(logging.INFO)
     output_upnp_service_names(upnp_service_names)
     assert expected_output in caplog.text
+
+
+def test_only_wan_service_descriptions_are_fetched(monkeypatch, fake_ssdp, fake_igd):
+    monkeypatch.setattr(export, "search", client.search)
+    fake_ssdp.igds.append(fake_igd)
+
+    (service_names,) = export.fetch_add_portmapping_services()
+
+    assert service_names.device_location == fake_igd.location
+    assert service_names.service_names == ("WANIPConn1",)
+    # The SCPD of the Layer3Forwarding service is never fetched
+    assert fake_igd.requests == ["/rootDesc.xml", "/WANIPCn.xml"]
+
+
+def test_local_addresses_are_listed_once_per_scan(monkeypatch, fake_ssdp, fake_igd):
+    monkeypatch.setattr(export, "search", client.search)
+    listed = []
+    get_local_addresses = interfaces.get_local_addresses
+
+    def counting_get_local_addresses():
+        listed.append(None)
+        return get_local_addresses()
+
+    monkeypatch.setattr(interfaces, "get_local_addresses", counting_get_local_addresses)
+    with FakeIGD(udn="uuid:other-igd") as other_igd:
+        fake_ssdp.igds.extend([fake_igd, other_igd])
+
+        assert len(export.fetch_add_portmapping_services()) == 2
+    assert len(listed) == 1
+
+
+@pytest.fixture
+def exported_igd(monkeypatch, fake_ssdp, fake_igd):
+    monkeypatch.setattr(export, "search", client.search)
+    fake_ssdp.igds.append(fake_igd)
+    return fake_igd
+
+
+def test_results_are_streamed_before_the_search_ends(exported_igd):
+    start = time.monotonic()
+    results = export.iter_add_portmapping_services()
+
+    service_names = next(results)
+
+    # The fake search lasts for a second
+    assert time.monotonic() - start < 0.5
+    assert service_names.device_location == exported_igd.location
+    assert list(results) == []
+
+
+def test_main_prints_json_lines(exported_igd, capsys):
+    export.main(["--json"])
+
+    (line,) = capsys.readouterr().out.splitlines()
+    assert json.loads(line) == {
+        "device_friendly_name": "Fake IGD",
+        "device_location": exported_igd.location,
+        "service_names": ["WANIPConn1"],
+    }
+
+
+def test_timeout_bounds_the_scan(exported_igd, capsys):
+    start = time.monotonic()
+    export.main(["--json", "--timeout", "0.3"])
+
+    assert time.monotonic() - start < 0.8
+    assert len(capsys.readouterr().out.splitlines()) == 1
@@ -1,2 +1,87 @@
-from .client import setup_port_map  # noqa: F401
-from .exceptions import NoPortMapServiceFound, PortMapFailed  # noqa: F401
+"""
+The public API is loaded lazily: importing the package only imports the exceptions,
+and the modules doing the discovery and the mappings are imported on first access
+to one of their names, so that processes which never map a port don't pay for them.
+"""
+import importlib
+import sys
+import types
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from .exceptions import (  # noqa: F401
+    DeadlineExceeded,
+    NoPortMapServiceFound,
+    PortMapFailed,
+)
+
+if TYPE_CHECKING:
+    from .cache import (  # noqa: F401
+        DeviceCache,
+        ExternalIPCache,
+        UnusableDeviceCache,
+    )
+    from .client import (  # noqa: F401
+        PortMapResult,
+        PortMapStatus,
+        external_ip_cache,
+        get_external_ip,
+        get_port_mappings,
+        setup_port_map,
+        setup_port_maps,
+        unusable_device_cache,
+    )
+    from .fingerprints import DeviceModel, Fingerprint, FingerprintDB  # noqa: F401
+    from .journal import MappingJournal  # noqa: F401
+    from .manager import PortMapManager  # noqa: F401
+    from .mappings import PortMappingEntry  # noqa: F401
+    from .release import (  # noqa: F401
+        PortMapHandle,
+        install_release_handlers,
+        map_ports,
+        release_all,
+    )
+
+# The module defining each of the lazily loaded names
+_LAZY_NAMES: Dict[str, str] = {
+    "DeviceCache": ".cache",
+    "ExternalIPCache": ".cache",
+    "UnusableDeviceCache": ".cache",
+    "PortMapResult": ".client",
+    "PortMapStatus": ".client",
+    "external_ip_cache": ".client",
+    "get_external_ip": ".client",
+    "get_port_mappings": ".client",
+    "setup_port_map": ".client",
+    "setup_port_maps": ".client",
+    "unusable_device_cache": ".client",
+    "DeviceModel": ".fingerprints",
+    "Fingerprint": ".fingerprints",
+    "FingerprintDB": ".fingerprints",
+    "MappingJournal": ".journal",
+    "PortMapManager": ".manager",
+    "PortMappingEntry": ".mappings",
+    "PortMapHandle": ".release",
+    "install_release_handlers": ".release",
+    "map_ports": ".release",
+    "release_all": ".release",
+}
+
+
+class _LazyModule(types.ModuleType):
+    # A module __getattr__ function would only work from Python 3.7
+    def __getattr__(self, name: str) -> Any:
+        try:
+            module_name = _LAZY_NAMES[name]
+        except KeyError:
+            raise AttributeError(
+                f"module {__name__!r} has no attribute {name!r}"
+            ) from None
+        value = getattr(importlib.import_module(module_name, __name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self) -> List[str]:
+        return sorted(set(super().__dir__()) | set(_LAZY_NAMES))
+
+
+sys.modules[__name__].__class__ = _LazyModule
@@ -0,0 +1,469 @@
+"""
+asyncio counterpart of :func:`upnp_port_forward.setup_port_map`.
+
+Discovery, description fetches and SOAP calls all run on the event loop, with a
+datagram endpoint for SSDP and a minimal HTTP client, so no thread is blocked
+while waiting for the network.
+"""
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from .client import (
+    DEFAULT_PORTMAP_DURATION,
+    SUPPORTED_PROTOCOLS,
+    PortMapStatus,
+    _existing_mapping_status,
+    _find_internal_ip_on_device_network,
+    _find_wan_service,
+    _is_mapping_conflict,
+    _log_device_failures,
+    _normalize_protocols,
+    external_ip_cache,
+)
+from .description import (
+    DEFAULT_HTTP_TIMEOUT,
+    DeviceDescription,
+    parse_device_description,
+)
+from .exceptions import PortMapFailed
+from .interfaces import InterfaceIndex
+from .mappings import (
+    NO_SUCH_ENTRY,
+    PortMappingEntry,
+    parse_specific_port_mapping_entry,
+    specific_port_mapping_entry_arguments,
+)
+from .metrics import OUTCOME_NO_DEVICES, OUTCOME_OK, Phase, measure, record_phase
+from .soap import (
+    DEFAULT_SOAP_TIMEOUT,
+    SOAPError,
+    SOAPProtocolError,
+    build_soap_request,
+    parse_soap_fault,
+    parse_soap_response,
+)
+from .ssdp import (
+    DEFAULT_DISCOVERY_TIMEOUT,
+    ROOT_DEVICE_SEARCH_TARGET,
+    SSDP_MULTICAST_ADDRESS,
+    SSDP_MULTICAST_TTL,
+    SSDPResponse,
+    build_msearch,
+    parse_ssdp_response,
+)
+from .typing import AnyIPAddress
+
+logger = logging.getLogger("upnp_port_forward")
+
+
+class _SSDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self) -> None:
+        self.responses: Dict[str, SSDPResponse] = {}
+        self.first_response_at: Optional[float] = None
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        response = parse_ssdp_response(data)
+        if response is not None and response.location not in self.responses:
+            self.responses[response.location] = response
+            if self.first_response_at is None:
+                self.first_response_at = time.monotonic()
+
+
+async def discover(
+    timeout: float = DEFAULT_DISCOVERY_TIMEOUT,
+    search_target: str = ROOT_DEVICE_SEARCH_TARGET,
+    ssdp_address: Tuple[str, int] = SSDP_MULTICAST_ADDRESS,
+) -> Tuple[SSDPResponse, ...]:
+    """
+    Send an SSDP M-SEARCH and collect the answers for ``timeout`` seconds.
+
+    :return: one response per device description location
+    """
+    loop = asyncio.get_event_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, SSDP_MULTICAST_TTL)
+    sock.bind(("", 0))
+    sock.setblocking(False)
+    transport, protocol = await loop.create_datagram_endpoint(_SSDPProtocol, sock=sock)
+    try:
+        mx = max(1, int(timeout))
+        start = time.monotonic()
+        transport.sendto(build_msearch(search_target, mx, ssdp_address), ssdp_address)
+        await asyncio.sleep(timeout)
+    finally:
+        transport.close()
+
+    if protocol.first_response_at is None:
+        record_phase(Phase.DISCOVERY, timeout, OUTCOME_NO_DEVICES)
+    else:
+        record_phase(Phase.DISCOVERY, protocol.first_response_at - start, OUTCOME_OK)
+    return tuple(protocol.responses.values())
+
+
+class HTTPError(Exception):
+    pass
+
+
+async def http_request(
+    url: str,
+    method: str = "GET",
+    headers: Optional[Dict[str, str]] = None,
+    body: bytes = b"",
+    timeout: float = DEFAULT_HTTP_TIMEOUT,
+) -> Tuple[int, bytes]:
+    """
+    Make a single HTTP/1.1 request over a fresh connection.
+
+    :return: the response status code and body
+    :raise HTTPError: if the request failed or timed out
+    """
+    try:
+        return await asyncio.wait_for(
+            _http_exchange(url, method, headers or {}, body), timeout
+        )
+    except asyncio.TimeoutError as exc:
+        raise HTTPError(f"{method} {url} timed out after {timeout}s") from exc
+    except (OSError, ValueError, asyncio.IncompleteReadError) as exc:
+        raise HTTPError(f"{method} {url} failed: {exc}") from exc
+
+
+async def _http_exchange(
+    url: str, method: str, headers: Dict[str, str], body: bytes
+) -> Tuple[int, bytes]:
+    parsed_url = urlparse(url)
+    if parsed_url.scheme != "http" or not parsed_url.hostname:
+        raise ValueError(f"Unsupported URL: {url}")
+    path = parsed_url.path or "/"
+    if parsed_url.query:
+        path += "?" + parsed_url.query
+
+    reader, writer = await asyncio.open_connection(
+        parsed_url.hostname, parsed_url.port or 80
+    )
+    try:
+        request_headers = {
+            "Host": parsed_url.netloc,
+            "Connection": "close",
+            "Content-Length": str(len(body)),
+        }
+        request_headers.update(headers)
+        request_head = f"{method} {path} HTTP/1.1\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in request_headers.items()
+        )
+        writer.write(request_head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise ValueError(f"Invalid HTTP status line: {status_line!r}")
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            content = await _read_chunked(reader)
+        elif "content-length" in response_headers:
+            content = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            content = await reader.read()
+        return status, content
+    finally:
+        writer.close()
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    chunks: List[bytes] = []
+    while True:
+        size_line = await reader.readline()
+        size = int(size_line.split(b";", 1)[0].strip(), 16)
+        if size == 0:
+            # Skip the trailers
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+
+class AsyncSOAPService:
+    """
+    A UPnP service called through its control URL from the event loop.
+    """
+
+    def __init__(
+        self,
+        control_url: str,
+        service_type: str,
+        name: str,
+        timeout: float = DEFAULT_SOAP_TIMEOUT,
+    ) -> None:
+        self.control_url = control_url
+        self.service_type = service_type
+        self.name = name
+        self.timeout = timeout
+
+    def __repr__(self) -> str:
+        return f"<AsyncSOAPService {self.name} at {self.control_url}>"
+
+    async def call(self, action_name: str, **arguments: Any) -> Dict[str, str]:
+        """
+        Call an action on the service and return its output arguments.
+
+        :raise SOAPError: if the device returned a UPnP error
+        :raise SOAPProtocolError: if the device could not be reached or its
+            response could not be understood
+        """
+        headers, body = build_soap_request(self.service_type, action_name, arguments)
+        try:
+            status, content = await http_request(
+                self.control_url, "POST", headers, body, self.timeout
+            )
+        except HTTPError as exc:
+            raise SOAPProtocolError(str(exc)) from exc
+
+        if status == 200:
+            return parse_soap_response(self.service_type, action_name, content)
+        elif status == 500:
+            raise parse_soap_fault(content)
+        else:
+            raise SOAPProtocolError(
+                f"{action_name} call to {self.control_url} returned HTTP {status}"
+            )
+
+
+async def fetch_device_description(
+    location: str, timeout: float = DEFAULT_HTTP_TIMEOUT
+) -> DeviceDescription:
+    """
+    Fetch and parse the root device description at ``location``.
+
+    :raise HTTPError: if the description could not be fetched
+    :raise ValueError: if the description could not be parsed
+    """
+    status, content = await http_request(location, timeout=timeout)
+    if status != 200:
+        raise HTTPError(f"GET {location} returned HTTP {status}")
+    return parse_device_description(location, content)
+
+
+class _DeviceProbe(NamedTuple):
+    location: str
+    internal_ip: str
+    wan_service: AsyncSOAPService
+    external_ip: str
+
+
+async def setup_port_map(
+    port: int,
+    duration: int = DEFAULT_PORTMAP_DURATION,
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    discovery_timeout: float = DEFAULT_DISCOVERY_TIMEOUT,
+    ssdp_address: Tuple[str, int] = SSDP_MULTICAST_ADDRESS,
+    protocols: Tuple[str, ...] = SUPPORTED_PROTOCOLS,
+) -> Tuple[AnyIPAddress, AnyIPAddress]:
+    """
+    Set up the port mapping
+
+    The discovered devices are probed concurrently and the port is mapped, for each
+    of the ``protocols`` at once, on the first one that responds.
+
+    :return: the internal and external IP addresses of the new mapping
+    """
+    protocols = _normalize_protocols(protocols)
+    responses = await discover(discovery_timeout, ssdp_address=ssdp_address)
+    if not responses:
+        raise PortMapFailed("No UPnP devices available")
+
+    interface_index = InterfaceIndex()
+    probes = [
+        asyncio.ensure_future(
+            _try_probe_device(
+                response.location, required_service_names, interface_index
+            )
+        )
+        for response in responses
+    ]
+    try:
+        for next_probe in asyncio.as_completed(probes):
+            probe = await next_probe
+            if probe is None:
+                continue
+            with _log_device_failures(probe.location):
+                statuses = await _map_probed_device(probe, port, duration, protocols)
+                logger.info(
+                    "NAT port forwarding successfully set up: "
+                    "internal=%s:%d external=%s:%d (%s)",
+                    probe.internal_ip,
+                    port,
+                    probe.external_ip,
+                    port,
+                    " ".join(
+                        f"{protocol}={status.value}"
+                        for protocol, status in zip(protocols, statuses)
+                    ),
+                )
+                return (
+                    ipaddress.ip_address(probe.internal_ip),
+                    ipaddress.ip_address(probe.external_ip),
+                )
+            # The address may be what the device rejected
+            external_ip_cache.invalidate(probe.wan_service.control_url)
+    finally:
+        for pending_probe in probes:
+            pending_probe.cancel()
+        # Let the cancelled probes close their connections
+        await asyncio.gather(*probes, return_exceptions=True)
+
+    logger.info("Failed to setup NAT portmap.  Tried %d devices", len(responses))
+    raise PortMapFailed(
+        f"Failed to setup NAT portmap.  Tried {len(responses)} devices."
+    )
+
+
+async def _try_probe_device(
+    location: str,
+    required_service_names: Optional[Tuple[str, ...]],
+    interface_index: InterfaceIndex,
+) -> Optional[_DeviceProbe]:
+    with _log_device_failures(location):
+        return await _probe_device(location, required_service_names, interface_index)
+    return None
+
+
+async def _probe_device(
+    location: str,
+    required_service_names: Optional[Tuple[str, ...]],
+    interface_index: InterfaceIndex,
+) -> _DeviceProbe:
+    internal_ip = _find_internal_ip_on_device_network(location, interface_index)
+    try:
+        with measure(Phase.DESCRIPTION, location):
+            description = await fetch_device_description(location)
+    except (HTTPError, ValueError) as exc:
+        raise PortMapFailed(
+            f"Unable to fetch device description at {location}"
+        ) from exc
+
+    wan_service = _get_wan_service(description, required_service_names)
+    external_ip = await _get_external_ip(location, wan_service)
+    return _DeviceProbe(location, internal_ip, wan_service, external_ip)
+
+
+async def _get_external_ip(location: str, wan_service: AsyncSOAPService) -> str:
+    external_ip = external_ip_cache.get(wan_service.control_url)
+    if external_ip is not None:
+        return external_ip
+    try:
+        with measure(Phase.EXTERNAL_IP, location):
+            result = await wan_service.call("GetExternalIPAddress")
+    except (SOAPError, SOAPProtocolError) as exc:
+        logger.debug("Failed to get external IP address of device: %s", location)
+        raise PortMapFailed from exc
+    external_ip = result["NewExternalIPAddress"]
+    external_ip_cache.record(wan_service.control_url, external_ip)
+    return external_ip
+
+
+def _get_wan_service(
+    description: DeviceDescription, required_service_names: Optional[Tuple[str, ...]]
+) -> AsyncSOAPService:
+    service = _find_wan_service(description, required_service_names)
+    return AsyncSOAPService(service.control_url, service.service_type, service.name)
+
+
+async def _map_probed_device(
+    probe: _DeviceProbe, port: int, duration: int, protocols: Sequence[str]
+) -> Tuple[PortMapStatus, ...]:
+    outcomes = await asyncio.gather(
+        *(_map_port(probe, port, duration, protocol) for protocol in protocols),
+        return_exceptions=True,
+    )
+    statuses: List[PortMapStatus] = []
+    for protocol, outcome in zip(protocols, outcomes):
+        if outcome is PortMapStatus.CONFLICT or (
+            isinstance(outcome, SOAPError) and _is_mapping_conflict(outcome)
+        ):
+            # See upnp_port_forward.client._add_port_mapping_batch
+            logger.debug(
+                "NAT %s port mapping already configured, not overriding it", protocol
+            )
+            statuses.append(PortMapStatus.CONFLICT)
+        elif isinstance(outcome, PortMapStatus):
+            statuses.append(outcome)
+        elif isinstance(outcome, (SOAPError, SOAPProtocolError)):
+            logger.debug(
+                "Failed to setup NAT %s portmap on device: %s", protocol, probe.location
+            )
+            raise PortMapFailed from outcome
+        else:
+            raise outcome
+    return tuple(statuses)
+
+
+async def _map_port(
+    probe: _DeviceProbe, port: int, duration: int, protocol: str
+) -> PortMapStatus:
+    existing_status = _existing_mapping_status(
+        await _get_existing_entry(probe, port, protocol),
+        probe.internal_ip,
+        port,
+        duration,
+    )
+    if existing_status is not None:
+        return existing_status
+    await _add_port_mapping(probe, port, duration, protocol)
+    return PortMapStatus.MAPPED
+
+
+async def _get_existing_entry(
+    probe: _DeviceProbe, port: int, protocol: str
+) -> Optional[PortMappingEntry]:
+    try:
+        arguments = await probe.wan_service.call(
+            "GetSpecificPortMappingEntry",
+            **specific_port_mapping_entry_arguments(port, protocol, probe.external_ip),
+        )
+        return parse_specific_port_mapping_entry(
+            arguments, port, protocol, probe.external_ip
+        )
+    except (SOAPError, SOAPProtocolError) as exc:
+        if isinstance(exc, SOAPError) and exc.args and exc.args[0] == NO_SUCH_ENTRY:
+            return None
+        # Not all devices implement it, the mapping is then added without looking
+        logger.debug(
+            "Failed to look up the %s port mapping %d on device: %s",
+            protocol,
+            port,
+            probe.location,
+            exc_info=True,
+        )
+        return None
+
+
+async def _add_port_mapping(
+    probe: _DeviceProbe, port: int, duration: int, protocol: str
+) -> None:
+    with measure(Phase.ADD_PORT_MAPPING, probe.location):
+        await probe.wan_service.call(
+            "AddPortMapping",
+            NewRemoteHost=probe.external_ip,
+            NewExternalPort=port,
+            NewProtocol=protocol,
+            NewInternalPort=port,
+            NewInternalClient=probe.internal_ip,
+            NewEnabled="1",
+            NewPortMappingDescription=f"upnp-port-forward[{protocol}]",
+            NewLeaseDuration=duration,
+        )
@@ -0,0 +1,275 @@
+import enum
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Iterable, NamedTuple, Optional, Tuple, Union
+
+from .interfaces import LocalAddress
+
+DEFAULT_DEVICE_CACHE_TTL = 24 * 60 * 60  # 1 day
+DEFAULT_EXTERNAL_IP_TTL = 5 * 60  # 5 minutes
+DEFAULT_UNUSABLE_DEVICE_TTL = 10 * 60  # 10 minutes
+
+_DEVICE_CACHE_VERSION = 1
+
+
+logger = logging.getLogger("upnp_port_forward.cache")
+
+
+class CachedDevice(NamedTuple):
+    udn: str
+    location: str
+    service_name: str
+    service_type: str
+    control_url: str
+    updated_at: float
+
+    @property
+    def key(self) -> str:
+        return self.udn or self.location
+
+
+class DeviceCache:
+    """
+    On-disk cache of the UPnP devices and WAN services that last successfully
+    mapped a port, so that a restarted process can skip SSDP discovery and the
+    description fetches and go straight to a known-good router.
+
+    Entries are keyed by device UDN (or location when the device has none) and
+    expire ``ttl`` seconds after their last successful use.
+    """
+
+    def __init__(
+        self, path: Union[str, pathlib.Path], ttl: float = DEFAULT_DEVICE_CACHE_TTL
+    ) -> None:
+        self.path = pathlib.Path(path).expanduser()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def entries(self) -> Tuple[CachedDevice, ...]:
+        """
+        :return: the unexpired entries, most recently used first
+        """
+        now = time.time()
+        with self._lock:
+            devices = self._load()
+        fresh_devices = (
+            device for device in devices.values() if now - device.updated_at < self.ttl
+        )
+        return tuple(
+            sorted(fresh_devices, key=lambda device: device.updated_at, reverse=True)
+        )
+
+    def record(self, device: CachedDevice) -> None:
+        with self._lock:
+            devices = self._load()
+            devices[device.key] = device
+            self._save(devices)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            devices = self._load()
+            if devices.pop(key, None) is not None:
+                self._save(devices)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._save({})
+
+    def _load(self) -> Dict[str, CachedDevice]:
+        try:
+            with self.path.open() as cache_file:
+                raw_cache = json.load(cache_file)
+            if raw_cache["version"] != _DEVICE_CACHE_VERSION:
+                return {}
+            return {
+                key: CachedDevice(**raw_device)
+                for key, raw_device in raw_cache["devices"].items()
+            }
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.debug("Ignoring unreadable UPnP device cache at %s", self.path)
+            return {}
+
+    def _save(self, devices: Dict[str, CachedDevice]) -> None:
+        raw_cache = {
+            "version": _DEVICE_CACHE_VERSION,
+            "devices": {key: device._asdict() for key, device in devices.items()},
+        }
+        dump_json_atomically(raw_cache, self.path)
+
+
+def dump_json_atomically(content: Any, path: pathlib.Path) -> None:
+    write_text_atomically(json.dumps(content), path)
+
+
+def write_text_atomically(text: str, path: pathlib.Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so that a crash never leaves a truncated file
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(text)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ExternalIPCache:
+    """
+    In-memory cache of the external IP address reported by each WAN service, keyed
+    by control URL, so that a burst of mappings on a device costs a single
+    ``GetExternalIPAddress`` call.
+
+    Addresses expire ``ttl`` seconds after they were looked up; a ``ttl`` of 0
+    disables the cache.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_EXTERNAL_IP_TTL) -> None:
+        self.ttl = ttl
+        # control URL -> (external IP address, time.monotonic() of the lookup)
+        self._entries: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, control_url: str) -> Optional[str]:
+        """
+        :return: the unexpired external address of the service, if any
+        """
+        with self._lock:
+            entry = self._entries.get(control_url)
+        if entry is None or time.monotonic() - entry[1] >= self.ttl:
+            return None
+        return entry[0]
+
+    def latest(self) -> Optional[Tuple[str, str]]:
+        """
+        :return: the control URL and unexpired external address of the service
+            looked up last, if any
+        """
+        now = time.monotonic()
+        with self._lock:
+            fresh_entries = [
+                (looked_up_at, control_url, external_ip)
+                for control_url, (external_ip, looked_up_at) in self._entries.items()
+                if now - looked_up_at < self.ttl
+            ]
+        if not fresh_entries:
+            return None
+        _, control_url, external_ip = max(fresh_entries)
+        return control_url, external_ip
+
+    def record(self, control_url: str, external_ip: str) -> None:
+        with self._lock:
+            self._entries[control_url] = (external_ip, time.monotonic())
+
+    def invalidate(self, control_url: Optional[str] = None) -> None:
+        """
+        Forget the address of the given service, or of all of them.
+        """
+        with self._lock:
+            if control_url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(control_url, None)
+
+
+class UnusableReason(enum.Enum):
+    # None of the networks of this host contains the device
+    NO_INTERNAL_ADDRESS = "no_internal_address"
+    # None of the WAN services looked for is on the device
+    NO_WAN_SERVICE = "no_wan_service"
+    # The device description is missing or can't be parsed
+    INVALID_DESCRIPTION = "invalid_description"
+
+
+class UnusableDevice(NamedTuple):
+    reason: UnusableReason
+    # The location and SERVER header the device advertised
+    advertisement: Tuple[str, str]
+    local_addresses: FrozenSet[LocalAddress]
+    # The service names that were looked for, for NO_WAN_SERVICE
+    required_service_names: Optional[Tuple[str, ...]]
+    # time.monotonic() of the expiry
+    expires_at: float
+
+
+class UnusableDeviceCache:
+    """
+    In-memory cache of the devices that can't map ports, such as media servers or
+    the upstream box of the ISP, keyed by device UDN (or location when the device
+    has none), so that they are not probed again on each search.
+
+    An entry is forgotten ``ttl`` seconds after it was recorded, or as soon as the
+    local interfaces or the advertisement of the device change.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_UNUSABLE_DEVICE_TTL) -> None:
+        self.ttl = ttl
+        self._entries: Dict[str, UnusableDevice] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        key: str,
+        advertisement: Tuple[str, str],
+        local_addresses: Iterable[LocalAddress],
+    ) -> Optional[UnusableDevice]:
+        """
+        :return: the entry of the device, if it still holds
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not _still_holds(entry, advertisement, frozenset(local_addresses)):
+                del self._entries[key]
+                return None
+            return entry
+
+    def record(
+        self,
+        key: str,
+        reason: UnusableReason,
+        advertisement: Tuple[str, str],
+        local_addresses: Iterable[LocalAddress],
+        required_service_names: Optional[Tuple[str, ...]] = None,
+    ) -> None:
+        entry = UnusableDevice(
+            reason,
+            advertisement,
+            frozenset(local_addresses),
+            required_service_names,
+            time.monotonic() + self.ttl,
+        )
+        with self._lock:
+            self._entries[key] = entry
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """
+        Forget the given device, or all of them.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+def _still_holds(
+    entry: UnusableDevice,
+    advertisement: Tuple[str, str],
+    local_addresses: FrozenSet[LocalAddress],
+) -> bool:
+    if time.monotonic() >= entry.expires_at:
+        return False
+    if entry.advertisement != advertisement:
+        return False
+    return entry.local_addresses == local_addresses
@@ -1,13 +1,56 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+import enum
 import ipaddress
 import logging
-from typing import Optional, Tuple
+import queue
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+import urllib.error
 from urllib.parse import urlparse
 
-import netifaces
-import upnpclient
-
-from .exceptions import PortMapFailed
-from .typing import AnyIPAddress
+from .cache import (
+    CachedDevice,
+    DeviceCache,
+    ExternalIPCache,
+    UnusableDeviceCache,
+    UnusableReason,
+)
+from .deadline import NO_DEADLINE, Deadline
+from .description import (
+    DEFAULT_HTTP_TIMEOUT,
+    DeviceDescription,
+    ServiceDescription,
+    fetch_device,
+)
+from .exceptions import DeadlineExceeded, PortMapFailed
+from .fingerprints import DeviceModel, Fingerprint, FingerprintDB
+from .interfaces import InterfaceIndex
+from .mappings import (
+    PortMappingEntry,
+    PortMappingIndex,
+    get_specific_port_mapping_entry,
+    iter_port_mapping_entries,
+)
+from .metrics import Phase, measure
+from .pcp import DEFAULT_PCP_TIMEOUT, map_port_on_gateway
+from .soap import SOAPError, SOAPProtocolError, SOAPService
+from .ssdp import DEFAULT_DISCOVERY_TIMEOUT, SSDPResponse, search
+from .throttle import DEFAULT_MAX_CONCURRENCY
+from .typing import AnyIPAddress, PortSpec
 
 
 #
@@ -21,12 +64,41 @@ class _WANServiceNotFound(Exception):
     pass
 
 
+class _InvalidDeviceDescription(PortMapFailed):
+    pass
+
+
 DEFAULT_PORTMAP_DURATION = 30 * 60  # 30 minutes
 
+# Calls of a batch made at once.  The throttle of the device keeps the calls actually
+# in flight down to what it copes with.
+DEFAULT_MAX_CONCURRENT_CALLS = DEFAULT_MAX_CONCURRENCY
+
+# Upper bound on the devices probed at once with concurrent=True
+_MAX_CONCURRENT_PROBES = 16
+
+# The only protocols an IGD accepts in NewProtocol
+SUPPORTED_PROTOCOLS: Tuple[str, ...] = ("UDP", "TCP")
+
+# Free ports tried per mapping when the mapping table changed since it was listed
+_MAX_FREE_PORT_ATTEMPTS = 8
+
+# IGDv2 added AddAnyPortMapping, where the device picks a free external port
+_ADD_ANY_PORT_MAPPING_SERVICE_TYPE_PREFIX = (
+    "urn:schemas-upnp-org:service:WANIPConnection:"
+)
+
 
 logger = logging.getLogger("upnp_port_forward")
 
 
+# Shared by all the mapping and renewal paths, and served by get_external_ip()
+external_ip_cache = ExternalIPCache()
+
+# The discovered devices that can't map ports, skipped by the following searches
+unusable_device_cache = UnusableDeviceCache()
+
+
 WAN_SERVICE_NAMES: Tuple[str, ...] = (
     "WANIPConn1",
     "WANIPConnection.1",  # Nighthawk C7800
@@ -35,131 +107,1057 @@ WAN_SERVICE_NAMES: Tuple[str, ...] = (
 )
 
 
+class PortMapStatus(enum.Enum):
+    MAPPED = "mapped"
+    # The same entry already exists and outlasts the requested duration, so it was
+    # left as is
+    EXISTING = "existing"
+    # Another host already has an entry for this external port and protocol
+    CONFLICT = "conflict"
+    FAILED = "failed"
+
+
+class PortMapResult(NamedTuple):
+    external_port: int
+    internal_port: int
+    protocol: str
+    status: PortMapStatus
+    internal_ip: AnyIPAddress
+    external_ip: AnyIPAddress
+    error: Optional[Exception] = None
+    # The entry found on the device for an EXISTING or CONFLICT mapping, if known
+    existing_entry: Optional[PortMappingEntry] = None
+
+
 def setup_port_map(
     port: int,
     duration: int = DEFAULT_PORTMAP_DURATION,
     required_service_names: Optional[Tuple[str, ...]] = None,
+    device_cache: Optional[DeviceCache] = None,
+    concurrent: bool = False,
+    protocols: Tuple[str, ...] = SUPPORTED_PROTOCOLS,
+    try_pcp: bool = False,
+    pcp_timeout: float = DEFAULT_PCP_TIMEOUT,
+    fingerprint_db: Optional[FingerprintDB] = None,
+    timeout: Optional[float] = None,
 ) -> Tuple[AnyIPAddress, AnyIPAddress]:
     """
     Set up the port mapping
 
+    The port is mapped for each of the ``protocols``, with all the calls made to the
+    device at the same time.  Entries that already map the port to this host are
+    only refreshed if they expire sooner than ``duration``, and entries of other
+    hosts are left alone.
+
+    If a ``device_cache`` is given, the devices that last worked are tried first
+    and discovery only happens if none of them can map the port anymore.
+
+    With ``concurrent=True`` the discovered devices are probed in parallel and the
+    port is mapped on the first one that responds, so a slow or dead device does
+    not hold up the others.
+
+    With ``try_pcp=True`` the port is first mapped on the default gateway with PCP or
+    NAT-PMP, which takes a single round trip, and UPnP is only used if the gateway
+    doesn't answer within ``pcp_timeout`` seconds or refuses the mapping.
+
+    If a ``fingerprint_db`` is given, the WAN service that worked on the same router
+    model is used first, and the service and actions that work are recorded in it.
+
+    With a ``timeout``, the whole call fails after that many seconds, with a
+    ``DeadlineExceeded`` error (a ``PortMapFailed``) naming what was going on.  Each
+    network operation, from the PCP request and the search to the SOAP calls, only
+    waits for the time left.
+
     :return: the IP address of the new mapping (or None if failed)
     """
-    devices = upnpclient.discover()
-    if not devices:
-        raise PortMapFailed("No UPnP devices available")
-
-    for upnp_dev in devices:
+    protocols = _normalize_protocols(protocols)
+    deadline = Deadline(timeout)
+    if try_pcp:
         try:
-            internal_ip, external_ip = _setup_device_port_map(
-                upnp_dev, port, duration, required_service_names,
+            gateway_mapping = map_port_on_gateway(
+                port, duration, protocols, deadline.budget("PCP", pcp_timeout)
             )
+        except PortMapFailed:
+            deadline.check("PCP")
+            logger.debug(
+                "Failed to setup portmap with PCP or NAT-PMP, trying UPnP",
+                exc_info=True,
+            )
+        else:
             logger.info(
-                "NAT port forwarding successfully set up: internal=%s:%d external=%s:%d",
-                internal_ip,
+                "NAT port forwarding successfully set up with %s: "
+                "internal=%s:%d external=%s:%d (%s)",
+                gateway_mapping.method,
+                gateway_mapping.internal_ip,
                 port,
-                external_ip,
+                gateway_mapping.external_ip,
                 port,
+                " ".join(
+                    f"{protocol}=conflict"
+                    if protocol in gateway_mapping.conflicts
+                    else f"{protocol}=mapped"
+                    for protocol in protocols
+                ),
             )
-            break
-        except _NoInternalAddressMatchesDevice:
-            logger.debug(
-                "No internal addresses were managed by the UPnP device at %s",
-                upnp_dev.location,
+            return (
+                ipaddress.ip_address(gateway_mapping.internal_ip),
+                ipaddress.ip_address(gateway_mapping.external_ip),
             )
-            continue
-        except _WANServiceNotFound:
-            logger.debug(
-                "No WAN services managed by the UPnP device at %s", upnp_dev.location,
+
+    device_prober = _DeviceProber(
+        required_service_names, device_cache, concurrent, fingerprint_db, deadline
+    )
+    # Closed as soon as a device works, rather than whenever it is collected, to end
+    # the search and the probes still running
+    with closing(iter(device_prober)) as probes:
+        for probe in probes:
+            with _log_device_failures(probe.location):
+                try:
+                    results = _add_port_mappings(probe, port, duration, protocols)
+                finally:
+                    # Nothing calls the service once the port is mapped
+                    probe.wan_service.close()
+                device_prober.remember(probe, results)
+                logger.info(
+                    "NAT port forwarding successfully set up: "
+                    "internal=%s:%d external=%s:%d (%s)",
+                    probe.internal_ip,
+                    port,
+                    probe.external_ip,
+                    port,
+                    _format_statuses(results),
+                )
+                return (
+                    ipaddress.ip_address(probe.internal_ip),
+                    ipaddress.ip_address(probe.external_ip),
+                )
+            device_prober.forget(probe)
+
+    raise device_prober.failure()
+
+
+def setup_port_maps(
+    ports: Iterable[PortSpec],
+    duration: int = DEFAULT_PORTMAP_DURATION,
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    device_cache: Optional[DeviceCache] = None,
+    concurrent: bool = False,
+    max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_CALLS,
+    fingerprint_db: Optional[FingerprintDB] = None,
+    any_external_port: bool = False,
+    timeout: Optional[float] = None,
+) -> Tuple[PortMapResult, ...]:
+    """
+    Set up several port mappings at once
+
+    Each entry of ``ports`` is either a port number, mapped to the same port for both
+    UDP and TCP, or an ``(external_port, internal_port, protocol)`` tuple.  The device,
+    its WAN service and the external IP address are only looked up once, then the
+    mappings are added with up to ``max_concurrent_calls`` calls in flight.
+
+    The existing entry of each mapping is looked up first: mappings that are already
+    set up are skipped, those to this host are refreshed and those to other hosts are
+    reported as conflicts.  A mapping that can't be added doesn't fail the others:
+    check the ``status`` of each result.
+
+    With ``any_external_port=True``, a mapping whose external port is taken is added
+    on another one instead, given in the ``external_port`` of its result: IGDv2
+    devices pick it with ``AddAnyPortMapping``, otherwise it is the next port that is
+    free in the mapping table of the device.
+
+    With a ``timeout``, the call fails after that many seconds as
+    :func:`setup_port_map` does.
+
+    :return: one result per mapping, in the order of ``ports``
+    :raise PortMapFailed: if no device could add any of the mappings
+    """
+    port_mappings = _normalize_port_specs(ports)
+    if not port_mappings:
+        return ()
+
+    device_prober = _DeviceProber(
+        required_service_names,
+        device_cache,
+        concurrent,
+        fingerprint_db,
+        Deadline(timeout),
+    )
+    probe, results = _setup_port_maps(
+        device_prober, port_mappings, duration, max_concurrent_calls, any_external_port
+    )
+    probe.wan_service.close()
+    return results
+
+
+def get_external_ip(
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    device_cache: Optional[DeviceCache] = None,
+    concurrent: bool = False,
+) -> AnyIPAddress:
+    """
+    Get the external IP address of the router
+
+    The address looked up last, by this function or while mapping ports, is returned
+    as long as it is fresher than ``external_ip_cache.ttl``.  Otherwise the devices
+    are probed as by :func:`setup_port_map`, which looks the address up again.
+
+    The address looked up last may come from any device, so it is not used when
+    ``required_service_names`` or a ``device_cache`` is given: the devices are then
+    probed, and only the address of the service they settle on comes from the cache.
+
+    :raise PortMapFailed: if no device could be used
+    """
+    latest = external_ip_cache.latest()
+    if latest is not None and required_service_names is None and device_cache is None:
+        _, external_ip = latest
+        return ipaddress.ip_address(external_ip)
+
+    device_prober = _DeviceProber(required_service_names, device_cache, concurrent)
+    with closing(iter(device_prober)) as probes:
+        for probe in probes:
+            device_prober.remember(probe)
+            probe.wan_service.close()
+            return ipaddress.ip_address(probe.external_ip)
+    raise device_prober.failure()
+
+
+def get_port_mappings(
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    device_cache: Optional[DeviceCache] = None,
+    concurrent: bool = False,
+) -> Iterator[PortMappingEntry]:
+    """
+    Iterate over the port mapping table of the router
+
+    Entries are fetched one by one as the iteration goes, so a table with hundreds of
+    entries is never held in memory and the iteration can stop at any point.  The
+    device is only looked up when the first entry is requested.
+
+    :raise PortMapFailed: if no device could be used, or if the device failed while
+        listing its entries
+    """
+    device_prober = _DeviceProber(required_service_names, device_cache, concurrent)
+    with closing(iter(device_prober)) as probes:
+        for probe in probes:
+            device_prober.remember(probe)
+            try:
+                yield from iter_port_mapping_entries(probe.wan_service)
+            except (SOAPError, SOAPProtocolError) as exc:
+                raise PortMapFailed(
+                    "Unable to list the port mappings of the UPnP device at "
+                    f"{probe.location}"
+                ) from exc
+            finally:
+                probe.wan_service.close()
+            return
+    raise device_prober.failure()
+
+
+def _setup_port_maps(
+    device_prober: "_DeviceProber",
+    port_mappings: Sequence[Tuple[int, int, str]],
+    duration: int,
+    max_concurrent_calls: int,
+    any_external_port: bool = False,
+) -> Tuple["_DeviceProbe", Tuple[PortMapResult, ...]]:
+    with closing(iter(device_prober)) as probes:
+        for probe in probes:
+            results = _add_port_mapping_batch(
+                probe,
+                port_mappings,
+                duration,
+                max_concurrent_calls,
+                any_external_port=any_external_port,
             )
-            continue
-        except PortMapFailed:
-            logger.debug(
-                "Failed to setup portmap on UPnP device at %s",
-                upnp_dev.location,
-                exc_info=True,
+            if all(result.status is PortMapStatus.FAILED for result in results):
+                logger.debug(
+                    "Failed to setup any portmap on UPnP device at %s", probe.location
+                )
+                device_prober.forget(probe)
+                continue
+
+            device_prober.remember(probe, results)
+            logger.info(
+                "NAT port forwarding set up for %d of %d mappings: "
+                "internal=%s external=%s",
+                sum(result.status in _SET_UP_STATUSES for result in results),
+                len(results),
+                probe.internal_ip,
+                probe.external_ip,
             )
-            continue
-    else:
-        logger.info("Failed to setup NAT portmap.  Tried %d devices", len(devices))
-        raise PortMapFailed(
-            f"Failed to setup NAT portmap.  Tried {len(devices)} devices."
-        )
+            return probe, results
 
-    return ipaddress.ip_address(internal_ip), ipaddress.ip_address(external_ip)
+    raise device_prober.failure()
 
 
-def _find_internal_ip_on_device_network(upnp_dev: upnpclient.upnp.Device) -> str:
+def _normalize_port_specs(
+    ports: Iterable[PortSpec],
+) -> Tuple[Tuple[int, int, str], ...]:
+    port_mappings: List[Tuple[int, int, str]] = []
+    for port_spec in ports:
+        if isinstance(port_spec, int):
+            port_mappings.extend(
+                (port_spec, port_spec, protocol) for protocol in SUPPORTED_PROTOCOLS
+            )
+        else:
+            external_port, internal_port, protocol = port_spec
+            port_mappings.append(
+                (external_port, internal_port, _normalize_protocol(protocol))
+            )
+    return tuple(port_mappings)
+
+
+def _normalize_protocols(protocols: Iterable[str]) -> Tuple[str, ...]:
+    normalized = tuple(_normalize_protocol(protocol) for protocol in protocols)
+    if not normalized:
+        raise ValueError("No protocol to map the port for")
+    return normalized
+
+
+def _normalize_protocol(protocol: str) -> str:
+    if protocol.upper() not in SUPPORTED_PROTOCOLS:
+        raise ValueError(f"Unsupported protocol: {protocol}")
+    return protocol.upper()
+
+
+class _DeviceProbe(NamedTuple):
+    location: str
+    udn: str
+    internal_ip: str
+    wan_service: SOAPService
+    external_ip: str
+    # Unknown for the devices found in the device cache
+    model: Optional[DeviceModel] = None
+    # Whether GetExternalIPAddress was called, rather than the address cached
+    external_ip_fetched: bool = False
+
+
+class _DeviceProber:
     """
-    For a given UPnP device, return the internal IP address of this host machine that can
-    be used for a NAT mapping.
+    Iterate over the devices that can be used to map a port: the cached devices
+    first, then the discovered ones.  Each device is probed (internal address, WAN
+    service and external address) before it is yielded.
     """
-    parsed_url = urlparse(upnp_dev.location)
-    # Get an ipaddress.IPv4Network instance for the upnp device's network.
-    upnp_dev_net = ipaddress.ip_network(parsed_url.hostname + "/24", strict=False)
-    for iface in netifaces.interfaces():
-        for family, addresses in netifaces.ifaddresses(iface).items():
-            # TODO: Support IPv6 addresses as well.
-            if family != netifaces.AF_INET:
+
+    def __init__(
+        self,
+        required_service_names: Optional[Tuple[str, ...]],
+        device_cache: Optional[DeviceCache],
+        concurrent: bool,
+        fingerprint_db: Optional[FingerprintDB] = None,
+        deadline: Deadline = NO_DEADLINE,
+    ) -> None:
+        self.required_service_names = required_service_names
+        self.device_cache = device_cache
+        self.concurrent = concurrent
+        self.fingerprint_db = fingerprint_db
+        self.deadline = deadline
+        self.discovered_device_count = 0
+
+    def __iter__(self) -> Generator[_DeviceProbe, None, None]:
+        # The local interfaces are only listed once per round
+        interface_index = InterfaceIndex()
+        if self.device_cache is not None:
+            yield from self._probe_cached_devices(self.device_cache, interface_index)
+
+        # Devices are probed as soon as they answer the search, so that the port can be
+        # mapped without waiting for the search to time out
+        responses = search(
+            timeout=self.deadline.budget("discovery", DEFAULT_DISCOVERY_TIMEOUT)
+        )
+        if self.concurrent:
+            yield from self._probe_devices_concurrently(responses, interface_index)
+        else:
+            yield from self._probe_devices(responses, interface_index)
+
+        if not self.discovered_device_count:
+            # The search may have been cut short
+            self.deadline.check("discovery")
+            raise PortMapFailed("No UPnP devices available")
+
+    def remember(
+        self, probe: _DeviceProbe, results: Sequence[PortMapResult] = ()
+    ) -> None:
+        if self.fingerprint_db is not None and probe.model is not None:
+            self.fingerprint_db.record(
+                probe.model, probe.wan_service.name, _working_actions(probe, results),
+            )
+        if self.device_cache is not None:
+            self.device_cache.record(
+                CachedDevice(
+                    udn=probe.udn,
+                    location=probe.location,
+                    service_name=probe.wan_service.name,
+                    service_type=probe.wan_service.service_type,
+                    control_url=probe.wan_service.control_url,
+                    updated_at=time.time(),
+                )
+            )
+
+    def forget(self, probe: _DeviceProbe) -> None:
+        probe.wan_service.close()
+        external_ip_cache.invalidate(probe.wan_service.control_url)
+        if self.device_cache is not None:
+            self.device_cache.invalidate(probe.udn or probe.location)
+
+    def failure(self) -> PortMapFailed:
+        if self.deadline.expired:
+            # Waiting for more devices to answer the search
+            return self.deadline.exceeded("discovery")
+        logger.info(
+            "Failed to setup NAT portmap.  Tried %d devices",
+            self.discovered_device_count,
+        )
+        return PortMapFailed(
+            f"Failed to setup NAT portmap.  Tried {self.discovered_device_count} devices."
+        )
+
+    def _probe_cached_devices(
+        self, device_cache: DeviceCache, interface_index: InterfaceIndex
+    ) -> Iterator[_DeviceProbe]:
+        for cached_device in device_cache.entries():
+            if self.required_service_names and (
+                cached_device.service_name not in self.required_service_names
+            ):
                 continue
-            for item in addresses:
-                if ipaddress.ip_address(item["addr"]) in upnp_dev_net:
-                    return str(item["addr"])
-    raise _NoInternalAddressMatchesDevice(parsed_url.hostname)
 
+            wan_service = SOAPService(
+                cached_device.control_url,
+                cached_device.service_type,
+                cached_device.service_name,
+                deadline=self.deadline,
+            )
+            try:
+                internal_ip = _find_internal_ip_on_device_network(
+                    cached_device.location, interface_index
+                )
+                # Unless it is cached, getting the external address doubles as a check
+                # that the device works
+                external_ip = _get_external_ip(cached_device.location, wan_service)
+            except DeadlineExceeded:
+                wan_service.close()
+                raise
+            except (_NoInternalAddressMatchesDevice, PortMapFailed):
+                wan_service.close()
+                logger.debug(
+                    "Cached UPnP device at %s failed, discarding it",
+                    cached_device.location,
+                    exc_info=True,
+                )
+                device_cache.invalidate(cached_device.key)
+                continue
 
-def _get_wan_service(
-    upnp_dev: upnpclient.upnp.Device, required_service_names: Optional[Tuple[str, ...]]
-) -> upnpclient.upnp.Service:
+            logger.debug("Using cached UPnP device at %s", cached_device.location)
+            yield _DeviceProbe(
+                cached_device.location,
+                cached_device.udn,
+                internal_ip,
+                wan_service,
+                external_ip,
+            )
+
+    def _probe_devices(
+        self,
+        responses: Generator[SSDPResponse, None, None],
+        interface_index: InterfaceIndex,
+    ) -> Iterator[_DeviceProbe]:
+        try:
+            for response in responses:
+                self.discovered_device_count += 1
+                if self._is_known_unusable(response, interface_index):
+                    continue
+                with _log_device_failures(response.location):
+                    yield self._probe_advertised_device(response, interface_index)
+        finally:
+            responses.close()
+
+    def _probe_devices_concurrently(
+        self,
+        responses: Generator[SSDPResponse, None, None],
+        interface_index: InterfaceIndex,
+    ) -> Iterator[_DeviceProbe]:
+        """
+        Probe the devices as they answer the search and yield them as their probe
+        completes.  Only the probe runs concurrently, so that the port is never mapped
+        on more than one device.
+        """
+        executor = ThreadPoolExecutor(
+            max_workers=_MAX_CONCURRENT_PROBES, thread_name_prefix="upnp-port-forward"
+        )
+        futures: Dict["Future[_DeviceProbe]", str] = {}
+        # Completed probes, then None once the search is over
+        completed: "queue.Queue[Optional[Future[_DeviceProbe]]]" = queue.Queue()
+        # Set under the lock once the executor is shut down, so that no probe is
+        # submitted afterwards
+        stopped = False
+        stopped_lock = threading.Lock()
+        # Unlike the discovered devices, the devices known to be unusable are not
+        # probed, and never complete
+        submitted_count = 0
+
+        def submit_probes() -> None:
+            nonlocal submitted_count
+            try:
+                for response in responses:
+                    with stopped_lock:
+                        if stopped:
+                            break
+                        self.discovered_device_count += 1
+                        if self._is_known_unusable(response, interface_index):
+                            continue
+                        future = executor.submit(
+                            self._probe_advertised_device, response, interface_index
+                        )
+                        futures[future] = response.location
+                        submitted_count += 1
+                    future.add_done_callback(completed.put)
+            finally:
+                responses.close()
+                completed.put(None)
+
+        search_thread = threading.Thread(
+            target=submit_probes, name="upnp-port-forward-search", daemon=True
+        )
+        search_thread.start()
+        searching = True
+        completed_count = 0
+        yielded: Set["Future[_DeviceProbe]"] = set()
+        try:
+            while searching or completed_count < submitted_count:
+                future = completed.get()
+                if future is None:
+                    searching = False
+                    continue
+                completed_count += 1
+                with _log_device_failures(futures[future]):
+                    yielded.add(future)
+                    yield future.result()
+        finally:
+            # Don't wait for the search to time out, nor for the devices that are still
+            # being probed, whose services are closed once they are
+            with stopped_lock:
+                stopped = True
+                for future in futures:
+                    if future not in yielded and not future.cancel():
+                        future.add_done_callback(_close_probed_service)
+                executor.shutdown(wait=False)
+
+    def _is_known_unusable(
+        self, response: SSDPResponse, interface_index: InterfaceIndex
+    ) -> bool:
+        unusable = unusable_device_cache.get(
+            _device_key(response),
+            _advertisement(response),
+            interface_index.local_addresses,
+        )
+        if unusable is None:
+            return False
+        if unusable.reason is UnusableReason.NO_WAN_SERVICE:
+            if unusable.required_service_names != self.required_service_names:
+                return False
+            # The database may know the service of the model under another name
+            if self.fingerprint_db is not None:
+                return False
+        logger.debug(
+            "Skipping UPnP device at %s: %s", response.location, unusable.reason.value
+        )
+        return True
 
+    def _probe_advertised_device(
+        self, response: SSDPResponse, interface_index: InterfaceIndex
+    ) -> _DeviceProbe:
+        """
+        Probe a device that answered the search, and remember it if it can't map
+        ports.
+        """
+        reason = None
+        try:
+            return _probe_device(
+                response.location,
+                self.required_service_names,
+                interface_index,
+                self.fingerprint_db,
+                self.deadline,
+            )
+        except _NoInternalAddressMatchesDevice:
+            reason = UnusableReason.NO_INTERNAL_ADDRESS
+            raise
+        except _WANServiceNotFound:
+            reason = UnusableReason.NO_WAN_SERVICE
+            raise
+        except _InvalidDeviceDescription:
+            reason = UnusableReason.INVALID_DESCRIPTION
+            raise
+        finally:
+            if reason is not None:
+                unusable_device_cache.record(
+                    _device_key(response),
+                    reason,
+                    _advertisement(response),
+                    interface_index.local_addresses,
+                    self.required_service_names,
+                )
+
+
+def _close_probed_service(future: "Future[_DeviceProbe]") -> None:
+    if future.exception() is None:
+        future.result().wan_service.close()
+
+
+def _device_key(response: SSDPResponse) -> str:
+    return response.udn or response.location
+
+
+def _advertisement(response: SSDPResponse) -> Tuple[str, str]:
+    return (response.location, response.server)
+
+
+@contextmanager
+def _log_device_failures(location: str) -> Iterator[None]:
+    """
+    Swallow and log the errors that mean the port can't be mapped on this device, so
+    that the caller moves on to the next one.
+    """
+    try:
+        yield
+    except _NoInternalAddressMatchesDevice:
+        logger.debug(
+            "No internal addresses were managed by the UPnP device at %s", location,
+        )
+    except _WANServiceNotFound:
+        logger.debug(
+            "No WAN services managed by the UPnP device at %s", location,
+        )
+    except DeadlineExceeded:
+        # No time is left for any other device
+        raise
+    except PortMapFailed:
+        logger.debug(
+            "Failed to setup portmap on UPnP device at %s", location, exc_info=True,
+        )
+
+
+def _find_internal_ip_on_device_network(
+    location: str, interface_index: Optional[InterfaceIndex] = None
+) -> str:
+    """
+    For the UPnP device at the given location, return the internal IP address of this host
+    machine that can be used for a NAT mapping.
+
+    The address is looked up in ``interface_index``, or in a fresh index of the local
+    interfaces if none is given.
+    """
+    with measure(Phase.INTERNAL_ADDRESS, location):
+        parsed_url = urlparse(location)
+        if parsed_url.hostname is None:
+            raise _NoInternalAddressMatchesDevice(location)
+        if interface_index is None:
+            interface_index = InterfaceIndex()
+        try:
+            local_address = interface_index.lookup(parsed_url.hostname)
+        except ValueError:
+            # Not an IP address
+            local_address = None
+        if local_address is None:
+            raise _NoInternalAddressMatchesDevice(parsed_url.hostname)
+        return str(local_address.address)
+
+
+def _find_wan_service(
+    description: DeviceDescription,
+    required_service_names: Optional[Tuple[str, ...]],
+    fingerprint: Optional[Fingerprint] = None,
+) -> ServiceDescription:
     candidate_service_names = (
         required_service_names if required_service_names else WAN_SERVICE_NAMES
     )
+    services_by_name = {service.name: service for service in description.services}
+    # The service that worked on the same model comes first, even if it is not one of
+    # the WAN_SERVICE_NAMES
+    if fingerprint is not None and not required_service_names:
+        candidate_service_names = (fingerprint.service_name,) + candidate_service_names
     for service_name in candidate_service_names:
-        try:
-            return upnp_dev[service_name]
-        except KeyError:
-            continue
+        if service_name in services_by_name:
+            return services_by_name[service_name]
     else:
         raise _WANServiceNotFound()
 
 
-def _setup_device_port_map(
-    upnp_dev: upnpclient.upnp.Device,
-    port: int,
-    duration: int,
+def _get_wan_service(
+    description: DeviceDescription,
+    required_service_names: Optional[Tuple[str, ...]],
+    fingerprint: Optional[Fingerprint] = None,
+    deadline: Deadline = NO_DEADLINE,
+) -> SOAPService:
+    # The control URL is in the root description, so the actions can be called
+    # without fetching the service description
+    service = _find_wan_service(description, required_service_names, fingerprint)
+    return SOAPService(
+        service.control_url, service.service_type, service.name, deadline=deadline
+    )
+
+
+def _probe_device(
+    location: str,
     required_service_names: Optional[Tuple[str, ...]],
-) -> Tuple[str, str]:
+    interface_index: InterfaceIndex,
+    fingerprint_db: Optional[FingerprintDB] = None,
+    deadline: Deadline = NO_DEADLINE,
+) -> _DeviceProbe:
+    internal_ip = _find_internal_ip_on_device_network(location, interface_index)
+    description = _fetch_device_description(location, deadline)
+    model = DeviceModel.of(description)
+    fingerprint = None if fingerprint_db is None else fingerprint_db.lookup(model)
+    wan_service = _get_wan_service(
+        description, required_service_names, fingerprint, deadline
+    )
+    external_ip = external_ip_cache.get(wan_service.control_url)
+    external_ip_fetched = external_ip is None
+    if external_ip is None:
+        try:
+            external_ip = _fetch_external_ip(location, wan_service)
+        except BaseException:
+            wan_service.close()
+            raise
+    return _DeviceProbe(
+        location,
+        description.udn,
+        internal_ip,
+        wan_service,
+        external_ip,
+        model,
+        external_ip_fetched,
+    )
 
-    internal_ip = _find_internal_ip_on_device_network(upnp_dev)
-    wan_service = _get_wan_service(upnp_dev, required_service_names)
 
-    external_ip = wan_service.GetExternalIPAddress()["NewExternalIPAddress"]
+def _fetch_device_description(
+    location: str, deadline: Deadline = NO_DEADLINE
+) -> DeviceDescription:
+    phase = f"the description fetch from {location}"
+    try:
+        with measure(Phase.DESCRIPTION, location):
+            return fetch_device(
+                location, deadline.budget(phase, DEFAULT_HTTP_TIMEOUT)
+            ).description
+    except (ValueError, urllib.error.HTTPError) as exc:
+        # The description is invalid or the device refused it, it won't get better
+        # by asking again
+        raise _InvalidDeviceDescription(
+            f"Invalid device description at {location}"
+        ) from exc
+    except OSError as exc:
+        deadline.check(phase)
+        raise PortMapFailed(
+            f"Unable to fetch device description at {location}"
+        ) from exc
+
+
+def _get_external_ip(location: str, wan_service: SOAPService) -> str:
+    external_ip = external_ip_cache.get(wan_service.control_url)
+    if external_ip is not None:
+        return external_ip
+    return _fetch_external_ip(location, wan_service)
+
+
+def _fetch_external_ip(location: str, wan_service: SOAPService) -> str:
+    try:
+        with measure(Phase.EXTERNAL_IP, location):
+            external_ip = wan_service.GetExternalIPAddress()["NewExternalIPAddress"]
+    except (SOAPError, SOAPProtocolError) as exc:
+        logger.debug("Failed to get external IP address of device: %s", location)
+        raise PortMapFailed from exc
+    external_ip_cache.record(wan_service.control_url, external_ip)
+    return external_ip
+
+
+def _add_port_mapping(
+    probe: _DeviceProbe,
+    external_port: int,
+    internal_port: int,
+    protocol: str,
+    duration: int,
+) -> None:
+    with measure(Phase.ADD_PORT_MAPPING, probe.location):
+        probe.wan_service.AddPortMapping(
+            NewRemoteHost=probe.external_ip,
+            NewExternalPort=external_port,
+            NewProtocol=protocol,
+            NewInternalPort=internal_port,
+            NewInternalClient=probe.internal_ip,
+            NewEnabled="1",
+            NewPortMappingDescription=f"upnp-port-forward[{protocol}]",
+            NewLeaseDuration=duration,
+        )
 
-    for protocol in ("UDP", "TCP"):
+
+def _is_mapping_conflict(exc: SOAPError) -> bool:
+    return exc.args == (718, "ConflictInMappingEntry")
+
+
+def _existing_mapping_status(
+    existing_entry: Optional[PortMappingEntry],
+    internal_ip: str,
+    internal_port: int,
+    duration: int,
+) -> Optional[PortMapStatus]:
+    """
+    :return: the status of a mapping given the entry that already exists for its
+        external port, or None if the mapping should be added (or refreshed)
+    """
+    if existing_entry is None:
+        return None
+    if existing_entry.internal_client != internal_ip:
+        return PortMapStatus.CONFLICT
+    if existing_entry.internal_port != internal_port or not existing_entry.enabled:
+        return None
+    if existing_entry.lease_duration == 0:
+        return PortMapStatus.EXISTING
+    if 0 < duration <= existing_entry.lease_duration:
+        return PortMapStatus.EXISTING
+    # One of ours that expires sooner than requested
+    return None
+
+
+def _get_existing_entry(
+    probe: _DeviceProbe, external_port: int, protocol: str
+) -> Optional[PortMappingEntry]:
+    try:
+        return get_specific_port_mapping_entry(
+            probe.wan_service, external_port, protocol, probe.external_ip
+        )
+    except (SOAPError, SOAPProtocolError):
+        # Not all devices implement it, the mapping is then added without looking
+        logger.debug(
+            "Failed to look up the %s port mapping %d on device: %s",
+            protocol,
+            external_port,
+            probe.location,
+            exc_info=True,
+        )
+        return None
+
+
+def _supports_add_any_port_mapping(wan_service: SOAPService) -> bool:
+    if not wan_service.service_type.startswith(
+        _ADD_ANY_PORT_MAPPING_SERVICE_TYPE_PREFIX
+    ):
+        return False
+    version = wan_service.service_type.rsplit(":", 1)[-1]
+    return version.isdigit() and int(version) >= 2
+
+
+def _index_port_mappings(probe: _DeviceProbe) -> PortMappingIndex:
+    port_index = PortMappingIndex()
+    try:
+        for entry in iter_port_mapping_entries(probe.wan_service):
+            port_index.mark_taken(entry.external_port, entry.protocol)
+    except (SOAPError, SOAPProtocolError):
+        # The ports of the entries listed so far are still avoided, and a mapping
+        # conflicting with another one moves on to the next port
+        logger.debug(
+            "Failed to list the port mappings of device: %s",
+            probe.location,
+            exc_info=True,
+        )
+    return port_index
+
+
+def _add_any_port_mapping(
+    probe: _DeviceProbe,
+    external_port: int,
+    internal_port: int,
+    protocol: str,
+    duration: int,
+    get_port_index: Callable[[], PortMappingIndex],
+) -> Tuple[int, PortMapStatus, Optional[Exception]]:
+    """
+    Map the internal port on another external port than ``external_port``, which is
+    taken.
+
+    :return: the external port, and the status and error of the mapping
+    """
+    if _supports_add_any_port_mapping(probe.wan_service):
+        try:
+            with measure(Phase.ADD_PORT_MAPPING, probe.location):
+                reserved_port = probe.wan_service.AddAnyPortMapping(
+                    NewRemoteHost=probe.external_ip,
+                    NewExternalPort=external_port,
+                    NewProtocol=protocol,
+                    NewInternalPort=internal_port,
+                    NewInternalClient=probe.internal_ip,
+                    NewEnabled="1",
+                    NewPortMappingDescription=f"upnp-port-forward[{protocol}]",
+                    NewLeaseDuration=duration,
+                )["NewReservedPort"]
+            return int(reserved_port), PortMapStatus.MAPPED, None
+        except (SOAPError, SOAPProtocolError, KeyError, ValueError):
+            logger.debug(
+                "AddAnyPortMapping failed on device %s, looking for a free port",
+                probe.location,
+                exc_info=True,
+            )
+
+    port_index = get_port_index()
+    port_index.mark_taken(external_port, protocol)
+    error: Optional[Exception] = None
+    for _ in range(_MAX_FREE_PORT_ATTEMPTS):
+        free_port = port_index.reserve_free_port(protocol, external_port)
+        if free_port is None:
+            break
+        try:
+            _add_port_mapping(probe, free_port, internal_port, protocol, duration)
+        except SOAPError as exc:
+            if not _is_mapping_conflict(exc):
+                return external_port, PortMapStatus.FAILED, exc
+            # Taken since the mapping table was listed
+            error = exc
+            continue
+        except SOAPProtocolError as exc:
+            return external_port, PortMapStatus.FAILED, exc
+        return free_port, PortMapStatus.MAPPED, None
+    return external_port, PortMapStatus.CONFLICT, error
+
+
+def _add_port_mappings(
+    probe: _DeviceProbe, port: int, duration: int, protocols: Sequence[str]
+) -> Tuple[PortMapResult, ...]:
+    results = _add_port_mapping_batch(
+        probe,
+        [(port, port, protocol) for protocol in protocols],
+        duration,
+        max_concurrent_calls=len(protocols),
+    )
+    for result in results:
+        if result.status is PortMapStatus.CONFLICT:
+            logger.debug(
+                "NAT %s port mapping already configured%s, not overriding it",
+                result.protocol,
+                ""
+                if result.existing_entry is None
+                else f" for {result.existing_entry.internal_client}",
+            )
+        elif result.status is PortMapStatus.FAILED:
+            logger.debug(
+                "Failed to setup NAT %s portmap on device: %s",
+                result.protocol,
+                probe.location,
+            )
+            raise PortMapFailed from result.error
+    return results
+
+
+# The statuses of the mappings that are in place once the batch is done
+_SET_UP_STATUSES = (PortMapStatus.MAPPED, PortMapStatus.EXISTING)
+
+
+def _working_actions(
+    probe: _DeviceProbe, results: Iterable[PortMapResult]
+) -> Tuple[str, ...]:
+    """
+    :return: the actions that are known to work on the probed device that gave these
+        results
+    """
+    actions = ["GetExternalIPAddress"] if probe.external_ip_fetched else []
+    results = tuple(results)
+    if any(result.existing_entry is not None for result in results):
+        actions.append("GetSpecificPortMappingEntry")
+    if any(result.status is PortMapStatus.MAPPED for result in results):
+        actions.append("AddPortMapping")
+    return tuple(actions)
+
+
+def _format_statuses(results: Iterable[PortMapResult]) -> str:
+    return " ".join(f"{result.protocol}={result.status.value}" for result in results)
+
+
+def _add_port_mapping_batch(
+    probe: _DeviceProbe,
+    port_mappings: Sequence[Tuple[int, int, str]],
+    duration: int,
+    max_concurrent_calls: int,
+    reconcile: bool = True,
+    any_external_port: bool = False,
+) -> Tuple[PortMapResult, ...]:
+    # Unless reconcile is False, as when renewing mappings known to be ours, the
+    # existing entry of each mapping is looked up first.  With any_external_port, the
+    # mapping table is only listed once, by the first mapping that needs a free port.
+    port_index: Optional[PortMappingIndex] = None
+    port_index_lock = threading.Lock()
+
+    def get_port_index() -> PortMappingIndex:
+        nonlocal port_index
+        with port_index_lock:
+            if port_index is None:
+                port_index = _index_port_mappings(probe)
+            return port_index
+
+    def add_port_mapping(port_mapping: Tuple[int, int, str]) -> PortMapResult:
+        external_port, internal_port, protocol = port_mapping
+        existing_entry = (
+            _get_existing_entry(probe, external_port, protocol) if reconcile else None
+        )
+        existing_status = _existing_mapping_status(
+            existing_entry, probe.internal_ip, internal_port, duration
+        )
+        if existing_status is PortMapStatus.CONFLICT and any_external_port:
+            return map_any_external_port(external_port, internal_port, protocol)
+        if existing_status is not None:
+            return PortMapResult(
+                external_port,
+                internal_port,
+                protocol,
+                existing_status,
+                ipaddress.ip_address(probe.internal_ip),
+                ipaddress.ip_address(probe.external_ip),
+                existing_entry=existing_entry,
+            )
+
+        status = PortMapStatus.MAPPED
+        error: Optional[Exception] = None
         try:
-            wan_service.AddPortMapping(
-                NewRemoteHost=external_ip,
-                NewExternalPort=port,
-                NewProtocol=protocol,
-                NewInternalPort=port,
-                NewInternalClient=internal_ip,
-                NewEnabled="1",
-                NewPortMappingDescription=f"upnp-port-forward[{protocol}]",
-                NewLeaseDuration=duration,
-            )
-        except upnpclient.soap.SOAPError as exc:
-            if exc.args == (718, "ConflictInMappingEntry"):
-                # An entry already exists with the parameters we specified. Maybe the router
-                # didn't clean it up after it expired or it has been configured by other piece
-                # of software, either way we should not override it.
+            _add_port_mapping(probe, external_port, internal_port, protocol, duration)
+        except SOAPError as exc:
+            if _is_mapping_conflict(exc):
+                # An entry was added by another host since it was looked up, or the
+                # device could not be asked.  Maybe the router didn't clean it up after
+                # it expired or it has been configured by other piece of software,
+                # either way we should not override it.
                 # https://tools.ietf.org/id/draft-ietf-pcp-upnp-igd-interworking-07.html#errors
-                logger.debug("NAT port mapping already configured, not overriding it")
-                continue
+                status, error = PortMapStatus.CONFLICT, exc
             else:
-                logger.debug(
-                    "Failed to setup NAT portmap on device: %s", upnp_dev.location,
-                )
-                raise PortMapFailed from exc
+                status, error = PortMapStatus.FAILED, exc
+        except SOAPProtocolError as exc:
+            status, error = PortMapStatus.FAILED, exc
+        if status is PortMapStatus.CONFLICT and any_external_port:
+            return map_any_external_port(external_port, internal_port, protocol)
+        return PortMapResult(
+            external_port,
+            internal_port,
+            protocol,
+            status,
+            ipaddress.ip_address(probe.internal_ip),
+            ipaddress.ip_address(probe.external_ip),
+            error,
+        )
+
+    def map_any_external_port(
+        external_port: int, internal_port: int, protocol: str
+    ) -> PortMapResult:
+        external_port, status, error = _add_any_port_mapping(
+            probe, external_port, internal_port, protocol, duration, get_port_index
+        )
+        return PortMapResult(
+            external_port,
+            internal_port,
+            protocol,
+            status,
+            ipaddress.ip_address(probe.internal_ip),
+            ipaddress.ip_address(probe.external_ip),
+            error,
+        )
 
-    return internal_ip, external_ip
+    max_workers = max(1, min(max_concurrent_calls, len(port_mappings)))
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="upnp-port-forward"
+    ) as executor:
+        return tuple(executor.map(add_port_mapping, port_mappings))
@@ -0,0 +1,384 @@
+"""
+A host-wide daemon owning the discovery, the device cache and the lease renewals,
+so that the router sees a single client however many processes map ports.
+
+Processes talk to it over a Unix domain socket with :class:`DaemonClient`.  The
+mappings requested over a connection are kept as long as the connection is open,
+and deleted once no connection holds them anymore.
+
+Run it with ``python -m upnp_port_forward.daemon``.
+"""
+import argparse
+from collections import defaultdict
+import ipaddress
+import json
+import logging
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, Optional, Sequence, Set, Tuple, Union
+
+from .cache import DeviceCache
+from .client import (
+    DEFAULT_PORTMAP_DURATION,
+    PortMapResult,
+    PortMapStatus,
+    _normalize_port_specs,
+    get_external_ip,
+)
+from .exceptions import PortMapFailed
+from .manager import PortMapManager, PortMapping
+from .mappings import PortMappingEntry
+from .netlink import NetworkWatcher
+from .typing import AnyIPAddress, PortSpec
+
+
+def _default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"upnp-port-forward-{os.getuid()}.sock")
+
+
+DEFAULT_DAEMON_SOCKET = _default_socket_path()
+DEFAULT_CLIENT_TIMEOUT = 60  # seconds
+
+# Only the processes of the same user can request mappings by default
+_DEFAULT_SOCKET_MODE = 0o600
+
+
+logger = logging.getLogger("upnp_port_forward.daemon")
+
+
+def _result_to_json(result: PortMapResult) -> Dict[str, Any]:
+    return {
+        "external_port": result.external_port,
+        "internal_port": result.internal_port,
+        "protocol": result.protocol,
+        "status": result.status.value,
+        "internal_ip": str(result.internal_ip),
+        "external_ip": str(result.external_ip),
+        "error": None if result.error is None else str(result.error),
+        "existing_entry": None
+        if result.existing_entry is None
+        else result.existing_entry._asdict(),
+    }
+
+
+def _result_from_json(raw_result: Dict[str, Any]) -> PortMapResult:
+    return PortMapResult(
+        external_port=raw_result["external_port"],
+        internal_port=raw_result["internal_port"],
+        protocol=raw_result["protocol"],
+        status=PortMapStatus(raw_result["status"]),
+        internal_ip=ipaddress.ip_address(raw_result["internal_ip"]),
+        external_ip=ipaddress.ip_address(raw_result["external_ip"]),
+        error=None
+        if raw_result["error"] is None
+        else PortMapFailed(raw_result["error"]),
+        existing_entry=None
+        if raw_result["existing_entry"] is None
+        else PortMappingEntry(**raw_result["existing_entry"]),
+    )
+
+
+class PortMapDaemon:
+    """
+    Serve the mapping requests of the local processes on ``socket_path`` with a
+    single :class:`~upnp_port_forward.PortMapManager`.
+    """
+
+    def __init__(
+        self,
+        socket_path: Union[str, pathlib.Path] = DEFAULT_DAEMON_SOCKET,
+        manager: Optional[PortMapManager] = None,
+        socket_mode: int = _DEFAULT_SOCKET_MODE,
+    ) -> None:
+        self.socket_path = str(socket_path)
+        self.manager = PortMapManager() if manager is None else manager
+        # The number of connections holding each mapping
+        self._holders: Dict[PortMapping, int] = defaultdict(int)
+        # Held while the manager adds or removes mappings too, so that a mapping that
+        # another connection removes is never reported as held
+        self._lock = threading.Lock()
+
+        _remove_stale_socket(self.socket_path)
+        self._server = _UnixServer(self.socket_path, _make_handler(self))
+        os.chmod(self.socket_path, socket_mode)
+
+    def serve_forever(self) -> None:
+        """
+        Renew the mappings from a background thread and serve the requests until
+        :meth:`shutdown` is called.
+        """
+        self.manager.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def shutdown(self) -> None:
+        """
+        Stop serving from another thread.
+        """
+        self._server.shutdown()
+
+    def close(self, delete_mappings: bool = True) -> None:
+        """
+        Stop renewing the mappings, deleting them unless ``delete_mappings`` is
+        False, and remove the socket.
+        """
+        self.manager.stop(delete_mappings=delete_mappings)
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def add(
+        self, port_mappings: Sequence[PortMapping], held: Set[PortMapping]
+    ) -> Tuple[PortMapResult, ...]:
+        with self._lock:
+            results = self.manager.add(port_mappings)
+            managed_mappings = set(self.manager.mappings)
+            for result in results:
+                port_mapping = (
+                    result.external_port,
+                    result.internal_port,
+                    result.protocol,
+                )
+                if port_mapping in managed_mappings and port_mapping not in held:
+                    held.add(port_mapping)
+                    self._holders[port_mapping] += 1
+        return results
+
+    def remove(
+        self, port_mappings: Iterable[PortMapping], held: Set[PortMapping]
+    ) -> None:
+        """
+        Let go of the mappings held by a connection, and delete those that no other
+        connection holds.
+        """
+        unheld = []
+        with self._lock:
+            for port_mapping in port_mappings:
+                if port_mapping not in held:
+                    continue
+                held.discard(port_mapping)
+                self._holders[port_mapping] -= 1
+                if self._holders[port_mapping] <= 0:
+                    del self._holders[port_mapping]
+                    unheld.append(port_mapping)
+            if unheld:
+                self.manager.remove(unheld)
+
+    def handle_request(
+        self, request: Dict[str, Any], held: Set[PortMapping]
+    ) -> Dict[str, Any]:
+        method = request.get("method")
+        try:
+            if method == "add":
+                port_mappings = _normalize_port_specs(
+                    _port_spec(port_spec) for port_spec in request["ports"]
+                )
+                results = self.add(port_mappings, held)
+                return {"results": [_result_to_json(result) for result in results]}
+            elif method == "remove":
+                port_mappings = _normalize_port_specs(
+                    _port_spec(port_spec) for port_spec in request["ports"]
+                )
+                self.remove(port_mappings, held)
+                return {}
+            elif method == "external_ip":
+                external_ip = get_external_ip(
+                    self.manager.required_service_names, self.manager.device_cache
+                )
+                return {"external_ip": str(external_ip)}
+            else:
+                return {"error": f"Unknown method: {method}"}
+        except PortMapFailed as exc:
+            return {"error": str(exc) or type(exc).__name__}
+        except (KeyError, TypeError, ValueError) as exc:
+            return {"error": f"Invalid request: {exc}"}
+
+
+def _port_spec(raw_port_spec: Any) -> PortSpec:
+    if isinstance(raw_port_spec, int):
+        return raw_port_spec
+    external_port, internal_port, protocol = raw_port_spec
+    return (int(external_port), int(internal_port), str(protocol))
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except FileNotFoundError:
+            return
+        except ConnectionRefusedError:
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise PortMapFailed(f"{socket_path} exists and is not a socket")
+            # Left behind by a daemon that is gone
+            os.unlink(socket_path)
+            return
+    raise PortMapFailed(f"A port mapping daemon is already running on {socket_path}")
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(daemon: PortMapDaemon) -> Any:
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            held: Set[PortMapping] = set()
+            try:
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        response: Dict[str, Any] = {"error": "Invalid JSON request"}
+                    else:
+                        response = daemon.handle_request(request, held)
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+                    self.wfile.flush()
+            except OSError:
+                logger.debug("Lost a client connection", exc_info=True)
+            finally:
+                # The mappings of a process that exited or crashed are not held anymore
+                daemon.remove(tuple(held), held)
+
+    return Handler
+
+
+class DaemonClient:
+    """
+    Request mappings from a :class:`PortMapDaemon`.  The mappings added through a
+    client are kept until they are removed or the client is closed.
+
+    :raise PortMapFailed: if no daemon listens on ``socket_path``
+    """
+
+    def __init__(
+        self,
+        socket_path: Union[str, pathlib.Path] = DEFAULT_DAEMON_SOCKET,
+        timeout: Optional[float] = DEFAULT_CLIENT_TIMEOUT,
+    ) -> None:
+        self.socket_path = str(socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(self.socket_path)
+        except OSError as exc:
+            self._sock.close()
+            raise PortMapFailed(
+                f"No port mapping daemon on {self.socket_path}"
+            ) from exc
+        self._file = self._sock.makefile("rwb")
+        self._lock = threading.Lock()
+
+    def add(self, ports: Iterable[PortSpec]) -> Tuple[PortMapResult, ...]:
+        """
+        Map the given ports (see :func:`upnp_port_forward.setup_port_maps`) and keep
+        them renewed by the daemon.
+
+        :raise PortMapFailed: if no device could add any of the mappings
+        """
+        response = self._call("add", ports=list(ports))
+        return tuple(
+            _result_from_json(raw_result) for raw_result in response["results"]
+        )
+
+    def remove(self, ports: Iterable[PortSpec]) -> None:
+        self._call("remove", ports=list(ports))
+
+    def get_external_ip(self) -> AnyIPAddress:
+        return ipaddress.ip_address(self._call("external_ip")["external_ip"])
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self) -> "DaemonClient":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _call(self, method: str, **arguments: Any) -> Dict[str, Any]:
+        request = json.dumps(dict(arguments, method=method)).encode() + b"\n"
+        with self._lock:
+            try:
+                self._file.write(request)
+                self._file.flush()
+                line = self._file.readline()
+            except OSError as exc:
+                raise PortMapFailed(
+                    f"Lost the port mapping daemon on {self.socket_path}"
+                ) from exc
+        if not line:
+            raise PortMapFailed(f"Lost the port mapping daemon on {self.socket_path}")
+        response: Dict[str, Any] = json.loads(line)
+        if "error" in response:
+            raise PortMapFailed(response["error"])
+        return response
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Map ports on behalf of the processes of this host."
+    )
+    parser.add_argument("--socket", default=DEFAULT_DAEMON_SOCKET)
+    parser.add_argument(
+        "--socket-mode",
+        type=lambda mode: int(mode, 8),
+        default=_DEFAULT_SOCKET_MODE,
+        help="permissions of the socket, in octal (default: 600)",
+    )
+    parser.add_argument("--duration", type=int, default=DEFAULT_PORTMAP_DURATION)
+    parser.add_argument("--device-cache", help="path of the on-disk device cache")
+    parser.add_argument(
+        "--service-name",
+        action="append",
+        dest="service_names",
+        help="only use the services with this name (can be repeated)",
+    )
+    parser.add_argument(
+        "--watch-network",
+        action="store_true",
+        help="map the ports again as soon as the network changes (Linux only)",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    manager = PortMapManager(
+        duration=args.duration,
+        required_service_names=tuple(args.service_names)
+        if args.service_names
+        else None,
+        device_cache=None
+        if args.device_cache is None
+        else DeviceCache(args.device_cache),
+    )
+    daemon = PortMapDaemon(args.socket, manager, args.socket_mode)
+    watcher = NetworkWatcher(manager) if args.watch_network else None
+    if watcher is not None:
+        watcher.start()
+    # Leave serve_forever() through SystemExit, so that the mappings get deleted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Serving port mapping requests on %s", args.socket)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
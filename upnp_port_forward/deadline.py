@@ -0,0 +1,51 @@
+"""
+An overall time budget for a call that goes through discovery, device probing and
+SOAP calls, so that a hung device can't hold it up for the sum of their timeouts.
+"""
+import math
+import time
+from typing import Optional
+
+from .exceptions import DeadlineExceeded
+
+
+class Deadline:
+    """
+    The time left to a call, which each of its network operations gets at most,
+    ``timeout`` seconds from now, or unlimited if ``timeout`` is None.
+    """
+
+    def __init__(self, timeout: Optional[float] = None) -> None:
+        self.timeout = timeout
+        self.expires_at = math.inf if timeout is None else time.monotonic() + timeout
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self, phase: str, timeout: float) -> float:
+        """
+        :return: ``timeout``, cut down to the time left
+        :raise DeadlineExceeded: if no time is left for ``phase``
+        """
+        self.check(phase)
+        return min(timeout, self.remaining())
+
+    def check(self, phase: str) -> None:
+        """
+        :raise DeadlineExceeded: if the time ran out, during ``phase``
+        """
+        if self.expired:
+            raise self.exceeded(phase)
+
+    def exceeded(self, phase: str) -> DeadlineExceeded:
+        return DeadlineExceeded(
+            f"Timed out after {self.timeout}s during {phase}", phase
+        )
+
+
+# The deadline of the calls without a timeout
+NO_DEADLINE = Deadline()
@@ -0,0 +1,200 @@
+"""
+Lightweight model of UPnP devices, built from their root description.
+
+Unlike ``upnpclient.Device``, which fetches and parses the SCPD of every service up
+front, the SCPD of a service is only fetched when its actions are asked for.
+"""
+import http.client
+import threading
+from typing import Dict, FrozenSet, Iterator, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin, urlparse
+import urllib.request
+from xml.etree import ElementTree
+
+DEFAULT_HTTP_TIMEOUT = 10  # seconds
+
+# The service types that can map ports, in any version
+WAN_CONNECTION_SERVICE_TYPE_PREFIXES: Tuple[str, ...] = (
+    "urn:schemas-upnp-org:service:WANIPConnection:",
+    "urn:schemas-upnp-org:service:WANPPPConnection:",
+)
+
+
+class ServiceDescription(NamedTuple):
+    service_type: str
+    service_id: str
+    control_url: str
+    scpd_url: str
+
+    @property
+    def name(self) -> str:
+        """
+        The last part of the service id, e.g. ``WANIPConn1``, as used in
+        ``WAN_SERVICE_NAMES`` and by ``upnpclient``.
+        """
+        return self.service_id.rsplit(":", 1)[-1]
+
+    @property
+    def is_wan_connection(self) -> bool:
+        return self.service_type.startswith(WAN_CONNECTION_SERVICE_TYPE_PREFIXES)
+
+
+class DeviceDescription(NamedTuple):
+    location: str
+    udn: str
+    friendly_name: str
+    manufacturer: str
+    model_name: str
+    services: Tuple[ServiceDescription, ...]
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _children(element: ElementTree.Element, name: str) -> Iterator[ElementTree.Element]:
+    return (child for child in element if _local_name(child.tag) == name)
+
+
+def _child_text(element: ElementTree.Element, name: str) -> str:
+    for child in _children(element, name):
+        return (child.text or "").strip()
+    return ""
+
+
+def _child(element: ElementTree.Element, name: str) -> Optional[ElementTree.Element]:
+    for child in _children(element, name):
+        return child
+    return None
+
+
+def parse_device_description(location: str, content: bytes) -> DeviceDescription:
+    """
+    Parse the root device description fetched from ``location``.  The services of the
+    root device and of all its embedded devices are listed, with their URLs resolved.
+
+    :raise ValueError: if the description is not valid XML or has no root device
+    """
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as exc:
+        raise ValueError(f"Invalid device description at {location}: {exc}") from exc
+
+    device = _child(root, "device")
+    if device is None:
+        raise ValueError(f"No root device described at {location}")
+
+    # If no URL Base is given, the UPnP specification says: "the base URL is the URL
+    # from which the device description was retrieved"
+    url_base = _child_text(root, "URLBase") or location
+
+    services = tuple(
+        ServiceDescription(
+            service_type=_child_text(service, "serviceType"),
+            service_id=_child_text(service, "serviceId"),
+            control_url=urljoin(url_base, _child_text(service, "controlURL")),
+            scpd_url=urljoin(url_base, _child_text(service, "SCPDURL")),
+        )
+        for service in device.iter()
+        if _local_name(service.tag) == "service"
+    )
+    return DeviceDescription(
+        location=location,
+        udn=_child_text(device, "UDN"),
+        friendly_name=_child_text(device, "friendlyName"),
+        manufacturer=_child_text(device, "manufacturer"),
+        model_name=_child_text(device, "modelName"),
+        services=services,
+    )
+
+
+def parse_service_actions(scpd_url: str, content: bytes) -> FrozenSet[str]:
+    """
+    Parse the names of the actions listed in a service description (SCPD).
+
+    :raise ValueError: if the description is not valid XML
+    """
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as exc:
+        raise ValueError(f"Invalid service description at {scpd_url}: {exc}") from exc
+    return frozenset(
+        _child_text(action, "name")
+        for action in root.iter()
+        if _local_name(action.tag) == "action"
+    )
+
+
+def http_get(url: str, timeout: float = DEFAULT_HTTP_TIMEOUT) -> bytes:
+    """
+    Fetch a description from a device.
+
+    :raise OSError: if the device could not be reached or answered with an error
+    :raise ValueError: if ``url`` is not an HTTP URL
+    """
+    # The URLs come from the network, don't let them point at local files
+    if urlparse(url).scheme != "http":
+        raise ValueError(f"Unsupported description URL: {url}")
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            content: bytes = response.read()
+            return content
+    except http.client.HTTPException as exc:
+        raise OSError(f"Invalid HTTP response from {url}: {exc}") from exc
+
+
+class Device:
+    """
+    A UPnP device, known from its root description only.
+
+    The SCPD of a service is fetched the first time :meth:`get_actions` is called
+    for it, and kept for the next calls.
+    """
+
+    def __init__(
+        self, description: DeviceDescription, timeout: float = DEFAULT_HTTP_TIMEOUT
+    ) -> None:
+        self.description = description
+        self.timeout = timeout
+        self._actions: Dict[str, FrozenSet[str]] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<Device {self.description.friendly_name!r} at {self.location}>"
+
+    @property
+    def location(self) -> str:
+        return self.description.location
+
+    @property
+    def services(self) -> Tuple[ServiceDescription, ...]:
+        return self.description.services
+
+    def get_actions(self, service: ServiceDescription) -> FrozenSet[str]:
+        """
+        :return: the names of the actions of ``service``
+        :raise OSError: if the SCPD could not be fetched
+        :raise ValueError: if the SCPD could not be parsed
+        """
+        with self._lock:
+            if service.scpd_url in self._actions:
+                return self._actions[service.scpd_url]
+        actions = parse_service_actions(
+            service.scpd_url, http_get(service.scpd_url, self.timeout)
+        )
+        with self._lock:
+            self._actions[service.scpd_url] = actions
+        return actions
+
+
+def fetch_device(location: str, timeout: float = DEFAULT_HTTP_TIMEOUT) -> Device:
+    """
+    Fetch and parse the root device description at ``location``, without any of the
+    service descriptions.
+
+    :raise OSError: if the description could not be fetched
+    :raise ValueError: if the description could not be parsed
+    """
+    return Device(
+        parse_device_description(location, http_get(location, timeout)), timeout
+    )
@@ -4,3 +4,10 @@ class PortMapFailed(Exception):
 
 class NoPortMapServiceFound(Exception):
     pass
+
+
+class DeadlineExceeded(PortMapFailed):
+    def __init__(self, message: str, phase: str) -> None:
+        super().__init__(message)
+        # What was going on when the time ran out, e.g. "discovery"
+        self.phase = phase
@@ -0,0 +1,143 @@
+"""
+On-disk database of the WAN service and the actions that work on each router model,
+learned while mapping ports or in bulk by the export tool.
+"""
+import json
+import logging
+import pathlib
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple, Union
+
+from .cache import dump_json_atomically
+from .description import DeviceDescription
+
+_FINGERPRINT_DB_VERSION = 1
+
+
+logger = logging.getLogger("upnp_port_forward.fingerprints")
+
+
+class DeviceModel(NamedTuple):
+    manufacturer: str
+    model_name: str
+    friendly_name: str
+
+    @classmethod
+    def of(cls, description: DeviceDescription) -> "DeviceModel":
+        return cls(
+            description.manufacturer, description.model_name, description.friendly_name
+        )
+
+    @property
+    def key(self) -> str:
+        return "\n".join(self)
+
+
+class Fingerprint(NamedTuple):
+    manufacturer: str
+    model_name: str
+    friendly_name: str
+    service_name: str
+    # The actions of the service that worked, or that its description lists when
+    # recorded by the export tool
+    actions: Tuple[str, ...]
+    updated_at: float
+
+    @property
+    def model(self) -> DeviceModel:
+        return DeviceModel(self.manufacturer, self.model_name, self.friendly_name)
+
+
+class FingerprintDB:
+    """
+    Remember the WAN service name and the working actions of each router model, keyed
+    by manufacturer, model name and friendly name, so that the right service of a
+    known model is used straight away, even when its name is not in
+    ``WAN_SERVICE_NAMES``.
+
+    The friendly name is often set by the owner of the router, so a model is also
+    matched by its manufacturer and model name alone.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]) -> None:
+        self.path = pathlib.Path(path).expanduser()
+        self._lock = threading.Lock()
+
+    def entries(self) -> Tuple[Fingerprint, ...]:
+        with self._lock:
+            return tuple(self._load().values())
+
+    def lookup(self, model: DeviceModel) -> Optional[Fingerprint]:
+        """
+        :return: the fingerprint of the model, or else the one that changed last for
+            another device of the same manufacturer and model name
+        """
+        with self._lock:
+            fingerprints = self._load()
+        if model.key in fingerprints:
+            return fingerprints[model.key]
+        same_models = [
+            fingerprint
+            for fingerprint in fingerprints.values()
+            if fingerprint.model[:2] == model[:2]
+        ]
+        if not same_models:
+            return None
+        return max(same_models, key=lambda fingerprint: fingerprint.updated_at)
+
+    def record(
+        self, model: DeviceModel, service_name: str, actions: Iterable[str]
+    ) -> None:
+        """
+        Record that ``actions`` worked on the ``service_name`` of the model.  They are
+        added to those already known as long as the service stays the same, and the
+        database is only written when that changes the fingerprint.
+        """
+        with self._lock:
+            fingerprints = self._load()
+            known_actions = set(actions)
+            previous = fingerprints.get(model.key)
+            if previous is not None and previous.service_name == service_name:
+                known_actions.update(previous.actions)
+            fingerprint = Fingerprint(
+                *model, service_name, tuple(sorted(known_actions)), time.time()
+            )
+            if previous is not None and previous[:-1] == fingerprint[:-1]:
+                return
+            fingerprints[model.key] = fingerprint
+            self._save(fingerprints)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._save({})
+
+    def _load(self) -> Dict[str, Fingerprint]:
+        try:
+            with self.path.open() as db_file:
+                raw_db = json.load(db_file)
+            if raw_db["version"] != _FINGERPRINT_DB_VERSION:
+                return {}
+            fingerprints = (
+                Fingerprint(
+                    **dict(raw_fingerprint, actions=tuple(raw_fingerprint["actions"]))
+                )
+                for raw_fingerprint in raw_db["fingerprints"]
+            )
+            return {fingerprint.model.key: fingerprint for fingerprint in fingerprints}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.debug(
+                "Ignoring unreadable UPnP fingerprint database at %s", self.path
+            )
+            return {}
+
+    def _save(self, fingerprints: Dict[str, Fingerprint]) -> None:
+        raw_db = {
+            "version": _FINGERPRINT_DB_VERSION,
+            "fingerprints": [
+                fingerprint._asdict() for fingerprint in fingerprints.values()
+            ],
+        }
+        dump_json_atomically(raw_db, self.path)
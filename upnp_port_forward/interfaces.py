@@ -0,0 +1,161 @@
+"""
+Index of the addresses of this host, to find the one on the same network as a UPnP
+device.
+"""
+from bisect import bisect_right
+import ipaddress
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from .typing import AnyIPAddress, AnyIPNetwork
+
+logger = logging.getLogger("upnp_port_forward.interfaces")
+
+
+class LocalAddress(NamedTuple):
+    interface: str
+    address: AnyIPAddress
+    network: AnyIPNetwork
+
+
+def _prefix_length(version: int, netmask: Optional[str]) -> int:
+    max_length = 32 if version == 4 else 128
+    if not netmask:
+        return max_length
+    # netifaces gives IPv6 netmasks either as an address or as "<address>/<length>"
+    mask, _, length = netmask.partition("/")
+    if length:
+        return int(length)
+    mask_bits = int(ipaddress.ip_address(mask))
+    return max_length - (~mask_bits & ((1 << max_length) - 1)).bit_length()
+
+
+def _strip_zone(address: str) -> str:
+    # Link-local IPv6 addresses are scoped to an interface, e.g. "fe80::1%eth0"
+    return address.split("%", 1)[0]
+
+
+def get_local_addresses() -> Tuple[LocalAddress, ...]:
+    """
+    List the IPv4 and IPv6 addresses of all the interfaces of this host, with the
+    network their netmask puts them on.
+    """
+    # Only loaded once the addresses are needed, to keep importing the package cheap
+    import netifaces
+
+    local_addresses: List[LocalAddress] = []
+    for interface in netifaces.interfaces():
+        interface_addresses = netifaces.ifaddresses(interface)
+        for family in (netifaces.AF_INET, netifaces.AF_INET6):
+            for item in interface_addresses.get(family, ()):
+                try:
+                    address = ipaddress.ip_address(_strip_zone(item["addr"]))
+                    prefix_length = _prefix_length(address.version, item.get("netmask"))
+                    network = ipaddress.ip_network(
+                        f"{address}/{prefix_length}", strict=False
+                    )
+                except (KeyError, ValueError):
+                    logger.debug(
+                        "Ignoring address of interface %s: %s", interface, item
+                    )
+                    continue
+                local_addresses.append(LocalAddress(interface, address, network))
+    return tuple(local_addresses)
+
+
+def get_default_gateway() -> Optional[str]:
+    """
+    :return: the address of the default IPv4 gateway, if there is one
+    """
+    import netifaces
+
+    gateway = netifaces.gateways().get("default", {}).get(netifaces.AF_INET)
+    if gateway is None:
+        return None
+    return str(gateway[0])
+
+
+# For each IP version: the sorted start of consecutive address ranges, and the local
+# address whose network most specifically covers each range (None for gaps)
+_RangeIndex = Tuple[List[int], List[Optional[LocalAddress]]]
+
+
+def _network_contains(network: AnyIPNetwork, address: int) -> bool:
+    return int(network.network_address) <= address <= int(network.broadcast_address)
+
+
+def _build_range_index(local_addresses: Iterable[LocalAddress]) -> _RangeIndex:
+    local_addresses = tuple(local_addresses)
+    boundaries = sorted(
+        {
+            boundary
+            for local_address in local_addresses
+            for boundary in (
+                int(local_address.network.network_address),
+                int(local_address.network.broadcast_address) + 1,
+            )
+        }
+    )
+    range_owners: List[Optional[LocalAddress]] = []
+    for start in boundaries:
+        covering = [
+            local_address
+            for local_address in local_addresses
+            if _network_contains(local_address.network, start)
+        ]
+        # The first address wins when several are on the same network
+        range_owners.append(
+            max(covering, key=lambda local_address: local_address.network.prefixlen)
+            if covering
+            else None
+        )
+    return boundaries, range_owners
+
+
+class InterfaceIndex:
+    """
+    The local addresses of this host, indexed for longest-prefix-match lookups.
+
+    Networks can be nested but never partially overlap, so they are flattened into
+    disjoint address ranges, each owned by the most specific network covering it,
+    and a lookup is a binary search over those ranges.
+
+    The index is a snapshot: call :meth:`refresh` to pick up interface changes.
+    """
+
+    def __init__(
+        self, local_addresses: Optional[Iterable[LocalAddress]] = None
+    ) -> None:
+        self.local_addresses: Tuple[LocalAddress, ...] = ()
+        self._ranges: Dict[int, _RangeIndex] = {}
+        self.refresh(local_addresses)
+
+    def refresh(self, local_addresses: Optional[Iterable[LocalAddress]] = None) -> None:
+        """
+        Rebuild the index, from the given addresses or else from the interfaces of
+        this host.
+        """
+        if local_addresses is None:
+            local_addresses = get_local_addresses()
+        self.local_addresses = local_addresses = tuple(local_addresses)
+        self._ranges = {
+            version: _build_range_index(
+                local_address
+                for local_address in local_addresses
+                if local_address.address.version == version
+            )
+            for version in (4, 6)
+        }
+
+    def lookup(self, address: Union[str, AnyIPAddress]) -> Optional[LocalAddress]:
+        """
+        :return: the local address on the most specific network that contains
+            ``address``, or None if it isn't on any of the networks of this host
+        """
+        if isinstance(address, str):
+            address = ipaddress.ip_address(_strip_zone(address))
+        boundaries, range_owners = self._ranges[address.version]
+        position = bisect_right(boundaries, int(address)) - 1
+        if position < 0:
+            return None
+        return range_owners[position]
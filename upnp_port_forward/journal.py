@@ -0,0 +1,150 @@
+"""
+On-disk journal of the port mappings this host set up, so that a restarted process
+can take them over from the device they are on, without discovery.
+"""
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from .cache import write_text_atomically
+
+_JOURNAL_VERSION = 1
+# Renewals append a record each time, the journal is rewritten with only the live
+# entries after this many records
+_COMPACTION_THRESHOLD = 1000
+
+
+logger = logging.getLogger("upnp_port_forward.journal")
+
+
+class JournalEntry(NamedTuple):
+    location: str
+    udn: str
+    service_name: str
+    service_type: str
+    control_url: str
+    external_port: int
+    internal_port: int
+    protocol: str
+    # The address of this host the mapping points at
+    internal_client: str
+    # time.time() of the end of the lease, 0 for a permanent mapping
+    expires_at: float
+
+    @property
+    def key(self) -> Tuple[int, str]:
+        return (self.external_port, self.protocol)
+
+
+class MappingJournal:
+    """
+    Append-only journal of the mappings that are set up, with the device and WAN
+    service they are on and the end of their lease.
+
+    Each change is appended as a line and synced to disk before moving on, so a
+    crash loses at most the line being written, which is skipped when the journal
+    is read back.  The journal is rewritten with only the live entries, atomically,
+    on the first change of each process and then every ``_COMPACTION_THRESHOLD``
+    changes.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]) -> None:
+        self.path = pathlib.Path(path).expanduser()
+        self._lock = threading.Lock()
+        # Records appended since the journal was last rewritten, None until it is
+        self._appended: Optional[int] = None
+
+    def entries(self) -> Tuple[JournalEntry, ...]:
+        """
+        :return: the entries whose lease has not ended
+        """
+        with self._lock:
+            return tuple(self._load().values())
+
+    def record(self, entries: Iterable[JournalEntry]) -> None:
+        """
+        Record that the mappings were set up, or their lease renewed.
+        """
+        self._append({"op": "add", **entry._asdict()} for entry in entries)
+
+    def forget(self, keys: Iterable[Tuple[int, str]]) -> None:
+        """
+        Record that the mappings of the (external port, protocol) ``keys`` are not
+        ours anymore.
+        """
+        self._append(
+            {"op": "delete", "external_port": external_port, "protocol": protocol}
+            for external_port, protocol in keys
+        )
+
+    def compact(self) -> None:
+        """
+        Rewrite the journal with only the live entries.
+        """
+        with self._lock:
+            self._rewrite(self._load())
+
+    def _append(self, records: Iterable[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        if not lines:
+            return
+        with self._lock:
+            # Rewriting first also gets rid of a line left truncated by a crash, which
+            # the new lines would otherwise be appended to
+            if self._appended is None or self._appended >= _COMPACTION_THRESHOLD:
+                self._rewrite(self._load())
+            with self.path.open("a") as journal_file:
+                journal_file.write(lines)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._appended = (self._appended or 0) + lines.count("\n")
+
+    def _rewrite(self, entries: Dict[Tuple[int, str], JournalEntry]) -> None:
+        records: List[Dict[str, Any]] = [{"version": _JOURNAL_VERSION}]
+        records.extend({"op": "add", **entry._asdict()} for entry in entries.values())
+        write_text_atomically(
+            "".join(json.dumps(record) + "\n" for record in records), self.path
+        )
+        self._appended = 0
+
+    def _load(self) -> Dict[Tuple[int, str], JournalEntry]:
+        try:
+            with self.path.open() as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return {}
+        except OSError:
+            logger.debug("Ignoring unreadable UPnP mapping journal at %s", self.path)
+            return {}
+
+        entries: Dict[Tuple[int, str], JournalEntry] = {}
+        for index, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+                if index == 0:
+                    if record["version"] != _JOURNAL_VERSION:
+                        return {}
+                    continue
+                op = record.pop("op")
+                if op == "add":
+                    entry = JournalEntry(**record)
+                    entries[entry.key] = entry
+                elif op == "delete":
+                    entries.pop((record["external_port"], record["protocol"]), None)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # e.g. the line being written when the process crashed
+                logger.debug(
+                    "Skipping unreadable line %d of UPnP mapping journal at %s",
+                    index + 1,
+                    self.path,
+                )
+        now = time.time()
+        return {
+            key: entry
+            for key, entry in entries.items()
+            if entry.expires_at == 0 or entry.expires_at > now
+        }
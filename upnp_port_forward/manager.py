@@ -0,0 +1,832 @@
+"""
+Keep port mappings alive by renewing their leases before they expire.
+"""
+import asyncio
+from collections import defaultdict
+import logging
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from .cache import DeviceCache
+from .client import (
+    DEFAULT_MAX_CONCURRENT_CALLS,
+    DEFAULT_PORTMAP_DURATION,
+    PortMapResult,
+    PortMapStatus,
+    _add_port_mapping_batch,
+    _DeviceProbe,
+    _DeviceProber,
+    _find_internal_ip_on_device_network,
+    _get_external_ip,
+    _NoInternalAddressMatchesDevice,
+    _normalize_port_specs,
+    _setup_port_maps,
+    external_ip_cache,
+)
+from .exceptions import PortMapFailed
+from .interfaces import InterfaceIndex, LocalAddress
+from .journal import JournalEntry, MappingJournal
+from .mappings import PortMappingEntry, get_specific_port_mapping_entry
+from .release import (
+    DEFAULT_RELEASE_TIMEOUT,
+    MappingOwner,
+    OwnedMapping,
+    delete_port_mappings,
+    register_owner,
+    unregister_owner,
+)
+from .soap import SOAPError, SOAPProtocolError, SOAPService
+from .typing import PortSpec
+
+DEFAULT_RENEW_BEFORE = 5 * 60  # 5 minutes
+DEFAULT_RENEWAL_JITTER = 30
+# Renewals due within this many seconds of each other are sent together
+DEFAULT_COALESCE_WINDOW = 60
+DEFAULT_RETRY_DELAY = 60
+
+# The asyncio backend wakes up at least this often to pick up new mappings
+_MAX_ASYNC_SLEEP = 30
+
+
+logger = logging.getLogger("upnp_port_forward.manager")
+
+
+# (external port, internal port, protocol)
+PortMapping = Tuple[int, int, str]
+# (external port, protocol), a device maps each to a single internal port
+_MappingKey = Tuple[int, str]
+
+
+class _ManagedMapping(NamedTuple):
+    internal_port: int
+    location: str
+    renew_at: float
+
+
+class PortMapManager(MappingOwner):
+    """
+    Own a set of port mappings and renew each of them shortly before its lease
+    expires.
+
+    Renewals go straight to the device and WAN service the mappings were set up
+    with, and renewals that fall within ``coalesce_window`` seconds of each other
+    are sent to the device as one batch.  Discovery only happens again if that
+    device stops working.
+
+    With a ``journal``, the mappings are recorded on disk as they are set up, so that
+    after a restart :meth:`recover` takes them over without discovery.
+
+    Renewals run either on a background thread (:meth:`start` / :meth:`stop`) or
+    from an asyncio event loop (:meth:`run`).  The mappings of a manager that is not
+    released are deleted by :func:`~upnp_port_forward.release_all`.
+
+    Permanent mappings don't need renewing, so ``duration`` can't be 0.
+    """
+
+    def __init__(
+        self,
+        duration: int = DEFAULT_PORTMAP_DURATION,
+        required_service_names: Optional[Tuple[str, ...]] = None,
+        device_cache: Optional[DeviceCache] = None,
+        renew_before: float = DEFAULT_RENEW_BEFORE,
+        jitter: float = DEFAULT_RENEWAL_JITTER,
+        coalesce_window: float = DEFAULT_COALESCE_WINDOW,
+        retry_delay: float = DEFAULT_RETRY_DELAY,
+        max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_CALLS,
+        journal: Optional[MappingJournal] = None,
+    ) -> None:
+        if duration <= 0:
+            raise ValueError(
+                f"Invalid lease duration: {duration}, set up permanent mappings with "
+                "setup_port_maps"
+            )
+        self.duration = duration
+        self.required_service_names = required_service_names
+        self.device_cache = device_cache
+        self.renew_before = renew_before
+        self.jitter = jitter
+        self.coalesce_window = coalesce_window
+        self.retry_delay = retry_delay
+        self.max_concurrent_calls = max_concurrent_calls
+        self.journal = journal
+
+        self._mappings: Dict[_MappingKey, _ManagedMapping] = {}
+        # The mappings being added or recovered, not managed until they are set up
+        self._adding: Dict[_MappingKey, int] = {}
+        self._devices: Dict[str, _DeviceProbe] = {}
+        # Guards the state above, and is never held while talking to a device, so
+        # that releasing the mappings doesn't wait for a slow device
+        self._lock = threading.RLock()
+        # Only one operation (adding, renewing, re-mapping, recovering) talks to the
+        # devices at a time
+        self._operation_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def mappings(self) -> Tuple[PortMapping, ...]:
+        with self._lock:
+            return tuple(
+                _port_mapping(key, managed) for key, managed in self._mappings.items()
+            )
+
+    def add(self, ports: Iterable[PortSpec]) -> Tuple[PortMapResult, ...]:
+        """
+        Map the given ports (see :func:`upnp_port_forward.setup_port_maps`) and keep
+        renewing them.  Mappings that conflict with an existing entry are not kept.
+
+        :raise ValueError: if an external port would be mapped to another internal
+            port than the one it is already managed for, or requested with
+        :raise PortMapFailed: if no device could add any of the mappings
+        """
+        port_mappings = _normalize_port_specs(ports)
+        if not port_mappings:
+            return ()
+        with self._operation_lock:
+            with self._lock:
+                self._check_conflicts(port_mappings)
+                self._adding = {
+                    (external_port, protocol): internal_port
+                    for external_port, internal_port, protocol in port_mappings
+                }
+            try:
+                results = self._map(port_mappings, time.monotonic())
+            finally:
+                with self._lock:
+                    self._adding = {}
+        self._wakeup.set()
+        return results
+
+    def remove(
+        self,
+        ports: Iterable[PortSpec],
+        delete_mappings: bool = True,
+        timeout: float = DEFAULT_RELEASE_TIMEOUT,
+    ) -> None:
+        """
+        Stop renewing the given mappings and, unless ``delete_mappings`` is False,
+        delete them from the device within ``timeout`` seconds.
+
+        Mappings that are being added are given up too, and deleted once set up.
+        """
+        with self._lock:
+            managed_mappings = set(self.mappings)
+            removed_keys = []
+            for port_mapping in _normalize_port_specs(ports):
+                key = _mapping_key(port_mapping)
+                if port_mapping in managed_mappings:
+                    removed_keys.append(key)
+                elif self._adding.get(key) == port_mapping[1]:
+                    del self._adding[key]
+            removed = [
+                self._owned_mapping(key, self._mappings.pop(key))
+                for key in removed_keys
+            ]
+            self._forget(removed_keys)
+        if delete_mappings:
+            # The devices keep being used for the other mappings
+            delete_port_mappings(
+                [owned for owned in removed if owned is not None],
+                timeout,
+                close_services=False,
+            )
+
+    def next_renewal_at(self) -> Optional[float]:
+        """
+        :return: the ``time.monotonic()`` time of the next renewal, if any
+        """
+        with self._lock:
+            return min(
+                (managed.renew_at for managed in self._mappings.values()), default=None
+            )
+
+    def renew_due(self, now: Optional[float] = None) -> Tuple[PortMapResult, ...]:
+        """
+        Renew the mappings that are due, along with those due within the coalescing
+        window, in one batch per device.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._operation_lock:
+            with self._lock:
+                due_by_location: Dict[str, List[PortMapping]] = defaultdict(list)
+                for key, managed in self._mappings.items():
+                    if managed.renew_at <= now + self.coalesce_window:
+                        due_by_location[managed.location].append(
+                            _port_mapping(key, managed)
+                        )
+
+            results: List[PortMapResult] = []
+            for location, port_mappings in due_by_location.items():
+                logger.debug(
+                    "Renewing %d port mappings on UPnP device at %s",
+                    len(port_mappings),
+                    location,
+                )
+                try:
+                    results.extend(
+                        self._map(port_mappings, now, location, reconcile=False)
+                    )
+                except PortMapFailed:
+                    logger.info(
+                        "Failed to renew %d port mappings, retrying in %ds",
+                        len(port_mappings),
+                        self.retry_delay,
+                    )
+                    self._retry_later(port_mappings, location, now)
+            return tuple(results)
+
+    def handle_network_change(
+        self,
+        local_addresses: Optional[Iterable[LocalAddress]] = None,
+        now: Optional[float] = None,
+        route_changed: bool = False,
+    ) -> Tuple[PortMapResult, ...]:
+        """
+        Set up again the mappings of the devices that a change of the local addresses
+        (``local_addresses``, or else those of the interfaces of this host) affected:
+        the devices now reached from another internal address, and those that are not
+        on any local network anymore.
+
+        With ``route_changed=True``, when the default route or its gateway changed,
+        the other devices are probed again too, and the mappings of those that don't
+        answer anymore are set up on the device now in use.  The other mappings are
+        left alone.
+        """
+        if now is None:
+            now = time.monotonic()
+        interface_index = InterfaceIndex(local_addresses)
+        with self._operation_lock:
+            with self._lock:
+                by_location: Dict[str, List[PortMapping]] = defaultdict(list)
+                for key, managed in self._mappings.items():
+                    by_location[managed.location].append(_port_mapping(key, managed))
+                devices = list(self._devices.items())
+
+            results: List[PortMapResult] = []
+            for location, probe in devices:
+                try:
+                    internal_ip: Optional[str] = _find_internal_ip_on_device_network(
+                        location, interface_index
+                    )
+                except _NoInternalAddressMatchesDevice:
+                    internal_ip = None
+                port_mappings = by_location[location]
+                if internal_ip != probe.internal_ip:
+                    self._readdress_device(probe, internal_ip, port_mappings)
+                elif not route_changed or self._still_answers(probe):
+                    continue
+                else:
+                    logger.info(
+                        "UPnP device at %s stopped answering after the default route "
+                        "changed",
+                        location,
+                    )
+                    self._drop_device(probe)
+                if not port_mappings:
+                    continue
+                try:
+                    results.extend(self._map(port_mappings, now, location))
+                except PortMapFailed:
+                    logger.info(
+                        "Failed to map %d ports again, retrying in %ds",
+                        len(port_mappings),
+                        self.retry_delay,
+                    )
+                    self._retry_later(port_mappings, location, now)
+            return tuple(results)
+
+    def release(self, timeout: float = DEFAULT_RELEASE_TIMEOUT) -> None:
+        """
+        Stop renewing all the mappings and delete them from their devices, all at
+        once, giving up after ``timeout`` seconds.
+
+        An operation in flight is not waited for: the mappings it sets up are
+        deleted as it completes.
+        """
+        delete_port_mappings(self._take_owned_mappings(), timeout)
+
+    def _take_owned_mappings(self) -> Tuple[OwnedMapping, ...]:
+        unregister_owner(self)
+        with self._lock:
+            owned_mappings = tuple(
+                owned
+                for owned in (
+                    self._owned_mapping(key, managed_mapping)
+                    for key, managed_mapping in self._mappings.items()
+                )
+                if owned is not None
+            )
+            self._forget(self._mappings)
+            self._mappings.clear()
+            self._adding = {}
+            wan_services = [probe.wan_service for probe in self._devices.values()]
+            self._devices.clear()
+        for wan_service in wan_services:
+            wan_service.close()
+        return owned_mappings
+
+    def recover(self, now: Optional[float] = None) -> Tuple[PortMapResult, ...]:
+        """
+        Take over the mappings recorded in the journal by a previous run, and renew
+        them straight on the device and WAN service they were set up on.
+
+        Entries that are now mapped to another host are dropped from the journal,
+        and those set up for an address this host doesn't have anymore are deleted
+        from the device too.  Entries on a device that can't be reached are left to
+        expire.
+        """
+        if self.journal is None:
+            return ()
+        if now is None:
+            now = time.monotonic()
+        entries_by_service: Dict[str, List[JournalEntry]] = defaultdict(list)
+        for entry in self.journal.entries():
+            entries_by_service[entry.control_url].append(entry)
+
+        interface_index = InterfaceIndex()
+        results: List[PortMapResult] = []
+        with self._operation_lock:
+            with self._lock:
+                self._adding = {
+                    entry.key: entry.internal_port
+                    for entries in entries_by_service.values()
+                    for entry in entries
+                    if entry.key not in self._mappings
+                }
+            try:
+                for entries in entries_by_service.values():
+                    results.extend(self._recover_device(entries, interface_index, now))
+            finally:
+                with self._lock:
+                    self._adding = {}
+        self.journal.compact()
+        self._wakeup.set()
+        return tuple(results)
+
+    #
+    # Thread backend
+    #
+    def start(self) -> None:
+        """
+        Renew the mappings from a background thread.
+        """
+        if self._thread is not None:
+            raise RuntimeError("PortMapManager is already running")
+        # Each thread gets its own event, a thread that was not waited for by stop()
+        # may still be finishing a renewal
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_thread,
+            args=(self._stopping,),
+            name="upnp-port-forward-renewal",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(
+        self, delete_mappings: bool = False, timeout: float = DEFAULT_RELEASE_TIMEOUT
+    ) -> None:
+        """
+        Stop the background thread, and delete all the mappings from their devices
+        within ``timeout`` seconds if ``delete_mappings`` is True.
+
+        The thread is only waited for when the mappings are kept: otherwise the
+        renewal in flight, if any, is left to complete in the background.
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if delete_mappings:
+            self.release(timeout)
+        elif thread is not None:
+            thread.join()
+
+    def _run_thread(self, stopping: threading.Event) -> None:
+        while not stopping.is_set():
+            self._wakeup.wait(self._seconds_until_next_renewal())
+            self._wakeup.clear()
+            if stopping.is_set():
+                break
+            if self._is_renewal_due():
+                try:
+                    self.renew_due()
+                except Exception:
+                    logger.exception("Unexpected error while renewing port mappings")
+                    self._wakeup.wait(self.retry_delay)
+
+    #
+    # asyncio backend
+    #
+    async def run(self) -> None:
+        """
+        Renew the mappings from the running event loop, until cancelled.
+
+        The SOAP calls of each renewal batch are made from the loop's default
+        executor.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            timeout = self._seconds_until_next_renewal()
+            await asyncio.sleep(
+                _MAX_ASYNC_SLEEP if timeout is None else min(timeout, _MAX_ASYNC_SLEEP)
+            )
+            if self._is_renewal_due():
+                await loop.run_in_executor(None, self.renew_due)
+
+    def _seconds_until_next_renewal(self) -> Optional[float]:
+        next_renewal_at = self.next_renewal_at()
+        if next_renewal_at is None:
+            return None
+        return max(0.0, next_renewal_at - time.monotonic())
+
+    def _is_renewal_due(self) -> bool:
+        next_renewal_at = self.next_renewal_at()
+        return next_renewal_at is not None and next_renewal_at <= time.monotonic()
+
+    def _renew_at(self, now: float) -> float:
+        lease_margin = min(
+            self.renew_before + random.uniform(0, self.jitter), self.duration / 2
+        )
+        return now + self.duration - lease_margin
+
+    def _recover_device(
+        self,
+        entries: Sequence[JournalEntry],
+        interface_index: InterfaceIndex,
+        now: float,
+    ) -> Tuple[PortMapResult, ...]:
+        device = entries[0]
+        wan_service = SOAPService(
+            device.control_url, device.service_type, device.service_name
+        )
+        try:
+            internal_ip = _find_internal_ip_on_device_network(
+                device.location, interface_index
+            )
+            external_ip = _get_external_ip(device.location, wan_service)
+        except (_NoInternalAddressMatchesDevice, PortMapFailed):
+            wan_service.close()
+            logger.info(
+                "UPnP device at %s can't be reached, leaving its %d journaled port "
+                "mappings to expire",
+                device.location,
+                len(entries),
+            )
+            return ()
+        probe = _DeviceProbe(
+            device.location, device.udn, internal_ip, wan_service, external_ip
+        )
+
+        stale_entries = [
+            entry for entry in entries if entry.internal_client != internal_ip
+        ]
+        # Those another host took over since are not ours to delete
+        owned_entries = [
+            entry
+            for entry in stale_entries
+            if _still_maps(wan_service, external_ip, entry)
+        ]
+        if owned_entries:
+            logger.info(
+                "Deleting %d journaled port mappings for %s, this host is now %s",
+                len(owned_entries),
+                owned_entries[0].internal_client,
+                internal_ip,
+            )
+            delete_port_mappings(
+                [
+                    OwnedMapping(
+                        device.location,
+                        wan_service,
+                        external_ip,
+                        entry.external_port,
+                        entry.protocol,
+                    )
+                    for entry in owned_entries
+                ],
+                close_services=False,
+            )
+        self._forget(entry.key for entry in stale_entries)
+
+        port_mappings = [
+            (entry.external_port, entry.internal_port, entry.protocol)
+            for entry in entries
+            if entry.internal_client == internal_ip
+        ]
+        if not port_mappings:
+            wan_service.close()
+            return ()
+        # The entries that are still ours are renewed, and those mapped to another
+        # host since are reported as conflicts and dropped
+        results = _add_port_mapping_batch(
+            probe, port_mappings, self.duration, self.max_concurrent_calls
+        )
+        self._schedule(probe, results, now)
+        return results
+
+    def _readdress_device(
+        self,
+        probe: _DeviceProbe,
+        internal_ip: Optional[str],
+        port_mappings: Sequence[PortMapping],
+    ) -> None:
+        # The external address may have changed along with the internal one
+        external_ip_cache.invalidate(probe.wan_service.control_url)
+        if internal_ip is None:
+            logger.info(
+                "UPnP device at %s is not on a local network anymore", probe.location
+            )
+            self._drop_device(probe)
+            return
+
+        logger.info(
+            "Internal address for UPnP device at %s changed from %s to %s",
+            probe.location,
+            probe.internal_ip,
+            internal_ip,
+        )
+        with self._lock:
+            if probe.location not in self._devices:
+                # Released in the meantime
+                return
+            # The device refuses to map a port again for another internal client
+            stale_mappings = [
+                self._owned_mapping(key, self._mappings[key])
+                for key in map(_mapping_key, port_mappings)
+                if key in self._mappings
+            ]
+            self._devices[probe.location] = probe._replace(internal_ip=internal_ip)
+        delete_port_mappings(
+            [owned for owned in stale_mappings if owned is not None],
+            close_services=False,
+        )
+
+    def _still_answers(self, probe: _DeviceProbe) -> bool:
+        # The address may have changed along with the route, so it is asked for again
+        external_ip_cache.invalidate(probe.wan_service.control_url)
+        try:
+            _get_external_ip(probe.location, probe.wan_service)
+        except PortMapFailed:
+            return False
+        return True
+
+    def _drop_device(self, probe: _DeviceProbe) -> None:
+        with self._lock:
+            self._devices.pop(probe.location, None)
+        probe.wan_service.close()
+        if self.device_cache is not None:
+            self.device_cache.invalidate(probe.udn or probe.location)
+
+    def _retry_later(
+        self, port_mappings: Sequence[PortMapping], location: str, now: float
+    ) -> None:
+        with self._lock:
+            for external_port, internal_port, protocol in port_mappings:
+                key = (external_port, protocol)
+                if self._is_wanted(key, internal_port):
+                    self._mappings[key] = _ManagedMapping(
+                        internal_port, location, now + self.retry_delay
+                    )
+
+    def _check_conflicts(self, port_mappings: Sequence[PortMapping]) -> None:
+        # Renewing both would have each renewal take the external port over from the
+        # other on the device
+        internal_ports = {
+            key: managed.internal_port for key, managed in self._mappings.items()
+        }
+        for external_port, internal_port, protocol in port_mappings:
+            managed_port = internal_ports.setdefault(
+                (external_port, protocol), internal_port
+            )
+            if managed_port != internal_port:
+                raise ValueError(
+                    f"{protocol} port {external_port} can't be mapped to port "
+                    f"{internal_port}, it is mapped to port {managed_port}"
+                )
+
+    def _is_wanted(self, key: _MappingKey, internal_port: int) -> bool:
+        managed = self._mappings.get(key)
+        if managed is not None:
+            return managed.internal_port == internal_port
+        return self._adding.get(key) == internal_port
+
+    def _map(
+        self,
+        port_mappings: Sequence[PortMapping],
+        now: float,
+        preferred_location: Optional[str] = None,
+        reconcile: bool = True,
+    ) -> Tuple[PortMapResult, ...]:
+        with self._lock:
+            known_devices = sorted(
+                self._devices.values(),
+                key=lambda probe: probe.location != preferred_location,
+            )
+        for probe in known_devices:
+            try:
+                # Pick up a new external address, and make sure the device still works
+                # if the address isn't cached anymore
+                probe = probe._replace(
+                    external_ip=_get_external_ip(probe.location, probe.wan_service)
+                )
+            except PortMapFailed:
+                logger.debug("UPnP device at %s stopped working", probe.location)
+                with self._lock:
+                    self._devices.pop(probe.location, None)
+                probe.wan_service.close()
+                continue
+
+            results = _add_port_mapping_batch(
+                probe,
+                port_mappings,
+                self.duration,
+                self.max_concurrent_calls,
+                reconcile,
+            )
+            if any(result.status is not PortMapStatus.FAILED for result in results):
+                self._schedule(probe, results, now)
+                return results
+            # The address may be what the device rejected
+            external_ip_cache.invalidate(probe.wan_service.control_url)
+
+        device_prober = _DeviceProber(
+            self.required_service_names, self.device_cache, concurrent=False
+        )
+        probe, results = _setup_port_maps(
+            device_prober, port_mappings, self.duration, self.max_concurrent_calls
+        )
+        self._schedule(probe, results, now)
+        return results
+
+    def _schedule(
+        self, probe: _DeviceProbe, results: Sequence[PortMapResult], now: float
+    ) -> None:
+        with self._lock:
+            dropped = self._record_results(probe, results, now)
+            kept = any(
+                device.wan_service is probe.wan_service
+                for device in self._devices.values()
+            )
+        if dropped:
+            logger.debug(
+                "Deleting %d port mappings that were removed while being set up",
+                len(dropped),
+            )
+            delete_port_mappings(dropped, close_services=False)
+        if not kept:
+            probe.wan_service.close()
+
+    def _record_results(
+        self, probe: _DeviceProbe, results: Sequence[PortMapResult], now: float
+    ) -> List[OwnedMapping]:
+        """
+        Manage the mappings that were set up, and return those that were removed or
+        released while being set up, which are not ours anymore.
+        """
+        set_up: List[PortMapResult] = []
+        dropped: List[OwnedMapping] = []
+        kept = False
+        for result in results:
+            key = (result.external_port, result.protocol)
+            if not self._is_wanted(key, result.internal_port):
+                if _is_leased(result):
+                    dropped.append(
+                        OwnedMapping(
+                            probe.location,
+                            probe.wan_service,
+                            probe.external_ip,
+                            result.external_port,
+                            result.protocol,
+                        )
+                    )
+                continue
+            kept = True
+            if result.status is PortMapStatus.EXISTING and _is_permanent(
+                result.existing_entry
+            ):
+                logger.info(
+                    "%s port %d is permanently mapped, no need to manage it",
+                    result.protocol,
+                    result.external_port,
+                )
+                self._mappings.pop(key, None)
+                self._forget([key])
+            elif result.status in (PortMapStatus.MAPPED, PortMapStatus.EXISTING):
+                self._mappings[key] = _ManagedMapping(
+                    result.internal_port, probe.location, self._renew_at(now)
+                )
+                set_up.append(result)
+            elif result.status is PortMapStatus.CONFLICT:
+                logger.info(
+                    "%s port %d is mapped by someone else, no longer managing it",
+                    result.protocol,
+                    result.external_port,
+                )
+                self._mappings.pop(key, None)
+                self._forget([key])
+            else:
+                self._mappings[key] = _ManagedMapping(
+                    result.internal_port, probe.location, now + self.retry_delay
+                )
+        if kept:
+            self._devices[probe.location] = probe
+            register_owner(self)
+        if self.journal is not None and set_up:
+            self.journal.record(
+                _journal_entry(probe, result, self.duration) for result in set_up
+            )
+        return dropped
+
+    def _forget(self, keys: Iterable[_MappingKey]) -> None:
+        if self.journal is not None:
+            self.journal.forget(keys)
+
+    def _owned_mapping(
+        self, key: _MappingKey, managed_mapping: _ManagedMapping
+    ) -> Optional[OwnedMapping]:
+        external_port, protocol = key
+        probe = self._devices.get(managed_mapping.location)
+        if probe is None:
+            # The device stopped working, the mapping will expire on its own
+            return None
+        return OwnedMapping(
+            probe.location,
+            probe.wan_service,
+            probe.external_ip,
+            external_port,
+            protocol,
+        )
+
+
+def _mapping_key(port_mapping: PortMapping) -> _MappingKey:
+    external_port, _, protocol = port_mapping
+    return (external_port, protocol)
+
+
+def _port_mapping(key: _MappingKey, managed_mapping: _ManagedMapping) -> PortMapping:
+    external_port, protocol = key
+    return (external_port, managed_mapping.internal_port, protocol)
+
+
+def _journal_entry(
+    probe: _DeviceProbe, result: PortMapResult, duration: int
+) -> JournalEntry:
+    if result.status is PortMapStatus.EXISTING and result.existing_entry is not None:
+        lease_duration = result.existing_entry.lease_duration
+    else:
+        lease_duration = duration
+    return JournalEntry(
+        location=probe.location,
+        udn=probe.udn,
+        service_name=probe.wan_service.name,
+        service_type=probe.wan_service.service_type,
+        control_url=probe.wan_service.control_url,
+        external_port=result.external_port,
+        internal_port=result.internal_port,
+        protocol=result.protocol,
+        internal_client=probe.internal_ip,
+        expires_at=time.time() + lease_duration if lease_duration else 0,
+    )
+
+
+def _is_leased(result: PortMapResult) -> bool:
+    if result.status is PortMapStatus.MAPPED:
+        return True
+    return result.status is PortMapStatus.EXISTING and not _is_permanent(
+        result.existing_entry
+    )
+
+
+def _is_permanent(entry: Optional[PortMappingEntry]) -> bool:
+    return entry is not None and entry.lease_duration == 0
+
+
+def _still_maps(
+    wan_service: SOAPService, remote_host: str, journal_entry: JournalEntry
+) -> bool:
+    """
+    :return: whether the device still maps the journaled port to the internal client
+        it was set up for
+    """
+    try:
+        entry = get_specific_port_mapping_entry(
+            wan_service,
+            journal_entry.external_port,
+            journal_entry.protocol,
+            remote_host,
+        )
+    except (SOAPError, SOAPProtocolError):
+        # Left to expire rather than deleted unchecked
+        logger.debug(
+            "Failed to look up the journaled %s port mapping %d on device: %s",
+            journal_entry.protocol,
+            journal_entry.external_port,
+            journal_entry.location,
+            exc_info=True,
+        )
+        return False
+    return entry is not None and entry.internal_client == journal_entry.internal_client
@@ -0,0 +1,165 @@
+"""
+Reading the port mapping table of a WAN service, and finding free ports in it.
+"""
+from collections import defaultdict
+import itertools
+import threading
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Optional, Set
+
+from .soap import SOAPError, SOAPProtocolError, SOAPService
+
+# GetSpecificPortMappingEntry: there is no entry for this port and protocol
+NO_SUCH_ENTRY = 714
+# GetGenericPortMappingEntry past the last entry.  713 is the standard error, but some
+# devices answer NoSuchEntryInArray instead.
+_END_OF_TABLE_ERRORS = (713, NO_SUCH_ENTRY)
+
+# Free external ports are picked among the non-privileged ones
+_MIN_FREE_PORT = 1024
+_MAX_PORT = 65535
+
+
+class PortMappingEntry(NamedTuple):
+    external_port: int
+    protocol: str
+    internal_port: int
+    internal_client: str
+    enabled: bool
+    description: str
+    # Seconds left on the lease, 0 for an entry that never expires
+    lease_duration: int
+    # Empty when the entry applies to all remote hosts
+    remote_host: str = ""
+
+
+def parse_port_mapping_entry(arguments: Dict[str, str]) -> PortMappingEntry:
+    """
+    Build an entry from the output arguments of GetGenericPortMappingEntry.
+
+    :raise SOAPProtocolError: if an argument is missing or invalid
+    """
+    try:
+        return PortMappingEntry(
+            external_port=int(arguments["NewExternalPort"]),
+            protocol=arguments["NewProtocol"].upper(),
+            internal_port=int(arguments["NewInternalPort"]),
+            internal_client=arguments["NewInternalClient"],
+            enabled=arguments.get("NewEnabled", "1").strip().lower()
+            in ("1", "true", "yes"),
+            description=arguments.get("NewPortMappingDescription", ""),
+            lease_duration=int(arguments.get("NewLeaseDuration") or 0),
+            remote_host=arguments.get("NewRemoteHost", ""),
+        )
+    except (KeyError, ValueError) as exc:
+        raise SOAPProtocolError(f"Invalid port mapping entry: {arguments}") from exc
+
+
+def specific_port_mapping_entry_arguments(
+    external_port: int, protocol: str, remote_host: str = ""
+) -> Dict[str, Any]:
+    return {
+        "NewRemoteHost": remote_host,
+        "NewExternalPort": external_port,
+        "NewProtocol": protocol,
+    }
+
+
+def parse_specific_port_mapping_entry(
+    arguments: Dict[str, str], external_port: int, protocol: str, remote_host: str = ""
+) -> PortMappingEntry:
+    """
+    Build an entry from the output arguments of GetSpecificPortMappingEntry, which
+    leave out the arguments of the request.
+    """
+    return parse_port_mapping_entry(
+        dict(
+            arguments,
+            NewExternalPort=str(external_port),
+            NewProtocol=protocol,
+            NewRemoteHost=remote_host,
+        )
+    )
+
+
+def get_specific_port_mapping_entry(
+    service: SOAPService, external_port: int, protocol: str, remote_host: str = ""
+) -> Optional[PortMappingEntry]:
+    """
+    :return: the entry of the external port and protocol, or None if there is none
+    :raise SOAPError: if the device returned another UPnP error
+    :raise SOAPProtocolError: if the device could not be reached or understood
+    """
+    try:
+        arguments = service.GetSpecificPortMappingEntry(
+            **specific_port_mapping_entry_arguments(
+                external_port, protocol, remote_host
+            )
+        )
+    except SOAPError as exc:
+        if exc.args and exc.args[0] == NO_SUCH_ENTRY:
+            return None
+        raise
+    return parse_specific_port_mapping_entry(
+        arguments, external_port, protocol, remote_host
+    )
+
+
+def iter_port_mapping_entries(service: SOAPService) -> Iterator[PortMappingEntry]:
+    """
+    Iterate over the port mapping table of the service.
+
+    Each entry is fetched with its own GetGenericPortMappingEntry call when the
+    iterator gets to it, so large tables are never held in memory and the
+    iteration can stop early.
+
+    :raise SOAPError: if the device returned another UPnP error than the end of the
+        table
+    :raise SOAPProtocolError: if the device could not be reached or understood
+    """
+    index = 0
+    while True:
+        try:
+            arguments = service.GetGenericPortMappingEntry(NewPortMappingIndex=index)
+        except SOAPError as exc:
+            if exc.args and exc.args[0] in _END_OF_TABLE_ERRORS:
+                return
+            raise
+        yield parse_port_mapping_entry(arguments)
+        index += 1
+
+
+class PortMappingIndex:
+    """
+    The external ports taken in the mapping table of a service, per protocol, to find
+    a free one without trying ports one by one on the device.
+
+    Ports handed out by :meth:`reserve_free_port` count as taken, so that concurrent
+    mappings are given different ports.
+    """
+
+    def __init__(self, entries: Iterable[PortMappingEntry] = ()) -> None:
+        self._taken_ports: Dict[str, Set[int]] = defaultdict(set)
+        for entry in entries:
+            self._taken_ports[entry.protocol].add(entry.external_port)
+        self._lock = threading.Lock()
+
+    def mark_taken(self, external_port: int, protocol: str) -> None:
+        with self._lock:
+            self._taken_ports[protocol].add(external_port)
+
+    def reserve_free_port(self, protocol: str, start: int) -> Optional[int]:
+        """
+        :return: the first port from ``start`` that is not taken for the protocol,
+            wrapping around to the first non-privileged port, or None if there is none
+        """
+        start = min(max(start, _MIN_FREE_PORT), _MAX_PORT)
+        candidates = itertools.chain(
+            range(start, _MAX_PORT + 1), range(_MIN_FREE_PORT, start)
+        )
+        with self._lock:
+            taken_ports = self._taken_ports[protocol]
+            for port in candidates:
+                if port not in taken_ports:
+                    taken_ports.add(port)
+                    return port
+        return None
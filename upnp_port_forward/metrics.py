@@ -0,0 +1,227 @@
+"""
+Timings and outcomes of each phase of discovery and port mapping.
+
+Observers are called with a :class:`PhaseTiming` at the end of each phase.  When no
+observer is registered, the phases are not even timed.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import enum
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .soap import SOAPError
+
+
+class Phase(enum.Enum):
+    # Sending the SSDP search, until the first device answered
+    DISCOVERY = "discovery"
+    # Fetching and parsing a device description
+    DESCRIPTION = "description"
+    # Finding the local address on the network of a device
+    INTERNAL_ADDRESS = "internal_address"
+    EXTERNAL_IP = "external_ip"
+    ADD_PORT_MAPPING = "add_port_mapping"
+    # Mapping the port on the default gateway with PCP or NAT-PMP
+    PCP = "pcp"
+
+
+OUTCOME_OK = "ok"
+# The search ended without any answer
+OUTCOME_NO_DEVICES = "no_devices"
+
+
+class PhaseTiming(NamedTuple):
+    phase: Phase
+    duration: float
+    # "ok", or the class of the error that ended the phase, e.g. "SOAPError:718"
+    outcome: str
+    # The location of the device description, for the phases involving a device
+    location: Optional[str] = None
+
+
+Observer = Callable[[PhaseTiming], None]
+
+_observers: Tuple[Observer, ...] = ()
+_observers_lock = threading.Lock()
+
+
+def add_observer(observer: Observer) -> None:
+    """
+    Call ``observer`` with the timing of every phase from now on.
+    """
+    global _observers
+    with _observers_lock:
+        _observers = _observers + (observer,)
+
+
+def remove_observer(observer: Observer) -> None:
+    global _observers
+    with _observers_lock:
+        _observers = tuple(other for other in _observers if other != observer)
+
+
+def error_class(exc: BaseException) -> str:
+    if isinstance(exc, SOAPError) and exc.args:
+        return f"{type(exc).__name__}:{exc.args[0]}"
+    return type(exc).__name__
+
+
+def record_phase(
+    phase: Phase, duration: float, outcome: str, location: Optional[str] = None
+) -> None:
+    if not _observers:
+        return
+    timing = PhaseTiming(phase, duration, outcome, location)
+    for observer in _observers:
+        observer(timing)
+
+
+@contextmanager
+def measure(phase: Phase, location: Optional[str] = None) -> Iterator[None]:
+    """
+    Time the phase run in the ``with`` block, which fails if it raises.
+    """
+    if not _observers:
+        yield
+        return
+
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as exc:
+        record_phase(phase, time.monotonic() - start, error_class(exc), location)
+        raise
+    else:
+        record_phase(phase, time.monotonic() - start, OUTCOME_OK, location)
+
+
+DEFAULT_DURATION_BUCKETS: Tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+
+def _labels(**labels: str) -> str:
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class PrometheusMetrics:
+    """
+    An observer keeping Prometheus-style metrics of the phases:
+
+    - ``upnp_port_forward_phase_duration_seconds``: histogram of durations per phase
+    - ``upnp_port_forward_phase_total``: counter of phases per outcome
+    - ``upnp_port_forward_device_errors_total``: counter of errors per device, phase
+      and error class
+
+    Register it with ``add_observer(metrics)`` and expose :meth:`render` to the
+    scraper.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_DURATION_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._durations: Dict[Phase, _Histogram] = {}
+        self._outcomes: Dict[Tuple[Phase, str], int] = defaultdict(int)
+        self._device_errors: Dict[Tuple[str, Phase, str], int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __call__(self, timing: PhaseTiming) -> None:
+        with self._lock:
+            if timing.phase not in self._durations:
+                self._durations[timing.phase] = _Histogram(self.buckets)
+            self._durations[timing.phase].observe(timing.duration)
+            self._outcomes[(timing.phase, timing.outcome)] += 1
+            if timing.outcome != OUTCOME_OK and timing.location is not None:
+                self._device_errors[
+                    (timing.location, timing.phase, timing.outcome)
+                ] += 1
+
+    def render(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines: List[str] = []
+        with self._lock:
+            lines.extend(
+                (
+                    "# HELP upnp_port_forward_phase_duration_seconds "
+                    "Time spent in each phase of discovery and port mapping.",
+                    "# TYPE upnp_port_forward_phase_duration_seconds histogram",
+                )
+            )
+            for phase, histogram in sorted(
+                self._durations.items(), key=lambda item: item[0].value
+            ):
+                cumulative_count = 0
+                bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative_count += count
+                    lines.append(
+                        "upnp_port_forward_phase_duration_seconds_bucket"
+                        f"{_labels(phase=phase.value, le=bound)} {cumulative_count}"
+                    )
+                lines.append(
+                    "upnp_port_forward_phase_duration_seconds_sum"
+                    f"{_labels(phase=phase.value)} {histogram.total}"
+                )
+                lines.append(
+                    "upnp_port_forward_phase_duration_seconds_count"
+                    f"{_labels(phase=phase.value)} {cumulative_count}"
+                )
+
+            lines.extend(
+                (
+                    "# HELP upnp_port_forward_phase_total "
+                    "Phases of discovery and port mapping, per outcome.",
+                    "# TYPE upnp_port_forward_phase_total counter",
+                )
+            )
+            for (phase, outcome), count in sorted(
+                self._outcomes.items(), key=lambda item: (item[0][0].value, item[0][1])
+            ):
+                lines.append(
+                    "upnp_port_forward_phase_total"
+                    f"{_labels(phase=phase.value, outcome=outcome)} {count}"
+                )
+
+            lines.extend(
+                (
+                    "# HELP upnp_port_forward_device_errors_total "
+                    "Errors of each device, per phase and error class.",
+                    "# TYPE upnp_port_forward_device_errors_total counter",
+                )
+            )
+            for (location, phase, outcome), count in sorted(
+                self._device_errors.items(),
+                key=lambda item: (item[0][0], item[0][1].value, item[0][2]),
+            ):
+                labels = _labels(location=location, phase=phase.value, error=outcome)
+                lines.append(f"upnp_port_forward_device_errors_total{labels} {count}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,255 @@
+"""
+Watch the address and default route changes of this host through rtnetlink (Linux
+only), and re-map the ports of a :class:`~upnp_port_forward.PortMapManager` as soon
+as they point at a stale internal address, rather than at the next renewal.
+"""
+import ipaddress
+import logging
+import socket
+import struct
+import threading
+import time
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from .exceptions import PortMapFailed
+from .manager import PortMapManager
+
+# Changes come in bursts (e.g. the old address goes, the new one and its routes
+# come), they are handled once the interfaces are quiet for this long
+DEFAULT_SETTLE_DELAY = 1.0  # seconds
+# How often the watcher thread checks whether it was stopped
+_POLL_INTERVAL = 0.5
+
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV4_ROUTE = 0x40
+_RTMGRP_IPV6_IFADDR = 0x100
+_RTMGRP_IPV6_ROUTE = 0x400
+_NETLINK_GROUPS = (
+    _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV4_ROUTE | _RTMGRP_IPV6_IFADDR | _RTMGRP_IPV6_ROUTE
+)
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_GATEWAY = 5
+RT_TABLE_MAIN = 254
+
+_NLMSG_HEADER = struct.Struct("=IHHII")
+_IFADDRMSG = struct.Struct("=BBBBI")
+_RTMSG = struct.Struct("=BBBBBBBBI")
+_RTATTR = struct.Struct("=HH")
+
+_MAX_MESSAGE_SIZE = 65536
+
+
+logger = logging.getLogger("upnp_port_forward.netlink")
+
+
+class NetworkChange(NamedTuple):
+    # "address" or "route"
+    kind: str
+    added: bool
+    # The address, or the gateway of the default route if it has one
+    address: Optional[str]
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def _iter_attributes(data: bytes, offset: int, end: int) -> Iterator[Tuple[int, bytes]]:
+    while offset + _RTATTR.size <= end:
+        length, attribute_type = _RTATTR.unpack_from(data, offset)
+        if length < _RTATTR.size:
+            return
+        payload_start, payload_end = offset + _RTATTR.size, offset + length
+        yield attribute_type, data[payload_start:payload_end]
+        offset += _align(length)
+
+
+def _format_address(family: int, packed: bytes) -> Optional[str]:
+    if family == socket.AF_INET and len(packed) == 4:
+        return str(ipaddress.IPv4Address(packed))
+    if family == socket.AF_INET6 and len(packed) == 16:
+        return str(ipaddress.IPv6Address(packed))
+    return None
+
+
+def _parse_address_message(
+    message_type: int, data: bytes, offset: int, end: int
+) -> Optional[NetworkChange]:
+    if offset + _IFADDRMSG.size > end:
+        return None
+    family = _IFADDRMSG.unpack_from(data, offset)[0]
+    attributes = dict(_iter_attributes(data, offset + _IFADDRMSG.size, end))
+    # IFA_ADDRESS is the peer address on point-to-point links, IFA_LOCAL is ours
+    packed = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS, b""))
+    return NetworkChange(
+        "address", message_type == RTM_NEWADDR, _format_address(family, packed)
+    )
+
+
+def _parse_route_message(
+    message_type: int, data: bytes, offset: int, end: int
+) -> Optional[NetworkChange]:
+    if offset + _RTMSG.size > end:
+        return None
+    family, destination_length, _, _, table, *_ = _RTMSG.unpack_from(data, offset)
+    # Only the default route of the main table tells where the router is
+    if destination_length != 0 or table != RT_TABLE_MAIN:
+        return None
+    attributes = dict(_iter_attributes(data, offset + _RTMSG.size, end))
+    gateway = attributes.get(RTA_GATEWAY)
+    return NetworkChange(
+        "route",
+        message_type == RTM_NEWROUTE,
+        None if gateway is None else _format_address(family, gateway),
+    )
+
+
+def parse_netlink_messages(data: bytes) -> Tuple[NetworkChange, ...]:
+    """
+    :return: the address and default route changes in a datagram of rtnetlink
+        messages, ignoring the other messages
+    """
+    changes: List[NetworkChange] = []
+    offset = 0
+    while offset + _NLMSG_HEADER.size <= len(data):
+        length, message_type, *_ = _NLMSG_HEADER.unpack_from(data, offset)
+        if length < _NLMSG_HEADER.size or offset + length > len(data):
+            break
+        payload_offset = offset + _NLMSG_HEADER.size
+        change = None
+        if message_type in (RTM_NEWADDR, RTM_DELADDR):
+            change = _parse_address_message(
+                message_type, data, payload_offset, offset + length
+            )
+        elif message_type in (RTM_NEWROUTE, RTM_DELROUTE):
+            change = _parse_route_message(
+                message_type, data, payload_offset, offset + length
+            )
+        if change is not None:
+            changes.append(change)
+        offset += _align(length)
+    return tuple(changes)
+
+
+class NetlinkSource:
+    """
+    The address and route changes announced by the kernel, read from an rtnetlink
+    socket, or from ``sock`` if given, which only needs to deliver datagrams of
+    rtnetlink messages.
+
+    :raise PortMapFailed: if rtnetlink is not available on this platform
+    """
+
+    def __init__(self, sock: Optional[socket.socket] = None) -> None:
+        if sock is None:
+            sock = _open_netlink_socket()
+        self._sock = sock
+
+    def receive(self, timeout: Optional[float]) -> Tuple[NetworkChange, ...]:
+        """
+        Wait up to ``timeout`` seconds for the next changes.
+
+        :return: the changes, or nothing if none came in time
+        """
+        self._sock.settimeout(timeout)
+        try:
+            data = self._sock.recv(_MAX_MESSAGE_SIZE)
+        except socket.timeout:
+            return ()
+        return parse_netlink_messages(data)
+
+    def close(self) -> None:
+        self._sock.close()
+
+
+def _open_netlink_socket() -> socket.socket:
+    netlink_family = getattr(socket, "AF_NETLINK", None)
+    if netlink_family is None:
+        raise PortMapFailed("rtnetlink is only available on Linux")
+    sock = socket.socket(netlink_family, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+    try:
+        sock.bind((0, _NETLINK_GROUPS))
+    except OSError as exc:
+        sock.close()
+        raise PortMapFailed("Unable to subscribe to rtnetlink changes") from exc
+    return sock
+
+
+class NetworkWatcher:
+    """
+    Have ``manager`` re-map its ports when the addresses or the default route of
+    this host change, from a background thread (:meth:`start` / :meth:`stop`).
+
+    Only the mappings of the devices now reached from another internal address, or
+    not on any local network anymore, are set up again, along with those of the
+    devices that stopped answering when the default route changed: see
+    :meth:`~upnp_port_forward.PortMapManager.handle_network_change`.
+    """
+
+    def __init__(
+        self,
+        manager: PortMapManager,
+        source: Optional[NetlinkSource] = None,
+        settle_delay: float = DEFAULT_SETTLE_DELAY,
+    ) -> None:
+        self.manager = manager
+        self.settle_delay = settle_delay
+        self._source = NetlinkSource() if source is None else source
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            raise RuntimeError("NetworkWatcher is already running")
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run_thread, name="upnp-port-forward-netlink", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread and close the event source.
+        """
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._source.close()
+
+    def _run_thread(self) -> None:
+        while not self._stopping:
+            changes = self._source.receive(_POLL_INTERVAL)
+            if not changes:
+                continue
+            changes += self._wait_until_settled()
+            if self._stopping:
+                break
+            logger.info("Network changed (%d changes), checking mappings", len(changes))
+            # A new default route may lead to another router, even when the addresses
+            # of this host stay the same
+            route_changed = any(change.kind == "route" for change in changes)
+            try:
+                self.manager.handle_network_change(route_changed=route_changed)
+            except Exception:
+                logger.exception("Unexpected error while handling a network change")
+
+    def _wait_until_settled(self) -> Tuple[NetworkChange, ...]:
+        changes: Tuple[NetworkChange, ...] = ()
+        settled_at = time.monotonic() + self.settle_delay
+        while not self._stopping:
+            timeout = settled_at - time.monotonic()
+            if timeout <= 0:
+                break
+            more_changes = self._source.receive(min(timeout, _POLL_INTERVAL))
+            if more_changes:
+                changes += more_changes
+                settled_at = time.monotonic() + self.settle_delay
+        return changes
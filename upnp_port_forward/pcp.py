@@ -0,0 +1,309 @@
+"""
+Port mapping on the default gateway with PCP (RFC 6887), or with NAT-PMP (RFC 6886)
+on the gateways that only speak the older protocol.
+
+A mapping is a single UDP exchange with the gateway, without any discovery, so it is
+tried first and UPnP only if the gateway doesn't answer.
+"""
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+from .exceptions import PortMapFailed
+from .interfaces import get_default_gateway
+from .metrics import Phase, measure
+
+# Both protocols are served on the same port, and a NAT-PMP gateway answers PCP
+# requests with a NAT-PMP "unsupported version" error
+PCP_SERVER_PORT = 5351
+
+DEFAULT_PCP_TIMEOUT = 0.5  # seconds
+# Unanswered requests are sent again after this delay, doubled every time
+_INITIAL_RETRANSMISSION_DELAY = 0.125
+
+_PCP_VERSION = 2
+_PCP_OPCODE_MAP = 1
+_PCP_RESPONSE_BIT = 0x80
+_PCP_OPTION_PREFER_FAILURE = 2
+# The gateway can't map the requested external port, and PREFER_FAILURE forbids it
+# to pick another one
+_PCP_CANNOT_PROVIDE_EXTERNAL = 11
+_PCP_HEADER = struct.Struct("!BBxBII12x")
+_PCP_MAP = struct.Struct("!12sB3xHH16s")
+_PROTOCOL_NUMBERS = {"TCP": 6, "UDP": 17}
+
+_NAT_PMP_VERSION = 0
+_NAT_PMP_OPCODE_EXTERNAL_ADDRESS = 0
+_NAT_PMP_OPCODES = {"UDP": 1, "TCP": 2}
+_NAT_PMP_RESPONSE_BIT = 0x80
+_NAT_PMP_UNSUPPORTED_VERSION = 1
+_NAT_PMP_HEADER = struct.Struct("!BBHI")
+_NAT_PMP_MAP_REQUEST = struct.Struct("!BBxxHHI")
+_NAT_PMP_MAP_RESPONSE = struct.Struct("!HHI")
+_NAT_PMP_EXTERNAL_ADDRESS_RESPONSE = struct.Struct("!4s")
+# The key of the external address request among the mapping ones
+_EXTERNAL_ADDRESS = "external address"
+
+# Large enough for any PCP message
+_MAX_MESSAGE_SIZE = 1100
+
+logger = logging.getLogger("upnp_port_forward.pcp")
+
+
+class GatewayMapping(NamedTuple):
+    # "PCP" or "NAT-PMP"
+    method: str
+    internal_ip: str
+    external_ip: str
+    # The protocols whose external port was taken by another host
+    conflicts: Tuple[str, ...] = ()
+
+
+class _NATPMPOnly(Exception):
+    pass
+
+
+def map_port_on_gateway(
+    port: int,
+    duration: int,
+    protocols: Sequence[str],
+    timeout: float = DEFAULT_PCP_TIMEOUT,
+    gateway_address: Optional[Tuple[str, int]] = None,
+) -> GatewayMapping:
+    """
+    Map ``port`` to the same port of this host, for each of the ``protocols``, on the
+    default gateway (or ``gateway_address``).
+
+    :raise PortMapFailed: if the gateway didn't answer within ``timeout`` seconds,
+        refused any of the mappings or had none of the ports available
+    """
+    if gateway_address is None:
+        gateway = get_default_gateway()
+        if gateway is None:
+            raise PortMapFailed("No default gateway")
+        gateway_address = (gateway, PCP_SERVER_PORT)
+
+    deadline = time.monotonic() + timeout
+    with measure(Phase.PCP, f"{gateway_address[0]}:{gateway_address[1]}"):
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.connect(gateway_address)
+                internal_ip = sock.getsockname()[0]
+                try:
+                    return _map_with_pcp(
+                        sock, internal_ip, port, duration, protocols, deadline
+                    )
+                except _NATPMPOnly:
+                    logger.debug("Gateway %s only speaks NAT-PMP", gateway_address[0])
+                    return _map_with_nat_pmp(
+                        sock, internal_ip, port, duration, protocols, deadline
+                    )
+        except OSError as exc:
+            # e.g. the gateway rejected the datagrams with an ICMP port unreachable
+            raise PortMapFailed(
+                f"Unable to reach the gateway at {gateway_address[0]}"
+            ) from exc
+
+
+_Key = TypeVar("_Key")
+
+
+def _exchange(
+    sock: socket.socket,
+    requests: Dict[_Key, bytes],
+    match: Callable[[bytes], Optional[_Key]],
+    deadline: float,
+) -> Dict[_Key, bytes]:
+    """
+    Send all the requests at once and collect the response to each of them, sending
+    the unanswered ones again with an exponential backoff until ``deadline``.
+
+    :return: the responses received by the deadline, by the key of their request
+    """
+    responses: Dict[_Key, bytes] = {}
+    retransmission_delay = _INITIAL_RETRANSMISSION_DELAY
+    send_at = time.monotonic()
+    while len(responses) < len(requests):
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        if now >= send_at:
+            for key, request in requests.items():
+                if key not in responses:
+                    sock.send(request)
+            send_at = now + retransmission_delay
+            retransmission_delay *= 2
+        sock.settimeout(min(send_at, deadline) - now)
+        try:
+            data = sock.recv(_MAX_MESSAGE_SIZE)
+        except socket.timeout:
+            continue
+        matched_key = match(data)
+        if matched_key is not None and matched_key in requests:
+            responses.setdefault(matched_key, data)
+    return responses
+
+
+def _ipv4_mapped(address: str) -> bytes:
+    return ipaddress.IPv6Address(f"::ffff:{address}").packed
+
+
+def _build_pcp_map_request(
+    nonce: bytes, protocol: str, port: int, duration: int, internal_ip: str
+) -> bytes:
+    header = struct.pack(
+        "!BBHI16s",
+        _PCP_VERSION,
+        _PCP_OPCODE_MAP,
+        0,
+        duration,
+        _ipv4_mapped(internal_ip),
+    )
+    map_request = _PCP_MAP.pack(
+        nonce, _PROTOCOL_NUMBERS[protocol], port, port, _ipv4_mapped("0.0.0.0")
+    )
+    # Fail rather than map another external port than the requested one
+    prefer_failure = struct.pack("!BxH", _PCP_OPTION_PREFER_FAILURE, 0)
+    return header + map_request + prefer_failure
+
+
+def _map_with_pcp(
+    sock: socket.socket,
+    internal_ip: str,
+    port: int,
+    duration: int,
+    protocols: Sequence[str],
+    deadline: float,
+) -> GatewayMapping:
+    nonces = {protocol: os.urandom(12) for protocol in protocols}
+    requests = {
+        protocol: _build_pcp_map_request(
+            nonces[protocol], protocol, port, duration, internal_ip
+        )
+        for protocol in protocols
+    }
+
+    def match(data: bytes) -> Optional[str]:
+        if data[:1] == bytes([_NAT_PMP_VERSION]):
+            raise _NATPMPOnly()
+        if len(data) < _PCP_HEADER.size + _PCP_MAP.size:
+            return None
+        version, opcode, *_ = _PCP_HEADER.unpack_from(data)
+        nonce = _PCP_MAP.unpack_from(data, _PCP_HEADER.size)[0]
+        if version != _PCP_VERSION or opcode != _PCP_RESPONSE_BIT | _PCP_OPCODE_MAP:
+            return None
+        return next(
+            (protocol for protocol in protocols if nonces[protocol] == nonce), None
+        )
+
+    responses = _exchange(sock, requests, match, deadline)
+    if len(responses) < len(requests):
+        raise PortMapFailed("No PCP response from the gateway")
+
+    external_ips = []
+    conflicts = []
+    for protocol, response in responses.items():
+        result_code = _PCP_HEADER.unpack_from(response)[2]
+        _, _, _, external_port, external_ip = _PCP_MAP.unpack_from(
+            response, _PCP_HEADER.size
+        )
+        if result_code == _PCP_CANNOT_PROVIDE_EXTERNAL:
+            conflicts.append(protocol)
+        elif result_code != 0:
+            raise PortMapFailed(
+                f"PCP gateway refused the {protocol} mapping: {result_code}"
+            )
+        elif external_port != port:
+            conflicts.append(protocol)
+        else:
+            external_ipv4 = ipaddress.IPv6Address(external_ip).ipv4_mapped
+            if external_ipv4 is None:
+                raise PortMapFailed("PCP gateway mapped the port on an IPv6 address")
+            external_ips.append(str(external_ipv4))
+    return _gateway_mapping("PCP", internal_ip, external_ips, conflicts)
+
+
+def _map_with_nat_pmp(
+    sock: socket.socket,
+    internal_ip: str,
+    port: int,
+    duration: int,
+    protocols: Sequence[str],
+    deadline: float,
+) -> GatewayMapping:
+    requests = {
+        # The external address is not part of the mapping responses
+        _EXTERNAL_ADDRESS: struct.pack(
+            "!BB", _NAT_PMP_VERSION, _NAT_PMP_OPCODE_EXTERNAL_ADDRESS
+        )
+    }
+    for protocol in protocols:
+        requests[protocol] = _NAT_PMP_MAP_REQUEST.pack(
+            _NAT_PMP_VERSION, _NAT_PMP_OPCODES[protocol], port, port, duration
+        )
+    keys = {
+        _NAT_PMP_RESPONSE_BIT | _NAT_PMP_OPCODE_EXTERNAL_ADDRESS: _EXTERNAL_ADDRESS,
+        **{
+            _NAT_PMP_RESPONSE_BIT | opcode: protocol
+            for protocol, opcode in _NAT_PMP_OPCODES.items()
+        },
+    }
+
+    def match(data: bytes) -> Optional[str]:
+        # Error responses may leave out everything but the header
+        if len(data) < _NAT_PMP_HEADER.size:
+            return None
+        version, opcode, result_code, _ = _NAT_PMP_HEADER.unpack_from(data)
+        if version != _NAT_PMP_VERSION or result_code == _NAT_PMP_UNSUPPORTED_VERSION:
+            # A late answer to one of the PCP requests
+            return None
+        return keys.get(opcode)
+
+    responses = _exchange(sock, requests, match, deadline)
+    if len(responses) < len(requests):
+        raise PortMapFailed("No NAT-PMP response from the gateway")
+
+    for response in responses.values():
+        result_code = _NAT_PMP_HEADER.unpack_from(response)[2]
+        if result_code != 0:
+            raise PortMapFailed(f"NAT-PMP gateway refused the request: {result_code}")
+
+    try:
+        packed_external_ip = _NAT_PMP_EXTERNAL_ADDRESS_RESPONSE.unpack_from(
+            responses[_EXTERNAL_ADDRESS], _NAT_PMP_HEADER.size
+        )[0]
+        external_ports = {
+            protocol: _NAT_PMP_MAP_RESPONSE.unpack_from(
+                responses[protocol], _NAT_PMP_HEADER.size
+            )[1]
+            for protocol in protocols
+        }
+    except struct.error as exc:
+        raise PortMapFailed("Truncated NAT-PMP response") from exc
+
+    conflicts = []
+    for protocol, external_port in external_ports.items():
+        if external_port != port:
+            # NAT-PMP can't forbid the gateway to pick another external port, give
+            # that one back
+            conflicts.append(protocol)
+            sock.send(
+                _NAT_PMP_MAP_REQUEST.pack(
+                    _NAT_PMP_VERSION, _NAT_PMP_OPCODES[protocol], port, 0, 0
+                )
+            )
+    external_ip = str(ipaddress.IPv4Address(packed_external_ip))
+    mapped = [external_ip] if len(conflicts) < len(protocols) else []
+    return _gateway_mapping("NAT-PMP", internal_ip, mapped, conflicts)
+
+
+def _gateway_mapping(
+    method: str, internal_ip: str, external_ips: Sequence[str], conflicts: Sequence[str]
+) -> GatewayMapping:
+    if not external_ips:
+        raise PortMapFailed("The port is taken on the gateway for all protocols")
+    return GatewayMapping(method, internal_ip, external_ips[0], tuple(conflicts))
@@ -0,0 +1,303 @@
+"""
+Deleting the port mappings set up by this process once they are not needed anymore,
+so that they don't linger on the device until their lease expires.
+
+Mappings are deleted concurrently across protocols and devices, and the deletions
+are given up at a deadline so that shutting down stays fast.
+"""
+import abc
+import atexit
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from types import FrameType
+from typing import Any, Iterable, NamedTuple, Optional, Sequence, Set, Tuple
+
+from .cache import DeviceCache
+from .client import (
+    DEFAULT_MAX_CONCURRENT_CALLS,
+    DEFAULT_PORTMAP_DURATION,
+    PortMapResult,
+    PortMapStatus,
+    _DeviceProber,
+    _normalize_port_specs,
+    _setup_port_maps,
+)
+from .fingerprints import FingerprintDB
+from .mappings import NO_SUCH_ENTRY
+from .soap import SOAPError, SOAPProtocolError, SOAPService
+from .typing import PortSpec
+
+DEFAULT_RELEASE_TIMEOUT = 2.0  # seconds
+
+# Upper bound on the DeletePortMapping calls in flight, over all devices
+_MAX_CONCURRENT_DELETIONS = 16
+
+
+logger = logging.getLogger("upnp_port_forward.release")
+
+
+class OwnedMapping(NamedTuple):
+    location: str
+    wan_service: SOAPService
+    # The NewRemoteHost the mapping was added with
+    remote_host: str
+    external_port: int
+    protocol: str
+
+
+def delete_port_mappings(
+    mappings: Sequence[OwnedMapping],
+    timeout: float = DEFAULT_RELEASE_TIMEOUT,
+    close_services: bool = True,
+) -> Tuple[OwnedMapping, ...]:
+    """
+    Delete the mappings concurrently, giving up after ``timeout`` seconds.  Unless
+    ``close_services`` is False, the services of the mappings are closed afterwards,
+    and the deletions still in flight close their connections once done.
+
+    :return: the mappings that could not be deleted, which expire on their own
+    """
+    if not mappings:
+        return ()
+
+    deadline = time.monotonic() + timeout
+    pending: "queue.Queue[int]" = queue.Queue()
+    for index in range(len(mappings)):
+        pending.put(index)
+    deleted: Set[int] = set()
+
+    def delete_pending() -> None:
+        while time.monotonic() < deadline:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            if _delete_port_mapping(mappings[index]):
+                deleted.add(index)
+
+    # Daemon threads, so that a device that doesn't answer never holds up the exit
+    workers = [
+        threading.Thread(
+            target=delete_pending, name="upnp-port-forward-release", daemon=True
+        )
+        for _ in range(min(_MAX_CONCURRENT_DELETIONS, len(mappings)))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
+
+    if close_services:
+        wan_services = {
+            id(mapping.wan_service): mapping.wan_service for mapping in mappings
+        }
+        for wan_service in wan_services.values():
+            wan_service.close()
+    left = tuple(
+        mapping for index, mapping in enumerate(mappings) if index not in deleted
+    )
+    if left:
+        logger.info(
+            "%d of %d port mappings could not be deleted in time, leaving them to "
+            "expire",
+            len(left),
+            len(mappings),
+        )
+    return left
+
+
+def _delete_port_mapping(mapping: OwnedMapping) -> bool:
+    try:
+        mapping.wan_service.DeletePortMapping(
+            NewRemoteHost=mapping.remote_host,
+            NewExternalPort=mapping.external_port,
+            NewProtocol=mapping.protocol,
+        )
+    except (SOAPError, SOAPProtocolError) as exc:
+        if isinstance(exc, SOAPError) and exc.args and exc.args[0] == NO_SUCH_ENTRY:
+            # Already gone
+            return True
+        logger.debug(
+            "Failed to delete %s port mapping %d on UPnP device at %s",
+            mapping.protocol,
+            mapping.external_port,
+            mapping.location,
+            exc_info=True,
+        )
+        return False
+    return True
+
+
+class MappingOwner(abc.ABC):
+    """
+    Base class of the objects owning port mappings, which :func:`release_all` takes
+    them from while they are registered.
+    """
+
+    @abc.abstractmethod
+    def _take_owned_mappings(self) -> Tuple[OwnedMapping, ...]:
+        """
+        Stop owning the mappings, and return them for deletion, without waiting for
+        any call to a device.
+        """
+
+
+_owners: Set[MappingOwner] = set()
+_owners_lock = threading.Lock()
+
+
+def register_owner(owner: MappingOwner) -> None:
+    with _owners_lock:
+        _owners.add(owner)
+
+
+def unregister_owner(owner: MappingOwner) -> None:
+    with _owners_lock:
+        _owners.discard(owner)
+
+
+def release_all(timeout: float = DEFAULT_RELEASE_TIMEOUT) -> Tuple[OwnedMapping, ...]:
+    """
+    Delete all the mappings of the unreleased :class:`PortMapHandle` and
+    :class:`~upnp_port_forward.PortMapManager` objects at once, giving up after
+    ``timeout`` seconds.
+
+    :return: the mappings that could not be deleted
+    """
+    with _owners_lock:
+        owners = list(_owners)
+        _owners.clear()
+    mappings = [mapping for owner in owners for mapping in owner._take_owned_mappings()]
+    return delete_port_mappings(mappings, timeout)
+
+
+class PortMapHandle(MappingOwner):
+    """
+    The port mappings set up by :func:`map_ports`, deleted from the device by
+    :meth:`release` or at the end of a ``with`` block.
+
+    Only the mappings that were added are deleted: existing entries and conflicts
+    are left alone.
+    """
+
+    def __init__(
+        self, results: Tuple[PortMapResult, ...], mappings: Sequence[OwnedMapping]
+    ) -> None:
+        self.results = results
+        self._mappings: Tuple[OwnedMapping, ...] = tuple(mappings)
+        self._lock = threading.Lock()
+        register_owner(self)
+
+    @property
+    def released(self) -> bool:
+        with self._lock:
+            return not self._mappings
+
+    def release(self, timeout: float = DEFAULT_RELEASE_TIMEOUT) -> None:
+        delete_port_mappings(self._take_owned_mappings(), timeout)
+
+    def _take_owned_mappings(self) -> Tuple[OwnedMapping, ...]:
+        unregister_owner(self)
+        with self._lock:
+            mappings, self._mappings = self._mappings, ()
+        return mappings
+
+    def __enter__(self) -> "PortMapHandle":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.release()
+
+
+def map_ports(
+    ports: Iterable[PortSpec],
+    duration: int = DEFAULT_PORTMAP_DURATION,
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    device_cache: Optional[DeviceCache] = None,
+    concurrent: bool = False,
+    max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_CALLS,
+    fingerprint_db: Optional[FingerprintDB] = None,
+    any_external_port: bool = False,
+) -> PortMapHandle:
+    """
+    Set up port mappings as :func:`~upnp_port_forward.setup_port_maps` does, and
+    return a handle that deletes them when released.
+
+    :raise PortMapFailed: if no device could add any of the mappings
+    """
+    port_mappings = _normalize_port_specs(ports)
+    if not port_mappings:
+        return PortMapHandle((), ())
+
+    device_prober = _DeviceProber(
+        required_service_names, device_cache, concurrent, fingerprint_db
+    )
+    probe, results = _setup_port_maps(
+        device_prober, port_mappings, duration, max_concurrent_calls, any_external_port
+    )
+    owned_mappings = [
+        OwnedMapping(
+            probe.location,
+            probe.wan_service,
+            probe.external_ip,
+            result.external_port,
+            result.protocol,
+        )
+        for result in results
+        if result.status is PortMapStatus.MAPPED
+    ]
+    if not owned_mappings:
+        # The handle has nothing to release, so nothing closes the service later
+        probe.wan_service.close()
+    return PortMapHandle(results, owned_mappings)
+
+
+_handlers_installed = False
+
+
+def install_release_handlers(
+    timeout: float = DEFAULT_RELEASE_TIMEOUT,
+    signals: Sequence[signal.Signals] = (signal.SIGTERM,),
+) -> None:
+    """
+    Call :func:`release_all` at exit and when one of the ``signals`` is received,
+    before the handler that was installed for it runs.
+
+    Signal handlers can only be installed from the main thread.
+    """
+    global _handlers_installed
+    if _handlers_installed:
+        return
+    _handlers_installed = True
+    atexit.register(release_all, timeout)
+    for signum in signals:
+        _chain_signal_handler(signum, timeout)
+
+
+def _chain_signal_handler(signum: signal.Signals, timeout: float) -> None:
+    previous_handler = signal.getsignal(signum)
+
+    def release_and_chain(received_signum: int, frame: Optional[FrameType]) -> None:
+        # The handler interrupts the main thread, which may hold one of the locks
+        # release_all takes: releasing from another thread, and only waiting for it
+        # up to the timeout, can't deadlock
+        releaser = threading.Thread(
+            target=release_all,
+            args=(timeout,),
+            name="upnp-port-forward-release",
+            daemon=True,
+        )
+        releaser.start()
+        releaser.join(timeout)
+        if callable(previous_handler):
+            previous_handler(received_signum, frame)
+        elif previous_handler != signal.SIG_IGN:
+            # Let the default action end the process
+            signal.signal(received_signum, signal.SIG_DFL)
+            os.kill(os.getpid(), received_signum)
+
+    signal.signal(signum, release_and_chain)
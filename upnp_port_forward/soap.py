@@ -0,0 +1,317 @@
+import http.client
+import re
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from .deadline import NO_DEADLINE, Deadline
+from .throttle import (
+    DEFAULT_SOAP_RETRIES,
+    DeviceThrottle,
+    backoff_delay,
+    get_device_throttle,
+)
+
+NS_SOAP_ENV = "http://schemas.xmlsoap.org/soap/envelope/"
+ENCODING_STYLE = "http://schemas.xmlsoap.org/soap/encoding/"
+
+DEFAULT_SOAP_TIMEOUT = 10  # seconds
+
+
+class SOAPError(Exception):
+    """
+    A UPnP error returned by the device.  The exception arguments are the
+    ``(error_code, error_description)`` pair, e.g. ``(718, "ConflictInMappingEntry")``.
+    """
+
+    pass
+
+
+class SOAPProtocolError(Exception):
+    """
+    The device could not be reached or answered with something that is not a valid
+    SOAP response.
+    """
+
+    pass
+
+
+class SOAPTransientError(SOAPProtocolError):
+    """
+    The device dropped the call or failed it without a UPnP error, as overwhelmed
+    devices do.  The call may succeed if made again.
+    """
+
+    pass
+
+
+def build_soap_request(
+    service_type: str, action_name: str, arguments: Dict[str, Any]
+) -> Tuple[Dict[str, str], bytes]:
+    """
+    Build the headers and body of a SOAP request for the given action.
+    """
+    arguments_xml = "".join(
+        f"<{name}>{escape(str(value))}</{name}>" for name, value in arguments.items()
+    )
+    body = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<s:Envelope xmlns:s="{NS_SOAP_ENV}" s:encodingStyle="{ENCODING_STYLE}">'
+        "<s:Body>"
+        f'<u:{action_name} xmlns:u="{service_type}">{arguments_xml}</u:{action_name}>'
+        "</s:Body>"
+        "</s:Envelope>"
+    ).encode("utf-8")
+    headers = {
+        "SOAPAction": f'"{service_type}#{action_name}"',
+        "Content-Type": 'text/xml; charset="utf-8"',
+        "Content-Length": str(len(body)),
+    }
+    return headers, body
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parse_xml(content: bytes) -> ElementTree.Element:
+    try:
+        return ElementTree.fromstring(content.strip())
+    except ElementTree.ParseError:
+        # Some devices embed their own XML files in the response, each with an XML
+        # declaration of its own.  Keep the first declaration and drop the others.
+        text = content.decode("utf-8", errors="replace").strip()
+        head, sep, tail = (
+            text.partition("?>") if text.startswith("<?xml") else ("", "", text)
+        )
+        try:
+            return ElementTree.fromstring(
+                head + sep + re.sub(r"<\?xml.*?\?>", "", tail, flags=re.I)
+            )
+        except ElementTree.ParseError as exc:
+            raise SOAPProtocolError(f"Malformed SOAP response: {exc}") from exc
+
+
+def parse_soap_response(
+    service_type: str, action_name: str, content: bytes
+) -> Dict[str, str]:
+    """
+    Extract the output arguments of a successful SOAP response.
+    """
+    xml = _parse_xml(content)
+    response = xml.find(f".//{{{service_type}}}{action_name}Response")
+    if response is None:
+        raise SOAPProtocolError(
+            f"Response did not include a {action_name}Response element for {service_type}"
+        )
+    return {_local_name(child.tag): child.text or "" for child in response}
+
+
+def parse_soap_fault(content: bytes) -> SOAPError:
+    """
+    Extract the UPnP error from a SOAP fault response.
+    """
+    xml = _parse_xml(content)
+    error_code = error_description = None
+    for element in xml.iter():
+        if _local_name(element.tag) == "errorCode":
+            error_code = element.text
+        elif _local_name(element.tag) == "errorDescription":
+            error_description = element.text
+    if error_code is None:
+        raise SOAPProtocolError("SOAP fault did not include an errorCode")
+    try:
+        return SOAPError(int(error_code.strip()), (error_description or "").strip())
+    except ValueError as exc:
+        raise SOAPProtocolError(f"Invalid UPnP error code: {error_code!r}") from exc
+
+
+class SOAPService:
+    """
+    A UPnP service called directly through its control URL.
+
+    Unlike ``upnpclient.Service``, this does not need the device or service
+    descriptions to be fetched, so a service that is already known can be used
+    straight away.  Actions can be called as methods:
+    ``service.GetExternalIPAddress()``.
+
+    Connections are kept alive and reused between calls, and concurrent calls from
+    several threads each get their own connection.
+
+    The calls in flight are capped by the ``throttle`` of the device, shared by all
+    its services by default, and the calls that fail transiently are made again up
+    to ``retries`` times, after an exponential backoff.
+
+    Each call, its retries included, is cut short at the ``deadline`` if given.
+    """
+
+    def __init__(
+        self,
+        control_url: str,
+        service_type: str,
+        name: str,
+        timeout: float = DEFAULT_SOAP_TIMEOUT,
+        retries: int = DEFAULT_SOAP_RETRIES,
+        throttle: Optional[DeviceThrottle] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        parsed_url = urlparse(control_url)
+        if parsed_url.scheme != "http" or not parsed_url.hostname:
+            raise ValueError(f"Unsupported control URL: {control_url}")
+        self.control_url = control_url
+        self.service_type = service_type
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.throttle = (
+            get_device_throttle(parsed_url.netloc) if throttle is None else throttle
+        )
+        self.deadline = NO_DEADLINE if deadline is None else deadline
+        self._idle_connections: List[http.client.HTTPConnection] = []
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"<SOAPService {self.name} at {self.control_url}>"
+
+    def __getattr__(self, action_name: str) -> Callable[..., Dict[str, str]]:
+        if action_name.startswith("_"):
+            raise AttributeError(action_name)
+
+        def action(**arguments: Any) -> Dict[str, str]:
+            return self.call(action_name, **arguments)
+
+        return action
+
+    def call(self, action_name: str, **arguments: Any) -> Dict[str, str]:
+        """
+        Call an action on the service and return its output arguments.
+
+        :raise SOAPError: if the device returned a UPnP error
+        :raise SOAPProtocolError: if the device could not be reached or its
+            response could not be understood
+        :raise DeadlineExceeded: if the deadline of the service passed
+        """
+        headers, body = build_soap_request(self.service_type, action_name, arguments)
+
+        phase = f"the {action_name} call"
+        attempt = 0
+        while True:
+            timeout = self.deadline.budget(phase, self.timeout)
+            self.throttle.acquire(self.deadline, phase)
+            # Less time may be left after waiting for the other calls
+            timeout = min(timeout, self.deadline.remaining())
+            started_at = time.monotonic()
+            transient_failure = False
+            try:
+                return self._call_once(action_name, headers, body, timeout)
+            except SOAPProtocolError as exc:
+                transient_failure = isinstance(exc, SOAPTransientError)
+                # Cut short by the deadline rather than by the device
+                self.deadline.check(phase)
+                if not transient_failure or attempt >= self.retries:
+                    raise
+            finally:
+                self.throttle.release(time.monotonic() - started_at, transient_failure)
+            time.sleep(min(backoff_delay(attempt), self.deadline.remaining()))
+            attempt += 1
+
+    def _call_once(
+        self, action_name: str, headers: Dict[str, str], body: bytes, timeout: float
+    ) -> Dict[str, str]:
+        connection, is_reused = self._acquire_connection()
+        try:
+            response, content = self._send(connection, headers, body, timeout)
+        except (OSError, http.client.HTTPException) as exc:
+            connection.close()
+            if not is_reused:
+                raise self._connection_error(action_name, exc) from exc
+            # The device may have closed the idle connection in the meantime
+            connection = self._new_connection()
+            try:
+                response, content = self._send(connection, headers, body, timeout)
+            except (OSError, http.client.HTTPException) as retry_exc:
+                connection.close()
+                raise self._connection_error(action_name, retry_exc) from retry_exc
+
+        with self._lock:
+            # Calls still in flight when the service is closed don't pool their
+            # connection, as nothing would close it anymore
+            keep_alive = not response.will_close and not self._closed
+            if keep_alive:
+                self._idle_connections.append(connection)
+        if not keep_alive:
+            connection.close()
+
+        if response.status == 200:
+            return parse_soap_response(self.service_type, action_name, content)
+        elif response.status == 500:
+            try:
+                soap_error = parse_soap_fault(content)
+            except SOAPProtocolError as exc:
+                raise SOAPTransientError(
+                    f"{action_name} call to {self.control_url} failed without a "
+                    "UPnP error"
+                ) from exc
+            raise soap_error
+        elif response.status == 503:
+            raise SOAPTransientError(
+                f"{action_name} call to {self.control_url} returned HTTP 503"
+            )
+        else:
+            raise SOAPProtocolError(
+                f"{action_name} call to {self.control_url} returned HTTP {response.status}"
+            )
+
+    def _connection_error(self, action_name: str, exc: Exception) -> SOAPProtocolError:
+        message = f"{action_name} call to {self.control_url} failed: {exc}"
+        # A device that doesn't answer, or doesn't listen, is not worth waiting for
+        # again
+        if isinstance(exc, (socket.timeout, ConnectionRefusedError)):
+            return SOAPProtocolError(message)
+        return SOAPTransientError(message)
+
+    def close(self) -> None:
+        """
+        Close the idle connections to the device.  The service can still be called
+        afterwards, but its connections are no longer kept alive.
+        """
+        with self._lock:
+            self._closed = True
+            idle_connections, self._idle_connections = self._idle_connections, []
+        for connection in idle_connections:
+            connection.close()
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(
+            urlparse(self.control_url).netloc, timeout=self.timeout
+        )
+
+    def _acquire_connection(self) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop(), True
+        return self._new_connection(), False
+
+    def _send(
+        self,
+        connection: http.client.HTTPConnection,
+        headers: Dict[str, str],
+        body: bytes,
+        timeout: float,
+    ) -> Tuple[http.client.HTTPResponse, bytes]:
+        # Reused connections get the timeout of the call too
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        parsed_url = urlparse(self.control_url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+        connection.request("POST", path, body, headers)
+        response = connection.getresponse()
+        return response, response.read()
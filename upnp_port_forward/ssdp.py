@@ -0,0 +1,138 @@
+import socket
+import time
+from typing import Generator, NamedTuple, Optional, Set, Tuple
+
+from .metrics import OUTCOME_NO_DEVICES, OUTCOME_OK, Phase, record_phase
+
+SSDP_MULTICAST_ADDRESS = ("239.255.255.250", 1900)
+SSDP_MULTICAST_TTL = 2
+
+ROOT_DEVICE_SEARCH_TARGET = "upnp:rootdevice"
+# Only the devices exposing a WAN connection service can map ports
+WAN_CONNECTION_SEARCH_TARGETS: Tuple[str, ...] = (
+    "urn:schemas-upnp-org:service:WANIPConnection:1",
+    "urn:schemas-upnp-org:service:WANIPConnection:2",
+    "urn:schemas-upnp-org:service:WANPPPConnection:1",
+)
+
+DEFAULT_DISCOVERY_TIMEOUT = 5  # seconds
+# Devices wait a random delay of up to MX seconds before answering, ask them not to
+# wait more than the minimum allowed
+SEARCH_MX = 1
+
+
+class SSDPResponse(NamedTuple):
+    location: str
+    usn: str
+    search_target: str
+    server: str
+
+    @property
+    def udn(self) -> str:
+        """
+        The device part of the USN, e.g. ``uuid:...``, if the device sent one.
+        """
+        device, _, _ = self.usn.partition("::")
+        return device if device.startswith("uuid:") else ""
+
+
+def build_msearch(
+    search_target: str, mx: int, ssdp_address: Tuple[str, int] = SSDP_MULTICAST_ADDRESS,
+) -> bytes:
+    """
+    Build an M-SEARCH request asking the devices matching ``search_target`` to answer
+    within ``mx`` seconds.
+    """
+    host, port = ssdp_address
+    return (
+        "M-SEARCH * HTTP/1.1\r\n"
+        f"HOST: {host}:{port}\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        f"MX: {mx}\r\n"
+        f"ST: {search_target}\r\n"
+        "\r\n"
+    ).encode("ascii")
+
+
+def parse_ssdp_response(data: bytes) -> Optional[SSDPResponse]:
+    """
+    Parse the answer of a device to an M-SEARCH request.
+
+    :return: the parsed response, or None if ``data`` isn't a valid search response
+    """
+    status_line, *header_lines = data.decode("utf-8", errors="replace").split("\r\n")
+    try:
+        version, status, *_ = status_line.split(" ", 2)
+    except ValueError:
+        return None
+    if not version.startswith("HTTP/") or status != "200":
+        return None
+
+    headers = {}
+    for line in header_lines:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+
+    if "location" not in headers:
+        return None
+    return SSDPResponse(
+        location=headers["location"],
+        usn=headers.get("usn", ""),
+        search_target=headers.get("st", ""),
+        server=headers.get("server", ""),
+    )
+
+
+def search(
+    search_targets: Tuple[str, ...] = WAN_CONNECTION_SEARCH_TARGETS,
+    timeout: float = DEFAULT_DISCOVERY_TIMEOUT,
+    ssdp_address: Tuple[str, int] = SSDP_MULTICAST_ADDRESS,
+) -> Generator[SSDPResponse, None, None]:
+    """
+    Send an M-SEARCH for each of ``search_targets`` and yield the answers as they
+    arrive, for up to ``timeout`` seconds.
+
+    A device answering several of the search targets is only yielded once: answers
+    are deduplicated by USN and by description location.  Stop iterating to end the
+    search early, e.g. as soon as a suitable device answered.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, SSDP_MULTICAST_TTL)
+        sock.bind(("", 0))
+        for search_target in search_targets:
+            sock.sendto(
+                build_msearch(search_target, SEARCH_MX, ssdp_address), ssdp_address
+            )
+
+        seen_usns: Set[str] = set()
+        seen_locations: Set[str] = set()
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, _ = sock.recvfrom(65507)
+            except socket.timeout:
+                break
+
+            response = parse_ssdp_response(data)
+            if response is None:
+                continue
+            if response.usn in seen_usns or response.location in seen_locations:
+                continue
+            if response.usn:
+                seen_usns.add(response.usn)
+            seen_locations.add(response.location)
+            if len(seen_locations) == 1:
+                record_phase(Phase.DISCOVERY, time.monotonic() - start, OUTCOME_OK)
+            yield response
+
+        if not seen_locations:
+            record_phase(Phase.DISCOVERY, timeout, OUTCOME_NO_DEVICES)
+    finally:
+        sock.close()
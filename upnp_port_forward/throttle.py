@@ -0,0 +1,102 @@
+"""
+Pacing of the SOAP calls to each device.
+
+Consumer routers drop or fail calls when they get too many at once, so the calls in
+flight to a device are capped, and the cap adapts to how the device copes: it grows
+by one after a full window of quick successful calls, and is halved when a call
+fails transiently or is slow.
+"""
+import random
+import threading
+from typing import Dict
+
+from .deadline import NO_DEADLINE, Deadline
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 16
+# Calls slower than this mean that the device is struggling
+DEFAULT_SLOW_CALL_DURATION = 2.0  # seconds
+
+DEFAULT_SOAP_RETRIES = 3
+_INITIAL_BACKOFF = 0.1  # seconds
+_MAX_BACKOFF = 2.0
+
+
+class DeviceThrottle:
+    """
+    Cap the concurrent calls to a device, additively increasing the cap while the
+    device copes and halving it when it struggles.
+    """
+
+    def __init__(
+        self,
+        initial_concurrency: int = DEFAULT_INITIAL_CONCURRENCY,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        slow_call_duration: float = DEFAULT_SLOW_CALL_DURATION,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.slow_call_duration = slow_call_duration
+        self._limit = max(1, min(initial_concurrency, max_concurrency))
+        self._in_flight = 0
+        # Quick successful calls since the limit last changed
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        with self._condition:
+            return self._limit
+
+    def acquire(
+        self, deadline: Deadline = NO_DEADLINE, phase: str = "the wait for the device"
+    ) -> None:
+        """
+        Wait until a call can be made to the device.
+
+        :raise DeadlineExceeded: if the ``deadline`` passed first, during ``phase``
+        """
+        with self._condition:
+            while self._in_flight >= self._limit:
+                deadline.check(phase)
+                self._condition.wait(
+                    None if deadline.timeout is None else deadline.remaining()
+                )
+            self._in_flight += 1
+
+    def release(self, duration: float, transient_failure: bool = False) -> None:
+        """
+        Record the outcome of a call started with :meth:`acquire`.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if transient_failure or duration > self.slow_call_duration:
+                self._limit = max(1, self._limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self._limit:
+                    self._limit = min(self._limit + 1, self.max_concurrency)
+                    self._successes = 0
+            self._condition.notify_all()
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    :return: the delay before retrying a call that failed ``attempt + 1`` times,
+        exponential with full jitter
+    """
+    return random.uniform(0, min(_MAX_BACKOFF, _INITIAL_BACKOFF * 2 ** attempt))
+
+
+_throttles: Dict[str, DeviceThrottle] = {}
+_throttles_lock = threading.Lock()
+
+
+def get_device_throttle(netloc: str) -> DeviceThrottle:
+    """
+    :return: the throttle shared by all the services of the device at ``netloc``
+    """
+    with _throttles_lock:
+        if netloc not in _throttles:
+            _throttles[netloc] = DeviceThrottle()
+        return _throttles[netloc]
@@ -1,9 +1,33 @@
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
 import logging
-from typing import NamedTuple, Tuple
-
-import upnpclient
+import queue
+import threading
+import time
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import urllib.error
 
+from upnp_port_forward.cache import UnusableReason
+from upnp_port_forward.client import (
+    WAN_SERVICE_NAMES,
+    _advertisement,
+    _device_key,
+    unusable_device_cache,
+)
+from upnp_port_forward.description import (
+    DEFAULT_HTTP_TIMEOUT,
+    ServiceDescription,
+    fetch_device,
+)
 from upnp_port_forward.exceptions import NoPortMapServiceFound
+from upnp_port_forward.fingerprints import DeviceModel, FingerprintDB
+from upnp_port_forward.interfaces import InterfaceIndex
+from upnp_port_forward.metrics import Phase, measure
+from upnp_port_forward.ssdp import SSDPResponse, search
+
+# Upper bound on the devices scanned at once
+_MAX_CONCURRENT_SCANS = 16
 
 
 class UPnPServiceNames(NamedTuple):
@@ -12,38 +36,188 @@ class UPnPServiceNames(NamedTuple):
     service_names: Tuple[str, ...]
 
 
-def fetch_add_portmapping_services() -> Tuple[UPnPServiceNames, ...]:
+def _may_map_ports(
+    service: ServiceDescription, required_service_names: Optional[Tuple[str, ...]]
+) -> bool:
+    if required_service_names:
+        return service.name in required_service_names
+    return service.is_wan_connection or service.name in WAN_SERVICE_NAMES
+
+
+def _scan_device(
+    response: SSDPResponse,
+    required_service_names: Optional[Tuple[str, ...]],
+    http_timeout: float,
+    interface_index: InterfaceIndex,
+    fingerprint_db: Optional[FingerprintDB] = None,
+) -> Optional[UPnPServiceNames]:
     """
-    :return: returns the available devices and services for which the action 'AddPortMapping' exists
+    Only the descriptions of the WAN connection services, or of the
+    ``required_service_names`` if given, are fetched to look for the action.
+
+    The first service found is recorded in ``fingerprint_db`` with its actions.
+    Devices with an invalid description are skipped until their advertisement or
+    the local interfaces change, as ``setup_port_map`` does.
     """
-    devices = upnpclient.discover()
-    if not devices:
-        raise NoPortMapServiceFound("No UPnP devices available")
+    logger = logging.getLogger("upnp_port_forward.tools.export")
+    location = response.location
+    local_addresses = interface_index.local_addresses
+    unusable = unusable_device_cache.get(
+        _device_key(response), _advertisement(response), local_addresses
+    )
+    if unusable is not None and unusable.reason is UnusableReason.INVALID_DESCRIPTION:
+        logger.debug("Skipping known invalid device description at %s", location)
+        return None
+    try:
+        with measure(Phase.DESCRIPTION, location):
+            device = fetch_device(location, http_timeout)
+    except (ValueError, urllib.error.HTTPError) as exc:
+        logger.error("Error '%s' for %s", exc, location)
+        unusable_device_cache.record(
+            _device_key(response),
+            UnusableReason.INVALID_DESCRIPTION,
+            _advertisement(response),
+            local_addresses,
+        )
+        return None
+    except OSError as exc:
+        logger.error("Error '%s' for %s", exc, location)
+        return None
+
+    service_names: List[str] = []
+    for service in device.services:
+        if not _may_map_ports(service, required_service_names):
+            continue
+        try:
+            actions = device.get_actions(service)
+        except (OSError, ValueError) as exc:
+            logger.error("Error '%s' for %s", exc, service.scpd_url)
+            continue
+        if "AddPortMapping" in actions:
+            if fingerprint_db is not None and not service_names:
+                fingerprint_db.record(
+                    DeviceModel.of(device.description), service.name, actions
+                )
+            service_names.append(service.name)
+
+    if not service_names:
+        return None
+    return UPnPServiceNames(
+        device.description.friendly_name, device.location, tuple(service_names)
+    )
+
+
+def iter_add_portmapping_services(
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    timeout: Optional[float] = None,
+    fingerprint_db: Optional[FingerprintDB] = None,
+) -> Iterator[UPnPServiceNames]:
+    """
+    Scan the devices concurrently as they answer the search, and yield the services
+    of each device for which the action 'AddPortMapping' exists as soon as its scan
+    is done.
+
+    With a ``timeout``, the search and the scans are given up after that many seconds
+    in total, and the devices that are still being scanned are left out.
+
+    With a ``fingerprint_db``, the port mapping service of each device model is
+    recorded in it, so that ``setup_port_map`` uses it straight away.
+
+    :raise NoPortMapServiceFound: if no device answered the search
+    """
+    logger = logging.getLogger("upnp_port_forward.tools.export")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    http_timeout = (
+        DEFAULT_HTTP_TIMEOUT if timeout is None else min(timeout, DEFAULT_HTTP_TIMEOUT)
+    )
+    # Listed once for all the devices, rather than once per scan
+    interface_index = InterfaceIndex()
+    # Only the devices exposing a WAN connection service answer the search
+    responses = search() if timeout is None else search(timeout=timeout)
+
+    executor = ThreadPoolExecutor(
+        max_workers=_MAX_CONCURRENT_SCANS, thread_name_prefix="upnp-port-forward"
+    )
+    # Completed scans, then None once the search is over
+    completed: "queue.Queue[Optional[Future[Optional[UPnPServiceNames]]]]" = (
+        queue.Queue()
+    )
+    stopped = threading.Event()
+    scheduled_scans: List["Future[Optional[UPnPServiceNames]]"] = []
+
+    def submit_scans() -> None:
+        try:
+            for response in responses:
+                if stopped.is_set():
+                    break
+                future = executor.submit(
+                    _scan_device,
+                    response,
+                    required_service_names,
+                    http_timeout,
+                    interface_index,
+                    fingerprint_db,
+                )
+                scheduled_scans.append(future)
+                future.add_done_callback(completed.put)
+        finally:
+            responses.close()
+            completed.put(None)
 
-    services_with_AddPortMapping = []
-    for upnp_dev in devices:
-        service_names = []
-        for service in upnp_dev.services:
+    search_thread = threading.Thread(
+        target=submit_scans, name="upnp-port-forward-search", daemon=True
+    )
+    search_thread.start()
+    searching = True
+    completed_count = 0
+    try:
+        while searching or completed_count < len(scheduled_scans):
             try:
-                service["AddPortMapping"]
-            except KeyError:
+                future = completed.get(
+                    timeout=None
+                    if deadline is None
+                    else max(0.0, deadline - time.monotonic())
+                )
+            except queue.Empty:
+                logger.warning(
+                    "Scan timed out, %d devices left out",
+                    len(scheduled_scans) - completed_count,
+                )
+                break
+            if future is None:
+                searching = False
                 continue
-            else:
-                service_names.append(service.name)
+            completed_count += 1
+            result = future.result()
+            if result is not None:
+                yield result
+    finally:
+        stopped.set()
+        for future in scheduled_scans:
+            future.cancel()
+        executor.shutdown(wait=False)
 
-        if len(service_names) > 0:
-            services_with_AddPortMapping.append(
-                UPnPServiceNames(
-                    upnp_dev.friendly_name, upnp_dev.location, tuple(service_names)
-                )
-            )
+    if not scheduled_scans:
+        raise NoPortMapServiceFound("No UPnP devices available")
 
+
+def fetch_add_portmapping_services(
+    required_service_names: Optional[Tuple[str, ...]] = None,
+    timeout: Optional[float] = None,
+    fingerprint_db: Optional[FingerprintDB] = None,
+) -> Tuple[UPnPServiceNames, ...]:
+    """
+    :return: returns the available devices and services for which the action 'AddPortMapping' exists
+    """
+    services_with_AddPortMapping = tuple(
+        iter_add_portmapping_services(required_service_names, timeout, fingerprint_db)
+    )
     if len(services_with_AddPortMapping) <= 0:
         raise NoPortMapServiceFound(
             "Unable to find a device with a port mapping service"
         )
 
-    return tuple(services_with_AddPortMapping)
+    return services_with_AddPortMapping
 
 
 def output_upnp_service_names(
@@ -79,14 +253,55 @@ def output_upnp_service_names(
     logger.info("\n".join(service_names_output))
 
 
-def main() -> None:
+def output_json_lines(upnp_service_names: UPnPServiceNames) -> None:
+    print(json.dumps(upnp_service_names._asdict()), flush=True)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="List the UPnP services of the network that can map ports."
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print each device as a line of JSON as soon as it is scanned",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="seconds after which the devices that are still being scanned are left out",
+    )
+    parser.add_argument(
+        "--service-name",
+        action="append",
+        dest="service_names",
+        help="only check the services with this name (can be repeated)",
+    )
+    parser.add_argument(
+        "--fingerprint-db",
+        help="record the port mapping service of each router model in this file",
+    )
+    args = parser.parse_args(argv)
+    required_service_names = tuple(args.service_names) if args.service_names else None
+    fingerprint_db = (
+        None if args.fingerprint_db is None else FingerprintDB(args.fingerprint_db)
+    )
+
     logger = logging.getLogger("upnp_port_forward.tools.export")
     try:
-        upnp_service_names_by_device = fetch_add_portmapping_services()
+        if args.json:
+            for upnp_service_names in iter_add_portmapping_services(
+                required_service_names, args.timeout, fingerprint_db
+            ):
+                output_json_lines(upnp_service_names)
+        else:
+            output_upnp_service_names(
+                fetch_add_portmapping_services(
+                    required_service_names, args.timeout, fingerprint_db
+                )
+            )
     except NoPortMapServiceFound:
         logger.error("No port mapping services found")
-    else:
-        output_upnp_service_names(upnp_service_names_by_device)
 
 
 if __name__ == "__main__":
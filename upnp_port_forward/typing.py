@@ -1,4 +1,8 @@
 import ipaddress
-from typing import Union
+from typing import Tuple, Union
 
 AnyIPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+AnyIPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# A port number mapped for both UDP and TCP, or (external port, internal port, protocol)
+PortSpec = Union[int, Tuple[int, int, str]]